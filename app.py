@@ -3,12 +3,11 @@
 import streamlit as st
 import os
 import tempfile
-import glob
 import cv2
 import shutil
 import time
-import json
 import face_match_backend as backend
+import face_match_jobs as jobs
 
 # --- ترجمه‌ها (Translations) ---
 T = {
@@ -32,6 +31,7 @@ T = {
     "cropped_db_not_built": "پایگاه داده چهره‌های برش‌خورده هنوز ساخته نشده است.",
     "no_cropped_faces_info": "هیچ چهره برش‌خورده‌ای یافت نشد. برای پردازش تصاویر منبع، روی «ساخت/به‌روزرسانی» کلیک کنید.",
     "cropped_faces_found": "{} چهره برش‌خورده یافت شد.",
+    "gallery_page_label": "صفحه ({} صفحه)",
     "match_results_header": "✅ نتایج تطبیق",
     "strong_match_header": "شخص «#{}» یک تطابق قوی است!",
     "matched_identity_label": "هویت تطبیق داده شده:",
@@ -59,14 +59,37 @@ T = {
         "- **yolov8:** نسخه جدید و سریع YOLO. برای تشخیص سریع چهره‌ها در ویدیوهای زنده عالی است، اما ممکن است به اندازه retinaface دقیق نباشد.\n\n"
         "- **opencv:** شناساگر داخلی کتابخانه OpenCV. سریع و ساده است اما دقت آن در مقایسه با مدل‌های دیگر کمتر است و ممکن است چهره‌های سخت را از دست بدهد."
     ),
+    "detect_max_side_label": "حداکثر ضلع تصویر برای شناساگر (پیکسل)",
+    "detect_max_side_help": "تصاویر و فریم‌های بزرگ‌تر پیش از شناسایی چهره کوچک می‌شوند تا شناسایی چند برابر سریع‌تر شود؛ چهره‌ها همچنان از تصویر با وضوح کامل برش داده می‌شوند. صفر = وضوح کامل.",
     "metric_label": "معیار فاصله",
     "threshold_label": "آستانه تایید",
     "threshold_help": "مقدار کمتر = تطبیق سخت‌گیرانه‌تر.",
     "video_options_header": "🎬 تنظیمات ویدیو",
     "frame_skip_label": "پرش از فریم",
     "frame_skip_help": "پردازش ۱ فریم از هر تعداد فریم.",
+    "sample_seconds_label": "فاصله نمونه‌برداری (ثانیه)",
+    "sample_seconds_help": "در صورت مقدار بیشتر از صفر، به جای پرش از فریم، هر چند ثانیه یک فریم پردازش می‌شود.",
+    "adaptive_sampling_label": "نمونه‌برداری تطبیقی",
+    "adaptive_sampling_help": "در اطراف تغییر صحنه یا ظاهر شدن چهره جدید، فریم‌های بیشتری پردازش می‌شود.",
     "model_status_header": "📦 وضعیت مدل",
     "model_ready_success": "✅ مدل «{}» آماده است.",
+    "model_state_downloaded": "وزن‌های مدل دانلود شده‌اند؛ مدل در اولین استفاده بارگذاری می‌شود.",
+    "model_state_loading": "⏳ در حال بارگذاری مدل در پس‌زمینه...",
+    "model_state_loaded": "مدل در حافظه پردازش‌گرها بارگذاری شده است.",
+    "prewarm_label": "پیش‌بارگذاری در پس‌زمینه",
+    "prewarm_help": "پس از نمایش صفحه، کتابخانه‌های سنگین و مدل انتخاب‌شده در پس‌زمینه بارگذاری می‌شوند تا اولین تحلیل منتظر آن‌ها نماند.",
+    "model_workers_label": "تعداد پردازش‌گرهای مدل",
+    "model_workers_help": "حداکثر تعداد پردازه‌های دائمی مدل که هر تحلیل یا ساخت پایگاه داده به کار می‌گیرد. این پردازه‌ها بین همه کارها مشترک‌اند و تعدادشان یک بار، در اولین استفاده، تعیین می‌شود.",
+    "stage_timings_label": "نمایش زمان‌بندی مراحل",
+    "stage_timings_help": "زمان صرف‌شده در هر مرحله (رمزگشایی، شناسایی، استخراج ویژگی، خوشه‌بندی، جستجو) و عمق صف‌ها را پس از تحلیل نمایش می‌دهد.",
+    "stage_timings_header": "⏱️ زمان‌بندی مراحل پردازش",
+    "indexed_models_label": "مدل‌های نمایه‌شده",
+    "indexed_models_help": "جاسازی‌های پایگاه داده برای این مدل‌ها در پس‌زمینه به‌روز نگه داشته می‌شوند تا تغییر مدل بدون بازسازی انجام شود. فقط مدل‌هایی که وزن‌هایشان دانلود شده است نمایه می‌شوند.",
+    "index_state_ready": "✅ {} آماده ({} چهره)",
+    "index_state_building": "⏳ {} در حال نمایه‌سازی ({} چهره)",
+    "index_state_stale": "🔄 {} در انتظار به‌روزرسانی",
+    "index_state_missing": "⚪ {} هنوز نمایه نشده",
+    "index_state_error": "⚠️ {}: {}",
     "model_not_found_warning": "مدل «{}» یافت نشد.",
     "model_download_info": "مدل در اولین استفاده به طور خودکار دانلود می‌شود، یا می‌توانید اکنون آن را دانلود کنید.",
     "download_model_button": "دانلود مدل «{}»",
@@ -102,6 +125,14 @@ T = {
     "progress_bar_init": "در حال آماده‌سازی...",
     "progress_bar_processing": "در حال پردازش...",
     "video_process_complete": "پردازش ویدیو کامل شد!",
+    "job_queued_info": "کار در صف انتظار است (جایگاه {}).",
+    "cancel_job_button": "⏹️ لغو کار",
+    "job_cancelling_caption": "در حال لغو کار...",
+    "job_cancelled_info": "کار لغو شد.",
+    "job_failed_error": "اجرای کار ناموفق بود: {}",
+    "job_queue_full_error": "صف کارها پر است. لطفاً کمی بعد دوباره تلاش کنید.",
+    "recent_jobs_expander": "کارهای اخیر",
+    "no_jobs_caption": "هنوز کاری ثبت نشده است.",
     "unknown_person": "ناشناس",
     "not_applicable": "N/A",
 }
@@ -111,6 +142,13 @@ T = {
 FACE_DATABASE_ROOT = os.path.join(os.getcwd(), "face_database")
 PROCESSED_DB_PATH = os.path.join(FACE_DATABASE_ROOT, "_cropped_faces")
 METADATA_FILE = os.path.join(FACE_DATABASE_ROOT, "metadata.json")
+METADATA_DB = os.path.join(FACE_DATABASE_ROOT, "metadata.sqlite3")
+GALLERY_PAGE_SIZE = 24
+MODEL_OPTIONS = ("ArcFace", "VGG-Face", "Facenet", "SFace")
+QUERY_CACHE_PATH = os.path.join(FACE_DATABASE_ROOT, "_query_cache")
+JOBS_PATH = os.path.join(FACE_DATABASE_ROOT, "_jobs")
+JOB_WORKERS = 2
+JOB_POLL_SECONDS = 1.0
 os.makedirs(FACE_DATABASE_ROOT, exist_ok=True)
 
 # --- Page Configuration and Styling ---
@@ -150,20 +188,33 @@ if 'analysis_complete' not in st.session_state:
     st.session_state.analysis_complete = False
 if 'edit_modal_for' not in st.session_state:
     st.session_state.edit_modal_for = None
-
-# --- Metadata Helper Functions (with UTF-8 support) ---
-def load_metadata():
-    if os.path.exists(METADATA_FILE):
-        with open(METADATA_FILE, 'r', encoding='utf-8') as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-    return {}
-
-def save_metadata(data):
-    with open(METADATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+if 'stage_timings' not in st.session_state:
+    st.session_state.stage_timings = None
+if 'job_id' not in st.session_state:
+    # Kept in the URL too, so reloading the page picks the running analysis back up.
+    st.session_state.job_id = st.query_params.get("job")
+if 'loaded_job' not in st.session_state:
+    st.session_state.loaded_job = None
+if 'job_errors' not in st.session_state:
+    st.session_state.job_errors = []
+if 'job_log' not in st.session_state:
+    st.session_state.job_log = []
+if 'build_job_id' not in st.session_state:
+    st.session_state.build_job_id = None
+
+# --- Metadata Store (SQLite; imports a legacy metadata.json once) ---
+@st.cache_resource
+def get_metadata_store():
+    return backend.MetadataStore(METADATA_DB, METADATA_FILE)
+
+METADATA = get_metadata_store()
+
+# --- Job Scheduler (analyses and builds run in the background, shared by all sessions) ---
+@st.cache_resource
+def get_job_scheduler():
+    return jobs.JobScheduler(JOBS_PATH, JOB_WORKERS)
+
+JOBS = get_job_scheduler()
 
 # --- UI Helper Functions ---
 def handle_db_upload():
@@ -174,6 +225,7 @@ def handle_db_upload():
             file_path = os.path.join(FACE_DATABASE_ROOT, uploaded_file.name)
             with open(file_path, "wb") as f:
                 f.write(uploaded_file.getbuffer())
+            backend.make_thumbnail(file_path)
             saved_count += 1
         if saved_count > 0:
             st.toast(T["saved_new_images"].format(saved_count))
@@ -189,36 +241,40 @@ def edit_info_dialog(img_filename, current_meta):
         
         submitted = st.form_submit_button(T["save_changes_button"])
         if submitted:
-            metadata = load_metadata()
-            metadata[img_filename] = {"name": name, "national_code": nat_code}
-            save_metadata(metadata)
+            METADATA.set(img_filename, name, nat_code)
             st.toast(T["saved_info_toast"].format(img_filename), icon="✅")
             st.session_state.edit_modal_for = None
             st.rerun()
 
+def gallery_page(image_files, key):
+    """Shows a page selector and returns the slice of image_files on the current page."""
+    page_count = max(1, -(-len(image_files) // GALLERY_PAGE_SIZE))
+    if page_count == 1:
+        return image_files
+    page = st.number_input(T["gallery_page_label"].format(page_count), 1, page_count, 1, key=key)
+    start = (page - 1) * GALLERY_PAGE_SIZE
+    return image_files[start:start + GALLERY_PAGE_SIZE]
+
 def manage_source_database_ui(db_path):
-    metadata = load_metadata()
-    
     if st.session_state.edit_modal_for:
         img_to_edit = st.session_state.edit_modal_for
-        current_meta = metadata.get(img_to_edit, {})
+        current_meta = METADATA.get(img_to_edit)
         edit_info_dialog(img_to_edit, current_meta)
 
     with st.container(height=350):
-        image_files = glob.glob(os.path.join(db_path, '*.jpg')) + \
-                      glob.glob(os.path.join(db_path, '*.jpeg')) + \
-                      glob.glob(os.path.join(db_path, '*.png'))
+        image_files = backend.cached_image_listing(db_path)
 
         if not image_files:
             st.info(T["db_empty_info"])
             return
 
         st.markdown(f"**{T['db_images_found'].format(len(image_files))}**")
+        page_files = gallery_page(image_files, "source_gallery_page")
         cols = st.columns(4)
-        for i, img_path in enumerate(sorted(image_files)):
+        for i, img_path in enumerate(page_files):
             with cols[i % 4]:
                 img_filename = os.path.basename(img_path)
-                st.image(img_path, caption=img_filename, use_container_width=True)
+                st.image(backend.make_thumbnail(img_path), caption=img_filename, use_container_width=True)
                 
                 button_cols = st.columns(2)
                 with button_cols[0]: # Edit Button on the left
@@ -229,10 +285,8 @@ def manage_source_database_ui(db_path):
                 with button_cols[1]: # Delete Button on the right
                     if st.button(T["delete_button_icon"], key=f"del_src_{img_path}", use_container_width=True, type="secondary", help=T["delete_button_help"]):
                         try:
-                            os.remove(img_path)
-                            if img_filename in metadata:
-                                del metadata[img_filename]
-                                save_metadata(metadata)
+                            backend.remove_image(img_path)
+                            METADATA.delete(img_filename)
                             st.toast(T["deleted_toast"].format(img_filename))
                             st.rerun()
                         except Exception as e:
@@ -245,24 +299,22 @@ def display_cropped_faces_ui(db_path):
         return
 
     with st.container(height=350):
-        image_files = glob.glob(os.path.join(db_path, '*.jpg')) + \
-                      glob.glob(os.path.join(db_path, '*.jpeg')) + \
-                      glob.glob(os.path.join(db_path, '*.png'))
+        image_files = backend.cached_image_listing(db_path)
 
         if not image_files:
             st.info(T["no_cropped_faces_info"])
             return
 
         st.markdown(f"**{T['cropped_faces_found'].format(len(image_files))}**")
+        page_files = gallery_page(image_files, "cropped_gallery_page")
         cols = st.columns(4)
-        for i, img_path in enumerate(sorted(image_files)):
+        for i, img_path in enumerate(page_files):
             with cols[i % 4]:
-                st.image(img_path, caption=os.path.splitext(os.path.basename(img_path))[0], use_container_width=True)
+                st.image(backend.make_thumbnail(img_path), caption=os.path.splitext(os.path.basename(img_path))[0], use_container_width=True)
 
 def display_results_ui(results, verification_threshold):
     if not results: return
-    metadata = load_metadata()
-    
+
     st.markdown("---")
     st.subheader(T["match_results_header"])
     unmatched_faces, matched_faces_count = [], 0
@@ -274,16 +326,7 @@ def display_results_ui(results, verification_threshold):
             match = result['matches'].iloc[0]
             
             matched_identity_path = match['identity']
-            matched_cropped_filename = os.path.basename(matched_identity_path)
-            source_file_stem = matched_cropped_filename.rsplit('_face_', 1)[0]
-            
-            source_filename = None
-            for key in metadata.keys():
-                if os.path.splitext(key)[0] == source_file_stem:
-                    source_filename = key
-                    break
-            
-            person_info = metadata.get(source_filename, {})
+            _, person_info = METADATA.lookup_crop(matched_identity_path)
             person_name = person_info.get("name", T["unknown_person"])
             person_code = person_info.get("national_code", T["not_applicable"])
             
@@ -309,25 +352,80 @@ def display_results_ui(results, verification_threshold):
     if matched_faces_count == 0 and not unmatched_faces:
         st.warning(T["no_strong_matches_warning"])
 
+def submit_job(kind, params, priority, input_path=None, label=''):
+    """Queues a job on the shared scheduler; returns None, after an error message, if the queue is full."""
+    try:
+        return JOBS.submit(kind, params, priority, input_path=input_path, label=label)
+    except jobs.JobQueueFull:
+        st.error(T["job_queue_full_error"])
+        return None
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress_ui(job_id):
+    """Polls a queued or running job and reruns the whole page once it has finished."""
+    job = JOBS.get(job_id)
+    if job is None or job['status'] not in jobs.ACTIVE_STATUSES:
+        st.rerun()
+    if job['status'] == jobs.QUEUED:
+        st.info(T["job_queued_info"].format(job['queue_position']))
+    else:
+        st.progress(min(job['progress'], 1.0), text=job['progress_text'] or T["progress_bar_processing"])
+        preview_path = JOBS.preview_path(job_id)
+        if os.path.exists(preview_path):
+            st.image(preview_path, caption=T["progress_bar_processing"])
+    if job['cancel_requested']:
+        st.caption(T["job_cancelling_caption"])
+    elif st.button(T["cancel_job_button"], key=f"cancel_{job_id}"):
+        JOBS.cancel(job_id)
+        st.rerun()
+
+def load_job_result(job):
+    """Moves a finished analysis job's result into the session, marking strong matches on images."""
+    result = JOBS.result(job['id']) or {}
+    processed_img = result.get('processed_media')
+    if processed_img is not None:
+        for res in result['results']:
+            if res.get('has_strong_match'):
+                fa = res['facial_area']
+                cv2.rectangle(processed_img, (fa['x'], fa['y']), (fa['x'] + fa['w'], fa['y'] + fa['h']), (0, 255, 0), 3)
+                # The text on the image remains English for now as cv2 doesn't handle Persian well
+                cv2.putText(processed_img, f"MATCH: #{res['person_index']}", (fa['x'], fa['y'] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
+    st.session_state.processed_media = processed_img
+    st.session_state.results = result.get('results', [])
+    st.session_state.stage_timings = result.get('stage_timings')
+    st.session_state.job_errors = result.get('errors', [])
+    st.session_state.job_log = result.get('log', [])
+    st.session_state.analysis_complete = True
+    st.session_state.loaded_job = job['id']
+
 # --- Main UI Layout ---
 st.title(f"{T['page_icon']} {T['dashboard_title']}")
 
 # --- Sidebar ---
 with st.sidebar:
     st.header(T["config_header"])
-    MODEL_NAME = st.selectbox(T["model_label"], ("ArcFace", "VGG-Face", "Facenet", "SFace"), 0, help=T["model_help"])
+    MODEL_NAME = st.selectbox(T["model_label"], MODEL_OPTIONS, 0, help=T["model_help"])
     DETECTOR_BACKEND = st.selectbox(T["detector_label"], ('retinaface', 'mtcnn', 'yolov8', 'opencv'), 0, help=T["detector_help"])
+    DETECT_MAX_SIDE = st.number_input(T["detect_max_side_label"], 0, 8192, backend.DETECTION_MAX_SIDE, 160, help=T["detect_max_side_help"])
     DISTANCE_METRIC = st.selectbox(T["metric_label"], ('cosine', 'euclidean', 'euclidean_l2'), 0)
     VERIFICATION_THRESHOLD = st.slider(T["threshold_label"], 0.0, 2.0, backend.get_threshold(MODEL_NAME, DISTANCE_METRIC), 0.01, help=T["threshold_help"])
     st.markdown("---")
     st.header(T["video_options_header"])
     FRAME_SKIP = st.number_input(T["frame_skip_label"], 1, 300, 15, help=T["frame_skip_help"])
+    SAMPLE_SECONDS = st.number_input(T["sample_seconds_label"], 0.0, 60.0, 0.0, 0.5, help=T["sample_seconds_help"])
+    ADAPTIVE_SAMPLING = st.checkbox(T["adaptive_sampling_label"], False, help=T["adaptive_sampling_help"])
     st.markdown("---")
     
     st.header(T["model_status_header"])
-    model_is_ready = backend.check_model_exists(MODEL_NAME)
+    MODEL_WORKERS = st.number_input(T["model_workers_label"], 1, os.cpu_count() or 1, 1, help=T["model_workers_help"])
+    SHOW_STAGE_TIMINGS = st.checkbox(T["stage_timings_label"], False, help=T["stage_timings_help"])
+    PREWARM = st.checkbox(T["prewarm_label"], True, help=T["prewarm_help"])
+    # Judged from the weights file and the worker pool only; rendering the sidebar never imports TensorFlow.
+    model_state = backend.model_readiness(MODEL_NAME, DETECTOR_BACKEND)
+    model_is_ready = model_state != 'missing'
     if model_is_ready:
         st.success(T["model_ready_success"].format(MODEL_NAME))
+        st.caption(T[f"model_state_{model_state}"])
     else:
         st.warning(T["model_not_found_warning"].format(MODEL_NAME))
         st.info(T["model_download_info"])
@@ -341,6 +439,16 @@ with st.sidebar:
             time.sleep(2)
             st.rerun()
 
+    INDEXED_MODELS = st.multiselect(T["indexed_models_label"], MODEL_OPTIONS, list(MODEL_OPTIONS), help=T["indexed_models_help"])
+    if os.path.isdir(PROCESSED_DB_PATH):
+        # Only models with downloaded weights are filled, so the filler never triggers a download.
+        filler = backend.fill_gallery_indexes(PROCESSED_DB_PATH, [m for m in INDEXED_MODELS if backend.check_model_exists(m)])
+        for indexed_model, status in filler.status().items():
+            if 'error' in status:
+                st.caption(T["index_state_error"].format(indexed_model, status['error']))
+            else:
+                st.caption(T[f"index_state_{status['state']}"].format(indexed_model, status['rows']))
+
 # --- Main Page Layout ---
 col_center, col_right = st.columns([2, 3])
 
@@ -352,6 +460,8 @@ with col_center:
         st.session_state.processed_media = None
         st.session_state.results = None
         st.session_state.analysis_complete = False
+        st.session_state.job_id = None
+        st.query_params.pop("job", None)
 
     st.markdown("---")
     st.header(T["db_management_header"])
@@ -367,22 +477,37 @@ with col_center:
         manage_source_database_ui(FACE_DATABASE_ROOT)
 
     with st.expander(T["expander_process_db"], expanded=True):
+        active_builds = JOBS.list_jobs(kind='build', statuses=jobs.ACTIVE_STATUSES, limit=1)
         col1, col2 = st.columns(2)
         with col1:
-            if st.button(T["build_db_button"], type="primary", use_container_width=True, help=T["build_db_help"]):
-                with st.spinner(T["processing_db_spinner"].format(DETECTOR_BACKEND)):
-                    _, count, failures = backend.crop_and_prepare_db(FACE_DATABASE_ROOT, DETECTOR_BACKEND)
-                    st.success(T["db_build_success"].format(count))
-                    if failures: st.warning(T["db_build_warning"].format(', '.join(failures)))
+            if st.button(T["build_db_button"], type="primary", use_container_width=True, help=T["build_db_help"], disabled=bool(active_builds)):
+                build_params = {'source_db_path': FACE_DATABASE_ROOT, 'detector_backend': DETECTOR_BACKEND, 'model_name': MODEL_NAME, 'workers': MODEL_WORKERS}
+                st.session_state.build_job_id = submit_job('build', build_params, jobs.PRIORITY_BUILD, label=DETECTOR_BACKEND)
+                if st.session_state.build_job_id:
                     st.rerun()
         with col2:
-            if st.button(T["delete_cropped_button"], use_container_width=True, help=T["delete_cropped_help"]):
+            if st.button(T["delete_cropped_button"], use_container_width=True, help=T["delete_cropped_help"], disabled=bool(active_builds)):
                 if os.path.exists(PROCESSED_DB_PATH):
                     shutil.rmtree(PROCESSED_DB_PATH)
                     st.success(T["delete_cropped_success"])
                     st.rerun()
                 else:
                     st.info(T["delete_cropped_info"])
+        if active_builds:
+            st.caption(T["processing_db_spinner"].format(active_builds[0]['label']))
+            job_progress_ui(active_builds[0]['id'])
+        elif st.session_state.build_job_id:
+            # The build this session started has finished; report it once.
+            build_job = JOBS.get(st.session_state.build_job_id)
+            st.session_state.build_job_id = None
+            if build_job is not None and build_job['status'] == jobs.DONE:
+                build_result = JOBS.result(build_job['id']) or {'count': 0, 'failures': []}
+                st.success(T["db_build_success"].format(build_result['count']))
+                if build_result['failures']: st.warning(T["db_build_warning"].format(', '.join(build_result['failures'])))
+            elif build_job is not None and build_job['status'] == jobs.FAILED:
+                st.error(T["job_failed_error"].format(build_job['error']))
+            elif build_job is not None and build_job['status'] == jobs.CANCELLED:
+                st.info(T["job_cancelled_info"])
 
     with st.expander(T["expander_view_active_db"], expanded=True):
         display_cropped_faces_ui(PROCESSED_DB_PATH)
@@ -390,8 +515,16 @@ with col_center:
 with col_right:
     st.header(T["analysis_results_header"])
 
+    job = JOBS.get(st.session_state.job_id) if st.session_state.job_id else None
+    job_is_active = job is not None and job['status'] in jobs.ACTIVE_STATUSES
+    if job is not None and job['status'] == jobs.DONE and st.session_state.loaded_job != job['id']:
+        load_job_result(job)
+
     media_placeholder = st.empty()
-    if st.session_state.processed_media is not None:
+    if job_is_active:
+        with media_placeholder.container():
+            job_progress_ui(job['id'])
+    elif st.session_state.processed_media is not None:
         media_placeholder.image(st.session_state.processed_media, channels="BGR")
     elif st.session_state.analysis_complete:
         if st.session_state.results:
@@ -407,12 +540,12 @@ with col_right:
     else:
         media_placeholder.info(T["upload_prompt"])
 
-    is_db_ready = os.path.exists(PROCESSED_DB_PATH) and any(f.endswith(('.jpg', '.png', '.jpeg')) for f in os.listdir(PROCESSED_DB_PATH))
+    is_db_ready = len(backend.cached_image_listing(PROCESSED_DB_PATH)) > 0
     analyze_button = st.button(
         T["analyze_button"],
         type="primary",
         use_container_width=True,
-        disabled=(source_file is None or not is_db_ready)
+        disabled=(source_file is None or not is_db_ready or job_is_active)
     )
     if not is_db_ready and source_file:
         st.warning(T["db_not_ready_warning"])
@@ -420,54 +553,78 @@ with col_right:
     log_placeholder = st.empty()
     results_container = st.container()
 
+    if job is not None and job['status'] == jobs.FAILED:
+        log_placeholder.error(T["job_failed_error"].format(job['error']))
+    elif job is not None and job['status'] == jobs.CANCELLED:
+        log_placeholder.info(T["job_cancelled_info"])
+    elif job is not None and job['status'] == jobs.DONE:
+        if st.session_state.job_errors:
+            log_placeholder.error("\n\n".join(st.session_state.job_errors))
+        elif job['kind'] == 'video':
+            log_placeholder.success(T["video_process_complete"])
+        if st.session_state.job_log:
+            with st.expander(T["verbose_logs_expander"], expanded=False):
+                for line in st.session_state.job_log:
+                    st.info(line)
+
     if analyze_button:
         if not backend.check_model_exists(MODEL_NAME):
             log_placeholder.error(T["model_not_downloaded_error"].format(MODEL_NAME))
         else:
-            debug_placeholder = st.expander(T["verbose_logs_expander"], expanded=False)
-            st.session_state.analysis_complete = False
-            st.session_state.results = []
-            st.session_state.processed_media = None
             with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(source_file.name)[1]) as tmp_file:
                 tmp_file.write(source_file.getvalue())
                 tmp_file_path = tmp_file.name
 
             file_ext = os.path.splitext(source_file.name)[1].lower()
-            with st.spinner(T["analyzing_spinner"]):
-                if file_ext in ['.jpg', '.jpeg', '.png']:
-                    processed_img, results, error = backend.process_image(
-                        tmp_file_path, PROCESSED_DB_PATH, MODEL_NAME, DETECTOR_BACKEND, DISTANCE_METRIC, VERIFICATION_THRESHOLD
-                    )
-                    if error:
-                        log_placeholder.error(error)
-                    else:
-                        for res in results:
-                            if res.get('has_strong_match'):
-                                fa = res['facial_area']
-                                cv2.rectangle(processed_img, (fa['x'], fa['y']), (fa['x'] + fa['w'], fa['y'] + fa['h']), (0, 255, 0), 3)
-                                # The text on the image remains English for now as cv2 doesn't handle Persian well
-                                cv2.putText(processed_img, f"MATCH: #{res['person_index']}", (fa['x'], fa['y'] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
-                        st.session_state.processed_media = processed_img
-                        st.session_state.results = results
-                else: # Video
-                    media_placeholder.empty()
-                    progress_bar = st.progress(0, T["progress_bar_init"])
-                    processor = backend.process_video(tmp_file_path, PROCESSED_DB_PATH, MODEL_NAME, DETECTOR_BACKEND, DISTANCE_METRIC, VERIFICATION_THRESHOLD, FRAME_SKIP)
-                    for update_type, data in processor:
-                        if update_type == 'progress': progress_bar.progress(data['value'], text=data['text'])
-                        elif update_type == 'frame_update': media_placeholder.image(data, channels="BGR", caption=T["progress_bar_processing"])
-                        elif update_type == 'result': st.session_state.results.append(data)
-                        elif update_type == 'error': log_placeholder.error(data)
-                        elif update_type == 'debug':
-                            with debug_placeholder:
-                                st.info(data)
-                    progress_bar.empty()
-                    log_placeholder.success(T["video_process_complete"])
-
-            st.session_state.analysis_complete = True
+            job_params = {
+                'db_path': PROCESSED_DB_PATH, 'model_name': MODEL_NAME, 'detector_backend': DETECTOR_BACKEND,
+                'distance_metric': DISTANCE_METRIC, 'verification_threshold': VERIFICATION_THRESHOLD,
+                'max_side': DETECT_MAX_SIDE, 'cache_dir': QUERY_CACHE_PATH, 'stage_timings': SHOW_STAGE_TIMINGS,
+            }
+            if file_ext in ['.jpg', '.jpeg', '.png']:
+                job_id = submit_job('image', job_params, jobs.PRIORITY_IMAGE, tmp_file_path, source_file.name)
+            else: # Video
+                job_params.update(frame_skip=FRAME_SKIP, workers=MODEL_WORKERS, sample_seconds=SAMPLE_SECONDS or None, adaptive_sampling=ADAPTIVE_SAMPLING)
+                job_id = submit_job('video', job_params, jobs.PRIORITY_VIDEO, tmp_file_path, source_file.name)
             os.remove(tmp_file_path)
-            st.rerun()
+
+            if job_id:
+                st.session_state.job_id = job_id
+                st.query_params["job"] = job_id
+                st.session_state.analysis_complete = False
+                st.session_state.results = None
+                st.session_state.processed_media = None
+                st.session_state.stage_timings = None
+                st.rerun()
 
     if st.session_state.results is not None:
         with results_container:
-            display_results_ui(st.session_state.results, VERIFICATION_THRESHOLD)
\ No newline at end of file
+            display_results_ui(st.session_state.results, VERIFICATION_THRESHOLD)
+
+    if st.session_state.stage_timings:
+        with results_container:
+            st.markdown("---")
+            st.subheader(T["stage_timings_header"])
+            st.dataframe([{'stage': stage, **values} for stage, values in st.session_state.stage_timings['stages'].items()], use_container_width=True)
+
+    with st.expander(T["recent_jobs_expander"], expanded=False):
+        recent_jobs = JOBS.list_jobs(limit=10)
+        if recent_jobs:
+            st.dataframe([
+                {'kind': j['kind'], 'label': j['label'], 'status': j['status'], 'progress': f"{j['progress']:.0%}",
+                 'created': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(j['created']))}
+                for j in recent_jobs
+            ], use_container_width=True)
+        else:
+            st.caption(T["no_jobs_caption"])
+
+# --- Background Prewarm ---
+# Runs after the page has rendered, so the first load never waits for the model frameworks.
+# Cached, so it starts once per process and model/detector pair rather than on every rerun;
+# _workers is not part of the cache key: it only matters if this creates the shared pool, which is never resized.
+@st.cache_resource(show_spinner=False)
+def start_prewarm(model_name, detector_backend, _workers):
+    return backend.prewarm(model_name, detector_backend, _workers)
+
+if PREWARM:
+    start_prewarm(MODEL_NAME if model_is_ready else None, DETECTOR_BACKEND, MODEL_WORKERS)
\ No newline at end of file
@@ -1,13 +1,56 @@
 # face_match_backend.py
 
 import os
+import sys
 import cv2
 import glob
+import hashlib
+import importlib
+import json
+import sqlite3
+import time
 import numpy as np
-import pandas as pd
-from deepface import DeepFace
-from sklearn.cluster import DBSCAN
 import multiprocessing
+import atexit
+import queue
+import threading
+from collections import deque
+from contextlib import nullcontext
+
+
+# --- Lazy Imports ---
+
+class _LazyModule:
+    """
+    Stands in for a heavy module and imports it on first attribute access,
+    so importing the backend stays cheap: DeepFace alone pulls in
+    TensorFlow, which takes seconds.
+    """
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            self._target = importlib.import_module(self._module_name)
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+# DeepFace is a submodule of the deepface package ('from deepface import DeepFace' imports it).
+DeepFace = _LazyModule('deepface.DeepFace')
+pd = _LazyModule('pandas')
+sklearn_cluster = _LazyModule('sklearn.cluster')
+sklearn_metrics = _LazyModule('sklearn.metrics')
+
+# None of these may be loaded by 'import face_match_backend'; the bench 'import' stage checks it.
+HEAVY_MODULES = ('deepface', 'tensorflow', 'tf_keras', 'keras', 'torch', 'sklearn', 'pandas')
+
+def loaded_heavy_modules():
+    """The HEAVY_MODULES already imported in this process."""
+    return [name for name in HEAVY_MODULES if name in sys.modules]
 
 
 def get_model_path(model_name):
@@ -49,13 +92,21 @@ def download_model(model_name):
         return False, str(e)
     
     
-def represent_in_process(frame, model_name, detector_backend):
+# Longest side the face detector sees; bigger images and frames are only downscaled for detection (see detect_faces).
+DETECTION_MAX_SIDE = 1280
+
+def represent_in_process(frame, model_name, detector_backend, max_side=DETECTION_MAX_SIDE, roi=None):
     """
     A wrapper to run DeepFace.represent in a separate process
-    to prevent memory leaks.
+    to prevent memory leaks. Frames larger than max_side, or with a region
+    of interest, go through detect_faces instead and come back in the same shape.
     """
     try:
         # This function runs in its own memory space
+        if roi is not None or (max_side and max(frame.shape[:2]) > max_side):
+            faces = detect_and_embed(frame, model_name, detector_backend, False, True, max_side, roi)
+            return [{'embedding': face['embedding'], 'facial_area': face['facial_area'], 'face_confidence': face['confidence']} for face in faces]
+        started = time.time()
         embedding_objs = DeepFace.represent(
             img_path=frame,
             model_name=model_name,
@@ -63,11 +114,529 @@ def represent_in_process(frame, model_name, detector_backend):
             enforce_detection=False,
             align=True
         )
+        record_stage('represent', started, len(embedding_objs))
         return embedding_objs
     except Exception as e:
         # Return the error to the main process if something goes wrong
         return e
     
+def detect_faces_in_process(frame, detector_backend, max_side=DETECTION_MAX_SIDE, roi=None):
+    """
+    Detection-only worker task: returns the detected faces of a frame as dicts
+    with 'facial_area', 'confidence' and the aligned 'face' (BGR, uint8), or the
+    exception if detection failed.
+    """
+    try:
+        return detect_faces(frame, detector_backend, False, True, max_side, roi)
+    except Exception as e:
+        return e
+
+def detect_faces_batch_in_process(frames, detector_backend, max_side=DETECTION_MAX_SIDE, roi=None):
+    """Runs detect_faces_in_process over several frames as one worker task."""
+    return [detect_faces_in_process(frame, detector_backend, max_side, roi) for frame in frames]
+
+def embed_faces_in_process(faces_bgr, model_name):
+    """Embedding-only worker task for a batch of aligned face crops."""
+    try:
+        return embed_aligned_faces(faces_bgr, model_name)
+    except Exception as e:
+        return e
+
+def analyze_image_file_in_process(img_path, model_name, detector_backend, max_side=DETECTION_MAX_SIDE, roi=None):
+    """
+    Image worker task for batch jobs: reads the file on the worker and returns
+    detect_and_embed's faces, or the exception (including "no face detected").
+    """
+    try:
+        img = cv2.imread(img_path)
+        if img is None:
+            raise ValueError("Cannot read image file.")
+        return detect_and_embed(img, model_name, detector_backend, True, True, max_side, roi)
+    except Exception as e:
+        return e
+
+# --- Instrumentation ---
+_task_timings = None
+
+def record_stage(stage, started, count=1):
+    """
+    Worker side: adds a span of `stage` that began at `started` (time.time())
+    to the timings of the task being run, which travel back with its result.
+    Does nothing outside a pooled task.
+    """
+    if _task_timings is not None:
+        _task_timings.append((stage, started, time.time() - started, count))
+
+def _timed_call(fn, args):
+    """Runs fn(*args) collecting record_stage spans; returns (result, start time, spans)."""
+    global _task_timings
+    _task_timings = []
+    started = time.time()
+    try:
+        result = fn(*args)
+    finally:
+        spans, _task_timings = _task_timings, None
+    return result, started, spans
+
+
+class _Span:
+    __slots__ = ('metrics', 'stage', 'count', 'started')
+
+    def __init__(self, metrics, stage, count):
+        self.metrics, self.stage, self.count = metrics, stage, count
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add(self.stage, self.started, time.time() - self.started, self.count)
+
+
+class PipelineMetrics:
+    """
+    Wall time, call and item counts per pipeline stage, plus queue-depth gauges.
+
+    Main-process stages (decode, track, cluster, index_sync, search) are timed
+    with span(); stages that run on model workers (detect - which includes
+    DeepFace's alignment -, embed, represent) come back with each task and are
+    added by record_task(), along with 'ipc': the time from submitting the task
+    until a worker started it. process_video reports snapshot() as
+    ('metrics', dict) events. to_prometheus() renders the totals in the
+    Prometheus text format, and with trace=True every span is also kept for
+    write_trace(), a Chrome/Perfetto trace file.
+    """
+
+    enabled = True
+
+    def __init__(self, trace=False, max_trace_events=200_000):
+        self.stages = {}  # stage -> [seconds, calls, items, max_seconds]
+        self.gauges = {}  # name -> [last, max]
+        self.trace_events = [] if trace else None
+        self.max_trace_events = max_trace_events
+        self._lock = threading.Lock()
+
+    def span(self, stage, count=1):
+        return _Span(self, stage, count)
+
+    def add(self, stage, started, seconds, count=1, pid=None):
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = [0.0, 0, 0, 0.0]
+            entry[0] += seconds
+            entry[1] += 1
+            entry[2] += count
+            entry[3] = max(entry[3], seconds)
+            if self.trace_events is not None and len(self.trace_events) < self.max_trace_events:
+                self.trace_events.append({
+                    'name': stage, 'ph': 'X', 'ts': started * 1e6, 'dur': seconds * 1e6,
+                    'pid': pid or os.getpid(), 'tid': pid or threading.get_ident(), 'args': {'count': count},
+                })
+
+    def gauge(self, name, value):
+        with self._lock:
+            entry = self.gauges.get(name)
+            if entry is None:
+                self.gauges[name] = [value, value]
+            else:
+                entry[0] = value
+                entry[1] = max(entry[1], value)
+
+    def record_task(self, pooled_result):
+        """Adds the worker-side spans of a finished PooledResult, and its dispatch (ipc) time."""
+        if pooled_result.task_started is None:
+            return
+        self.add('ipc', pooled_result.submitted, max(0.0, pooled_result.task_started - pooled_result.submitted))
+        for stage, started, seconds, count in pooled_result.spans:
+            self.add(stage, started, seconds, count, pid=pooled_result.pid)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'stages': {
+                    stage: {'seconds': round(seconds, 6), 'calls': calls, 'items': items, 'max_seconds': round(max_seconds, 6)}
+                    for stage, (seconds, calls, items, max_seconds) in self.stages.items()
+                },
+                'gauges': {name: {'last': last, 'max': peak} for name, (last, peak) in self.gauges.items()},
+            }
+
+    def to_prometheus(self, prefix='face_match', labels=None):
+        """The totals in the Prometheus text exposition format."""
+        extra = "".join(f',{key}="{value}"' for key, value in (labels or {}).items())
+        snapshot = self.snapshot()
+        lines = []
+        for name, kind, help_text, field in (
+            ('stage_seconds_total', 'counter', 'Wall time spent in each pipeline stage.', 'seconds'),
+            ('stage_calls_total', 'counter', 'Times each pipeline stage ran.', 'calls'),
+            ('stage_items_total', 'counter', 'Items (frames, faces, queries) handled by each stage.', 'items'),
+            ('stage_max_seconds', 'gauge', 'Longest single run of each stage.', 'max_seconds'),
+        ):
+            lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} {kind}"]
+            lines += [f'{prefix}_{name}{{stage="{stage}"{extra}}} {values[field]}' for stage, values in snapshot['stages'].items()]
+        for name, field in (('queue_depth', 'last'), ('queue_depth_max', 'max')):
+            lines += [f"# HELP {prefix}_{name} Queue depth ({field}).", f"# TYPE {prefix}_{name} gauge"]
+            lines += [f'{prefix}_{name}{{queue="{queue_name}"{extra}}} {values[field]}' for queue_name, values in snapshot['gauges'].items()]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, **kwargs):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus(**kwargs))
+
+    def write_trace(self, path):
+        """Writes the recorded spans as a Chrome trace (open in chrome://tracing or Perfetto)."""
+        with self._lock:
+            events = list(self.trace_events or [])
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class NullMetrics:
+    """Stand-in used when instrumentation is off: every call is a no-op."""
+
+    enabled = False
+    _span = nullcontext()
+
+    def span(self, stage, count=1):
+        return self._span
+
+    def add(self, *args, **kwargs):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def record_task(self, pooled_result):
+        pass
+
+NO_METRICS = NullMetrics()
+
+
+# --- Shared Model Worker Pool ---
+
+DEFAULT_POOL_WORKERS = 1
+DEFAULT_MAX_TASKS_PER_WORKER = 500
+DEFAULT_MAX_WORKER_MEMORY_MB = 4096
+
+# Set inside pool workers so model calls made there run inline instead of nesting pools.
+_IN_MODEL_WORKER = False
+
+def current_rss_mb():
+    """Resident set size of the current process in MB."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except Exception:
+        return 0.0
+
+def warm_models(model_name, detector_backend):
+    """Loads a model and detector into the current process by running them on a blank image."""
+    try:
+        if model_name:
+            DeepFace.build_model(model_name)
+        DeepFace.extract_faces(
+            img_path=np.zeros((64, 64, 3), dtype=np.uint8),
+            detector_backend=detector_backend,
+            enforce_detection=False
+        )
+    except Exception:
+        pass
+
+def _init_model_worker(warm_specs):
+    global _IN_MODEL_WORKER
+    _IN_MODEL_WORKER = True
+    for model_name, detector_backend in warm_specs:
+        warm_models(model_name, detector_backend)
+
+def _pooled_call(fn, args):
+    """
+    Runs a task in a worker and reports the worker's pid and memory, and the
+    task's start time and record_stage spans, along with the result.
+    """
+    result, started, spans = _timed_call(fn, args)
+    return result, os.getpid(), current_rss_mb(), started, spans
+
+def _ping():
+    return os.getpid()
+
+
+class PooledResult:
+    """Handle for a task submitted to the ModelPool; get() returns the task's own result."""
+
+    def __init__(self, model_pool, async_result):
+        self._model_pool = model_pool
+        self._async_result = async_result
+        self.submitted = time.time()
+        self.pid = self.task_started = None
+        self.spans = ()
+
+    def ready(self):
+        return self._async_result.ready()
+
+    def get(self, timeout=None):
+        result, self.pid, rss_mb, self.task_started, self.spans = self._async_result.get(timeout)
+        self._model_pool._record(self.pid, rss_mb)
+        return result
+
+
+class ModelPool:
+    """
+    Process-wide pool of long-lived model workers shared by image, video and
+    gallery-build calls.
+
+    Workers load the configured model/detector pairs once at start-up. A worker
+    is replaced after max_tasks tasks, and the whole pool is recycled (pending
+    tasks still finish on the old one) once any worker reports more than
+    max_memory_mb of resident memory - which is the leak represent_in_process
+    was originally isolated against.
+    """
+
+    def __init__(self, workers=DEFAULT_POOL_WORKERS, max_tasks=DEFAULT_MAX_TASKS_PER_WORKER, max_memory_mb=DEFAULT_MAX_WORKER_MEMORY_MB):
+        self.workers = max(1, int(workers))
+        self.max_tasks = max_tasks
+        self.max_memory_mb = max_memory_mb
+        # Shared with the Pool as its initargs, so replacement workers also load pairs warmed later.
+        self.warm_specs = []
+        # Per warmed pair: its unfinished warm-up tasks and the pids of the workers known to have it loaded.
+        self._warm_tasks, self._warm_pids = {}, {}
+        self._warm_lock = threading.Lock()
+        self.tasks_completed = 0
+        self.recycles = 0
+        self.worker_rss = {}
+        self._lock = threading.Lock()
+        self._retired = []
+        self._pool = self._start()
+
+    def _start(self):
+        ctx = multiprocessing.get_context('spawn')
+        return ctx.Pool(
+            processes=self.workers,
+            initializer=_init_model_worker,
+            initargs=(self.warm_specs,),
+            maxtasksperchild=self.max_tasks
+        )
+
+    def _record(self, pid, rss_mb):
+        with self._lock:
+            self.tasks_completed += 1
+            self.worker_rss[pid] = rss_mb
+            over_limit = self.max_memory_mb and rss_mb > self.max_memory_mb
+        if over_limit:
+            self.recycle()
+
+    def recycle(self):
+        """Replaces every worker. Tasks already submitted finish on the retired pool."""
+        with self._lock:
+            old_pool, self._pool = self._pool, self._start()
+            self.worker_rss = {}
+            self.recycles += 1
+        with self._warm_lock:
+            # The new workers load every pair at start-up; fresh warm-up tasks confirm it, worker by worker.
+            for spec in self._warm_pids:
+                self._warm_tasks[spec], self._warm_pids[spec] = [], set()
+                self._submit_warm_tasks(spec)
+        old_pool.close()
+        retire = threading.Thread(target=old_pool.join, daemon=True)
+        retire.start()
+        self._retired = [t for t in self._retired if t.is_alive()] + [retire]
+
+    def resize(self, workers):
+        """Changes the number of workers by recycling the pool at the new size."""
+        workers = max(1, int(workers))
+        if workers != self.workers:
+            self.workers = workers
+            self.recycle()
+
+    def concurrency(self, workers=None):
+        """How many workers a call asking for `workers` may keep busy: never more than the pool has."""
+        return self.workers if not workers else max(1, min(int(workers), self.workers))
+
+    def warm(self, model_name, detector_backend):
+        """
+        Makes sure a model/detector pair is loaded. New pairs are added to the
+        start-up list of future workers and loaded on each current worker by
+        warm-up tasks (see warm_state).
+        """
+        spec = (model_name, detector_backend)
+        with self._warm_lock:
+            if spec in self.warm_specs:
+                return
+            self.warm_specs.append(spec)
+            self._warm_tasks[spec], self._warm_pids[spec] = [], set()
+            self._submit_warm_tasks(spec)
+
+    def _submit_warm_tasks(self, spec):
+        """Tops up the pair's warm-up tasks to one per worker not yet known to have it loaded."""
+        missing = self.workers - len(self._warm_pids[spec]) - len(self._warm_tasks[spec])
+        self._warm_tasks[spec].extend(self.submit(warm_models, *spec) for _ in range(max(0, missing)))
+
+    def warm_state(self, model_name, detector_backend):
+        """
+        'loaded' once warm-up tasks have finished on as many distinct workers as
+        the pool has, 'loading' before, None if never warmed. Tasks cannot be pinned to a worker and a warm worker finishes
+        one at once, so several may land on the same process; each check
+        counts the distinct pids and submits more tasks for the rest.
+        """
+        spec = (model_name, detector_backend)
+        with self._warm_lock:
+            tasks = self._warm_tasks.get(spec)
+            if tasks is None:
+                return None
+            for task in [task for task in tasks if task.ready()]:
+                tasks.remove(task)
+                try:
+                    task.get()
+                except Exception:
+                    continue
+                self._warm_pids[spec].add(task.pid)
+            if len(self._warm_pids[spec]) >= self.workers:
+                return 'loaded'
+            self._submit_warm_tasks(spec)
+            return 'loading'
+
+    def submit(self, fn, *args):
+        """Runs fn(*args) on a worker; returns a PooledResult."""
+        return PooledResult(self, self._pool.apply_async(_pooled_call, (fn, args)))
+
+    def run(self, fn, *args):
+        """Runs fn(*args) on a worker and waits for the result."""
+        return self.submit(fn, *args).get()
+
+    def imap_unordered(self, fn, arg_tuples, chunksize=1, max_in_flight=None):
+        """
+        Yields fn(*args) for each args tuple as workers finish them. With
+        max_in_flight below the pool size, at most that many tasks are
+        submitted at a time (and results come back in order).
+        """
+        if max_in_flight is not None and max_in_flight < self.workers:
+            pending = deque()
+            for args in arg_tuples:
+                if len(pending) >= max_in_flight:
+                    yield pending.popleft().get()
+                pending.append(self.submit(fn, *args))
+            while pending:
+                yield pending.popleft().get()
+            return
+        for result, pid, rss_mb, _, _ in self._pool.imap_unordered(_pooled_call_star, [(fn, args) for args in arg_tuples], chunksize):
+            self._record(pid, rss_mb)
+            yield result
+
+    def map(self, fn, arg_tuples, chunksize=1):
+        """Returns [fn(*args) for args in arg_tuples], computed on the workers, in order."""
+        results = []
+        for result, pid, rss_mb, _, _ in self._pool.imap(_pooled_call_star, [(fn, args) for args in arg_tuples], chunksize):
+            self._record(pid, rss_mb)
+            results.append(result)
+        return results
+
+    def health_check(self, timeout=30):
+        """
+        Sends one ping per worker. If any ping is not answered within the
+        timeout, the pool is recycled. Returns a status dict for display.
+        """
+        pings = [self._pool.apply_async(_ping) for _ in range(self.workers)]
+        responding, healthy = set(), True
+        for ping in pings:
+            try:
+                responding.add(ping.get(timeout))
+            except Exception:
+                healthy = False
+        if not healthy:
+            self.recycle()
+        with self._lock:
+            return {
+                'healthy': healthy,
+                'workers': self.workers,
+                'responding_pids': sorted(responding),
+                'tasks_completed': self.tasks_completed,
+                'recycles': self.recycles,
+                'max_worker_rss_mb': max(self.worker_rss.values(), default=0.0),
+                'warm_specs': list(self.warm_specs),
+            }
+
+    def shutdown(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def _pooled_call_star(fn_args):
+    return _pooled_call(*fn_args)
+
+
+_model_pool = None
+_model_pool_lock = threading.Lock()
+
+def get_model_pool(workers=None):
+    """
+    Returns the shared model pool, creating it with `workers` workers on first
+    use. Later calls never resize it - respawning the workers reloads every
+    model - so callers treat their own worker count as a cap on how many of
+    the pool's workers they keep busy (see ModelPool.concurrency).
+    """
+    global _model_pool
+    with _model_pool_lock:
+        if _model_pool is None:
+            _model_pool = ModelPool(workers or DEFAULT_POOL_WORKERS)
+            atexit.register(_model_pool.shutdown)
+        return _model_pool
+
+def warm_model_pool(model_name, detector_backend, workers=None):
+    """Creates the shared pool if needed and preloads a model/detector pair on it."""
+    model_pool = get_model_pool(workers)
+    model_pool.warm(model_name, detector_backend)
+    return model_pool
+
+def model_readiness(model_name, detector_backend):
+    """
+    'missing', 'downloaded', 'loading' or 'loaded' for a model/detector pair,
+    judged from the weights file and the shared pool's warm-up tasks only, so
+    asking never imports DeepFace or TensorFlow into this process.
+    """
+    if not check_model_exists(model_name):
+        return 'missing'
+    model_pool = _model_pool
+    state = model_pool.warm_state(model_name, detector_backend) if model_pool is not None else None
+    return state or 'downloaded'
+
+def prewarm(model_name=None, detector_backend=None, workers=None, modules=('pandas', 'sklearn.cluster')):
+    """
+    Warms things up on a daemon thread and returns it at once; meant to run
+    after the first page render. Imports the deferred modules this process
+    needs for searching and clustering, then, if the model weights are already
+    downloaded, loads the model/detector pair on the shared pool.
+    """
+    def run():
+        for module_name in modules:
+            try:
+                importlib.import_module(module_name)
+            except ImportError:
+                pass
+        if model_name and check_model_exists(model_name):
+            warm_model_pool(model_name, detector_backend, workers)
+
+    thread = threading.Thread(target=run, name="prewarm", daemon=True)
+    thread.start()
+    return thread
+
+def run_model_task(fn, *args, metrics=NO_METRICS):
+    """
+    Runs a model-bound function on the shared pool, or inline when already
+    inside a worker. Its worker-side stage timings are added to `metrics`.
+    """
+    if _IN_MODEL_WORKER:
+        return fn(*args)
+    task = get_model_pool().submit(fn, *args)
+    result = task.get()
+    metrics.record_task(task)
+    return result
+
 # --- Helper Functions (No Streamlit here) ---
 
 def get_threshold(model_name, distance_metric):
@@ -88,256 +657,2664 @@ def convert_distance_to_similarity(distance, threshold):
     if distance > threshold * 2: return 0.0
     return 100 * max(0, 1 - (distance / (threshold * 2)))
 
-def crop_and_prepare_db(source_db_path, detector_backend):
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v', '.mpg', '.mpeg')
+INDEX_DIR_NAME = "_index"
+# Bumped whenever the way gallery embeddings are computed or stored changes.
+INDEX_VERSION = 2
+
+def list_image_files(directory):
+    """Lists the image files directly inside a directory, sorted by name."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        entry.path for entry in os.scandir(directory)
+        if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+def file_content_hash(path):
+    """Returns the SHA-1 hex digest of a file's bytes."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def similarity_from_distances(distances, threshold):
+    """Vectorized convert_distance_to_similarity for an array of distances."""
+    return 100 * np.clip(1 - np.asarray(distances, dtype=np.float64) / (threshold * 2), 0, None)
+
+
+# --- Thumbnails and Cached Listings ---
+THUMBNAIL_DIR_NAME = "_thumbs"
+THUMBNAIL_MAX_SIDE = 192
+
+_listing_cache = {}
+
+def cached_image_listing(directory):
     """
-    Finds faces in all images, crops them, resizes to a width of 400px
-    while maintaining aspect ratio, and saves them to '_cropped_faces'.
+    list_image_files, cached per directory until the directory's mtime changes
+    (which happens whenever a file is added, removed or renamed in it).
     """
-    cropped_db_path = os.path.join(source_db_path, "_cropped_faces")
-    os.makedirs(cropped_db_path, exist_ok=True)
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return []
+    cached = _listing_cache.get(directory)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, list_image_files(directory))
+        _listing_cache[directory] = cached
+    return cached[1]
 
-    for f in glob.glob(os.path.join(cropped_db_path, "*")):
-        os.remove(f)
+def thumbnail_path(image_path):
+    directory, filename = os.path.split(image_path)
+    return os.path.join(directory, THUMBNAIL_DIR_NAME, filename + ".jpg")
 
-    image_files = glob.glob(os.path.join(source_db_path, '*.jpg')) + \
-                  glob.glob(os.path.join(source_db_path, '*.jpeg')) + \
-                  glob.glob(os.path.join(source_db_path, '*.png'))
+def make_thumbnail(image_path, img=None, max_side=THUMBNAIL_MAX_SIDE):
+    """
+    Returns the path of a small JPEG thumbnail of an image, (re)writing it if it
+    is missing or older than the image. `img` may be passed when the image is
+    already decoded. Falls back to the image itself if it cannot be read.
+    """
+    thumb_path = thumbnail_path(image_path)
+    try:
+        if os.path.getmtime(thumb_path) >= os.path.getmtime(image_path):
+            return thumb_path
+    except OSError:
+        pass
+    if img is None:
+        img = cv2.imread(image_path)
+        if img is None:
+            return image_path
+    h, w = img.shape[:2]
+    scale = max_side / max(h, w)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    tmp_path = thumb_path + ".tmp.jpg"
+    if not cv2.imwrite(tmp_path, img, [cv2.IMWRITE_JPEG_QUALITY, 85]):
+        return image_path
+    os.replace(tmp_path, thumb_path)
+    return thumb_path
 
-    faces_count, failed_files = 0, []
+def remove_image(image_path):
+    """Deletes an image together with its thumbnail."""
+    for path in (image_path, thumbnail_path(image_path)):
+        if os.path.exists(path):
+            os.remove(path)
 
-    for img_path in image_files:
-        try:
-            face_objs = DeepFace.extract_faces(
-                img_path=img_path,
-                detector_backend=detector_backend,
-                align=True,
-                enforce_detection=True
-            )
-            for i, face_obj in enumerate(face_objs):
-                face_crop_raw = face_obj['face']
-                face_crop_bgr = cv2.cvtColor((face_crop_raw * 255).astype(np.uint8), cv2.COLOR_RGB2BGR)
-
-                # --- CHANGE HERE: Resize while maintaining aspect ratio ---
-                h, w, _ = face_crop_bgr.shape
-                target_width = 400
-                scale = target_width / w
-                target_height = int(h * scale)
-                resized_face = cv2.resize(face_crop_bgr, (target_width, target_height), interpolation=cv2.INTER_AREA)
-                # --- END CHANGE ---
-
-                original_filename = os.path.splitext(os.path.basename(img_path))[0]
-                new_filename = f"{original_filename}_face_{i+1}.jpg"
-                save_path = os.path.join(cropped_db_path, new_filename)
-                cv2.imwrite(save_path, resized_face)
-                faces_count += 1
-        except Exception:
-            failed_files.append(os.path.basename(img_path))
+def prune_thumbnails(directory):
+    """Deletes thumbnails whose image no longer exists."""
+    thumb_dir = os.path.join(directory, THUMBNAIL_DIR_NAME)
+    if not os.path.isdir(thumb_dir):
+        return
+    for entry in os.scandir(thumb_dir):
+        if entry.is_file() and not os.path.exists(os.path.join(directory, entry.name[:-len(".jpg")])):
+            os.remove(entry.path)
 
-    for pkl_file in glob.glob(os.path.join(cropped_db_path, "*.pkl")):
-        os.remove(pkl_file)
+# --- Vectorized Search Engine ---
 
-    return cropped_db_path, faces_count, failed_files
+DEFAULT_TOP_K = 10
 
+class SearchEngine:
+    """
+    Brute-force matrix search over a gallery of embeddings.
 
-# --- Core Image Processing Backend ---
+    The gallery is one contiguous float32 matrix plus its row norms, so all
+    query faces are scored in a single matrix multiply for cosine, euclidean
+    and euclidean_l2, and the top-k per query is selected with argpartition.
+    The matrix is used as given - a memory-mapped GalleryFile's vectors stay
+    in the shared page cache instead of being copied - and cosine scores are
+    divided by the row norms rather than kept as a normalized copy.
+    """
+
+    def __init__(self, embeddings, norms=None):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if norms is None:
+            norms = np.linalg.norm(self.embeddings, axis=1)
+        self.norms = np.asarray(norms, dtype=np.float32)
+        self.sq_norms = self.norms ** 2
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    @classmethod
+    def from_rows(cls, engine, rows):
+        """A view-like engine over a subset of another engine's rows, without renormalizing."""
+        sub = cls.__new__(cls)
+        sub.embeddings = engine.embeddings[rows]
+        sub.norms = engine.norms[rows]
+        sub.sq_norms = engine.sq_norms[rows]
+        return sub
+
+    def subset(self, rows):
+        """Engine over some of this engine's rows (see from_rows)."""
+        return SearchEngine.from_rows(self, rows)
+
+    def distances(self, queries, distance_metric):
+        """Full (n_queries, n_gallery) distance matrix."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if distance_metric in ('cosine', 'euclidean_l2'):
+            q_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            cosine_sim = ((queries / np.maximum(q_norms, 1e-10)) @ self.embeddings.T) / np.maximum(self.norms, 1e-10)
+            if distance_metric == 'cosine':
+                return 1 - cosine_sim
+            return np.sqrt(np.maximum(2 - 2 * cosine_sim, 0))
+        if distance_metric == 'euclidean':
+            q_sq = np.einsum('ij,ij->i', queries, queries)[:, None]
+            return np.sqrt(np.maximum(q_sq + self.sq_norms[None, :] - 2 * (queries @ self.embeddings.T), 0))
+        raise ValueError(f"Unsupported distance metric: {distance_metric}")
 
-def process_image(img_path, db_path, model_name, detector_backend, distance_metric, verification_threshold):
+    def search(self, queries, distance_metric, top_k=DEFAULT_TOP_K, max_distance=None):
+        """
+        Scores every query against the gallery at once.
+        Returns a list with one (indices, distances) pair per query, sorted by
+        distance, holding at most top_k rows within max_distance.
+        """
+        dist = self.distances(queries, distance_metric)
+        n = dist.shape[1]
+        if n == 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in range(dist.shape[0])]
+        k = n if top_k is None else min(top_k, n)
+        if k < n:
+            candidates = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.broadcast_to(np.arange(n), dist.shape)
+        candidate_dist = np.take_along_axis(dist, candidates, axis=1)
+        order = np.argsort(candidate_dist, axis=1, kind='stable')
+        top_indices = np.take_along_axis(candidates, order, axis=1)
+        top_dist = np.take_along_axis(candidate_dist, order, axis=1)
+
+        results = []
+        for indices, distances in zip(top_indices, top_dist):
+            if max_distance is not None:
+                keep = distances <= max_distance
+                indices, distances = indices[keep], distances[keep]
+            results.append((indices, distances))
+        return results
+
+
+# --- Face Detection ---
+
+DETECTION_UPSCALE_STEP = 2
+NO_FACE_ERROR = "Face could not be detected. Please confirm that the picture is a face photo or consider to set enforce_detection param to False."
+
+def roi_mask(shape, roi):
     """
-    Processes an image to find faces and matches.
-    Returns:
-        - (np.array) The image with RED bounding boxes drawn on it. Green boxes are added by the frontend.
-        - (list) A list of structured dictionaries containing results for each face.
-        - (str or None) An error message if something went wrong.
+    Binary mask (uint8, 255 inside) for a region of interest given either as a
+    mask image (any size; non-zero is inside) or as a list of (x, y, w, h) boxes.
     """
-    try:
-        # Step 1: Extract faces to get their exact coordinates for drawing boxes later.
-        face_objects = DeepFace.extract_faces(
-            img_path=img_path,
-            detector_backend=detector_backend,
-            align=True
-        )
-        if not face_objects:
-            return None, None, "No faces were detected in the uploaded image."
+    if roi is None:
+        return None
+    height, width = shape[:2]
+    if isinstance(roi, np.ndarray) and roi.ndim >= 2 and roi.shape[-1] != 4:
+        mask = roi if roi.ndim == 2 else roi.max(axis=2)
+        if mask.shape != (height, width):
+            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+        return np.where(mask > 0, 255, 0).astype(np.uint8)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for x, y, w, h in roi:
+        mask[max(0, int(y)):max(0, int(y + h)), max(0, int(x)):max(0, int(x + w))] = 255
+    return mask
 
-        # Step 2: Find matches for all detected faces in the image at once.
-        matches_df_list = DeepFace.find(
-            img_path=img_path,
-            db_path=db_path,
-            model_name=model_name,
-            distance_metric=distance_metric,
+def roi_cache_key(roi):
+    """Stable stand-in for a region of interest in cache keys."""
+    if roi is None:
+        return None
+    if isinstance(roi, np.ndarray) and roi.ndim >= 2 and roi.shape[-1] != 4:
+        return hashlib.sha1(np.ascontiguousarray(roi).tobytes() + str(roi.shape).encode()).hexdigest()
+    return [[int(v) for v in box] for box in roi]
+
+def scale_facial_area(facial_area, factor, offset_x=0, offset_y=0):
+    """Maps a DeepFace facial_area (box and landmark points) from a resized, cropped image back to the source."""
+    scaled = {}
+    for key, value in facial_area.items():
+        if key in ('x', 'y', 'w', 'h'):
+            scaled[key] = int(round(value * factor)) + (offset_x if key == 'x' else offset_y if key == 'y' else 0)
+        elif isinstance(value, (tuple, list)) and len(value) == 2:
+            scaled[key] = (int(round(value[0] * factor)) + offset_x, int(round(value[1] * factor)) + offset_y)
+        else:
+            scaled[key] = value
+    return scaled
+
+def align_face_crop(img, facial_area, align=True):
+    """
+    Cuts a face out of `img` and levels its eyes the way DeepFace does (a
+    rotation about the box centre by the angle between the eyes). Only the
+    box-sized window is rendered, so this stays cheap on 4K frames.
+    """
+    x, y, w, h = (int(facial_area[key]) for key in ('x', 'y', 'w', 'h'))
+    left_eye, right_eye = facial_area.get('left_eye'), facial_area.get('right_eye')
+    if not align or left_eye is None or right_eye is None:
+        return img[max(0, y):y + h, max(0, x):x + w].copy()
+    angle = float(np.degrees(np.arctan2(left_eye[1] - right_eye[1], left_eye[0] - right_eye[0])))
+    matrix = cv2.getRotationMatrix2D((x + w / 2, y + h / 2), angle, 1.0)
+    matrix[:, 2] -= (x, y)
+    return cv2.warpAffine(img, matrix, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0))
+
+def detect_faces(img, detector_backend, enforce_detection=True, align=True, max_side=DETECTION_MAX_SIDE, roi=None, multiscale=True):
+    """
+    Resolution-aware detection. The detector runs on a copy of `img` scaled
+    down so its longer side is at most max_side (None or 0 keeps full size);
+    boxes and eye points are mapped back and every face is cut and aligned
+    from the full-resolution image, so the embeddings lose nothing to the
+    downscale. `roi` (see roi_mask) limits detection to a region, and with
+    multiscale a pass that finds nothing is retried at DETECTION_UPSCALE_STEP
+    times the resolution, up to full size, to catch small faces.
+    Returns dicts with 'facial_area' (full-resolution coordinates),
+    'confidence' and 'face' (BGR, uint8). Raises ValueError, as DeepFace
+    does, when enforce_detection is set and there is no face.
+    """
+    if isinstance(img, str):
+        img_path, img = img, cv2.imread(img)
+        if img is None:
+            raise ValueError(f"Cannot read image {img_path}")
+    mask = roi_mask(img.shape, roi)
+    source, offset_x, offset_y = img, 0, 0
+    if mask is not None:
+        offset_x, offset_y, roi_w, roi_h = cv2.boundingRect(mask)
+        source = img[offset_y:offset_y + roi_h, offset_x:offset_x + roi_w].copy()
+        source[mask[offset_y:offset_y + roi_h, offset_x:offset_x + roi_w] == 0] = 0
+    source_h, source_w = source.shape[:2]
+    scale = min(1.0, max_side / max(source_h, source_w)) if max_side and source.size else 1.0
+
+    started = time.time()
+    face_objs = []
+    while source.size:
+        small = source if scale >= 1.0 else cv2.resize(
+            source, (max(1, round(source_w * scale)), max(1, round(source_h * scale))), interpolation=cv2.INTER_AREA)
+        # Faces that get re-cut from the full image below need no alignment from the detector pass.
+        recut = scale < 1.0 or mask is not None
+        face_objs = DeepFace.extract_faces(
+            img_path=small,
             detector_backend=detector_backend,
-            silent=True,
-            align=True
+            enforce_detection=False,
+            align=align and not recut
         )
+        # With enforce_detection=False an empty image comes back as one full-image "face"
+        # with zero confidence; a real face filling a tight crop has a confidence and is kept.
+        small_h, small_w = small.shape[:2]
+        face_objs = [obj for obj in face_objs if obj.get('confidence') or not (obj['facial_area']['w'] >= small_w and obj['facial_area']['h'] >= small_h)]
+        if face_objs or not multiscale or scale >= 1.0:
+            break
+        scale = min(1.0, scale * DETECTION_UPSCALE_STEP)
+    record_stage('detect', started, len(face_objs))
 
-        original_img = cv2.imread(img_path)
-        img_with_boxes = original_img.copy()
-        results_list = []
-
-        # Zip the face objects (with coordinates) and their corresponding match results.
-        for i, (face_obj, df) in enumerate(zip(face_objects, matches_df_list)):
+    faces = []
+    for face_obj in face_objs:
+        if not recut:
             facial_area = face_obj['facial_area']
-            x, y, w, h = facial_area['x'], facial_area['y'], facial_area['w'], facial_area['h']
-            cv2.rectangle(img_with_boxes, (x, y), (x + w, y + h), (0, 0, 255), 2)
-            cv2.putText(img_with_boxes, f"#{i+1}", (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 255), 2)
+            face = cv2.cvtColor((face_obj['face'] * 255).astype(np.uint8), cv2.COLOR_RGB2BGR)
+        else:
+            facial_area = scale_facial_area(face_obj['facial_area'], 1 / scale, offset_x, offset_y)
+            if mask is not None:
+                centre_x = min(max(facial_area['x'] + facial_area['w'] // 2, 0), mask.shape[1] - 1)
+                centre_y = min(max(facial_area['y'] + facial_area['h'] // 2, 0), mask.shape[0] - 1)
+                if not mask[centre_y, centre_x]:
+                    continue
+            face = align_face_crop(img, facial_area, align)
+        faces.append({'facial_area': facial_area, 'confidence': face_obj.get('confidence', 0), 'face': face})
+    if enforce_detection and not faces:
+        raise ValueError(NO_FACE_ERROR)
+    return faces
 
-            ref_face_img = (face_obj['face'] * 255).astype(np.uint8)
-            ref_face_img = cv2.cvtColor(ref_face_img, cv2.COLOR_RGB2BGR)
 
-            has_strong_match = False
-            if not df.empty:
-                df.rename(columns={f'{model_name}_{distance_metric}': 'distance'}, inplace=True, errors='ignore')
-                df['similarity'] = df['distance'].apply(lambda d: convert_distance_to_similarity(d, verification_threshold))
-                if not df.empty and df.iloc[0]['distance'] <= verification_threshold:
-                    has_strong_match = True
+def embed_aligned_face(face_bgr, model_name):
+    """Embeds an already detected and aligned face crop (BGR, uint8) without re-detecting."""
+    embedding_objs = DeepFace.represent(
+        img_path=face_bgr,
+        model_name=model_name,
+        detector_backend='skip',
+        enforce_detection=False,
+        align=False
+    )
+    return embedding_objs[0]['embedding']
 
-            results_list.append({
-                'person_index': i + 1,
-                'matches': df,
-                'ref_crop': ref_face_img,
-                'facial_area': facial_area,
-                'has_strong_match': has_strong_match
-            })
+def embed_aligned_faces(faces_bgr, model_name):
+    """
+    Embeds a batch of aligned face crops in one model forward pass when the
+    installed DeepFace accepts batched input (0.0.94+), else one at a time.
+    """
+    faces_bgr = list(faces_bgr)
+    started = time.time()
+    if len(faces_bgr) > 1:
+        try:
+            embedding_objs = DeepFace.represent(
+                img_path=faces_bgr,
+                model_name=model_name,
+                detector_backend='skip',
+                enforce_detection=False,
+                align=False
+            )
+            if len(embedding_objs) == len(faces_bgr) and all(isinstance(objs, list) for objs in embedding_objs):
+                record_stage('embed', started, len(faces_bgr))
+                return [objs[0]['embedding'] for objs in embedding_objs]
+        except Exception:
+            pass
+    embeddings = [embed_aligned_face(face_bgr, model_name) for face_bgr in faces_bgr]
+    record_stage('embed', started, len(faces_bgr))
+    return embeddings
 
-        return img_with_boxes, results_list, None
+def detect_and_embed(img, model_name, detector_backend, enforce_detection=True, align=True, max_side=DETECTION_MAX_SIDE, roi=None):
+    """
+    Detects and aligns the faces in an image once (see detect_faces), then embeds those aligned crops.
+    Returns one dict per face with 'facial_area', 'confidence', 'face' (BGR uint8)
+    and 'embedding', so every embedding stays paired with the box it came from.
+    """
+    faces = detect_faces(img, detector_backend, enforce_detection, align, max_side, roi)
+    for face, embedding in zip(faces, embed_aligned_faces([face['face'] for face in faces], model_name)):
+        face['embedding'] = embedding
+    return faces
 
-    except Exception as e:
-        error_msg = f"An error occurred during image processing: {str(e)}"
-        if "Face could not be detected" in str(e):
-            error_msg = "No faces were detected in the uploaded image."
-        return None, None, error_msg
 
-# --- Core Video Processing Backend (as a Generator) ---
+# --- Approximate Search (IVF) ---
 
-# In face_match_backend.py
+ANN_MIN_GALLERY_SIZE = 200_000
+ANN_DEFAULT_PROBES = 8
+# Share of exact verified matches the approximate index must keep (on a sample
+# of the gallery, see ann_recall_report) before searches use it by default.
+ANN_RECALL_TARGET = 0.99
+ANN_TUNING_PROBES = (1, 2, 4, 8, 16, 32, 64)
 
-def process_video(video_path, db_path, model_name, detector_backend, distance_metric, verification_threshold, frame_skip):
+class IVFIndex:
     """
-    Processes a video to find unique individuals and their matches using a
-    multiprocessing pool and improved detection logic.
+    Inverted-file approximate index for very large galleries (CPU only, no extra dependencies).
+
+    A k-means coarse quantizer splits the gallery into n_lists cells, once on the
+    raw vectors (for euclidean) and once on the L2-normalized vectors (for cosine
+    and euclidean_l2). A query only scores the rows of its n_probe nearest cells
+    exactly, so n_probe trades speed against recall.
+
+    verified_recall is the recall measured for n_probe when the index was
+    tuned (None until then, or after the gallery outgrew the training).
     """
-    cap = cv2.VideoCapture(video_path)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    if total_frames == 0:
-        yield ('error', "Cannot read video file or video has no frames.")
-        return
 
-    all_detections, frame_count = [], 0
-    ctx = multiprocessing.get_context('spawn')
-    pool = ctx.Pool(processes=1)
+    def __init__(self, n_lists=None, n_probe=ANN_DEFAULT_PROBES):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.trained_size = 0
+        self.verified_recall = None
+        self.centroids_raw = self.centroids_norm = None
+        self.lists_raw = self.lists_norm = None
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
+    @property
+    def is_trained(self):
+        return self.centroids_raw is not None
 
-        frame_count += 1
-        if frame_count % frame_skip != 0:
-            continue
+    @property
+    def enabled(self):
+        """Whether the measured recall meets ANN_RECALL_TARGET, so searches may use it by default."""
+        return self.verified_recall is not None and self.verified_recall >= ANN_RECALL_TARGET
 
-        progress_text = f"Analyzing frame {frame_count}/{total_frames}..."
-        yield ('progress', {'value': frame_count / total_frames, 'text': progress_text})
+    def train(self, embeddings, seed=0):
+        """Trains both coarse quantizers on (a sample of) the gallery and assigns every row."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        n = len(embeddings)
+        n_lists = self.n_lists or max(1, min(int(4 * np.sqrt(n)), n // 39 or 1))
+        rng = np.random.default_rng(seed)
+        sample = embeddings[rng.choice(n, size=min(n, 64 * n_lists), replace=False)]
+        normalized = sample / np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-10)
+        kmeans_args = dict(n_clusters=n_lists, random_state=seed, batch_size=4096, n_init=1)
+        self.centroids_raw = sklearn_cluster.MiniBatchKMeans(**kmeans_args).fit(sample).cluster_centers_.astype(np.float32)
+        centroids_norm = sklearn_cluster.MiniBatchKMeans(**kmeans_args).fit(normalized).cluster_centers_.astype(np.float32)
+        self.centroids_norm = centroids_norm / np.maximum(np.linalg.norm(centroids_norm, axis=1, keepdims=True), 1e-10)
+        self.n_lists = n_lists
+        self.trained_size = n
+        self.set_assignments(*self.assign(embeddings))
 
-        try:
-            yield ('debug', f"Frame {frame_count}: Submitting to processing pool...")
-            async_result = pool.apply_async(represent_in_process, (frame, model_name, detector_backend))
-            embedding_objs = async_result.get()
+    def assign(self, embeddings):
+        """Nearest raw and normalized cell for each embedding."""
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        lists_raw = SearchEngine(self.centroids_raw).distances(embeddings, 'euclidean').argmin(axis=1)
+        lists_norm = (embeddings @ self.centroids_norm.T).argmax(axis=1)
+        return lists_raw.astype(np.int32), lists_norm.astype(np.int32)
 
-            if isinstance(embedding_objs, Exception):
-                raise embedding_objs
+    def with_assignments(self, lists_raw, lists_norm):
+        """A copy sharing the trained quantizers with its own cell assignments; this index is left untouched."""
+        ivf = IVFIndex.__new__(IVFIndex)
+        ivf.__dict__.update(self.__dict__)
+        ivf.set_assignments(lists_raw, lists_norm)
+        return ivf
 
-            yield ('debug', f"Frame {frame_count}: Received {len(embedding_objs)} result(s) from pool.")
+    def set_assignments(self, lists_raw, lists_norm):
+        """Stores per-row cell assignments and builds the inverted lists from them."""
+        self.lists_raw = np.asarray(lists_raw, dtype=np.int32)
+        self.lists_norm = np.asarray(lists_norm, dtype=np.int32)
+        self._inverted = {}
+        for space, lists in (('raw', self.lists_raw), ('norm', self.lists_norm)):
+            order = np.argsort(lists, kind='stable')
+            offsets = np.searchsorted(lists[order], np.arange(self.n_lists + 1))
+            self._inverted[space] = (order, offsets)
 
-            if not embedding_objs:
-                yield ('debug', f"Frame {frame_count}: No faces found by .represent().")
-                yield ('frame_update', frame)
+    def search(self, engine, queries, distance_metric, top_k=DEFAULT_TOP_K, max_distance=None, n_probe=None, **search_args):
+        """
+        Same contract as SearchEngine.search, scoring only the probed cells with
+        `engine` (a SearchEngine or a GalleryFile; search_args go to its search).
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        if distance_metric == 'euclidean':
+            space, cell_dist = 'raw', SearchEngine(self.centroids_raw).distances(queries, 'euclidean')
+        else:
+            space, cell_dist = 'norm', -(queries @ self.centroids_norm.T)
+        order, offsets = self._inverted[space]
+        probes = np.argpartition(cell_dist, n_probe - 1, axis=1)[:, :n_probe]
+
+        results = []
+        for query, cells in zip(queries, probes):
+            candidates = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in cells])
+            if len(candidates) == 0:
+                results.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)))
                 continue
+            sub_engine = engine.subset(candidates)
+            indices, distances = sub_engine.search(query, distance_metric, top_k, max_distance, **search_args)[0]
+            results.append((candidates[indices], distances))
+        return results
 
-            frame_with_boxes = frame.copy()
-            
-            # --- START OF MODIFIED LOGIC ---
-            for obj in embedding_objs:
-                # Log the confidence of EVERY detected face for better debugging.
-                confidence = obj.get('confidence', 0)
-                yield ('debug', f"  - Face detected with confidence: {confidence:.4f}")
-
-                # Remove the strict 0.90 threshold. Let's process all faces
-                # and let the clustering algorithm sort them out.
-                all_detections.append({
-                    'embedding': obj['embedding'],
-                    'facial_area': obj['facial_area'],
-                    'frame': frame.copy()
-                })
+    def save(self, path, names):
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            version=np.array(INDEX_VERSION),
+            n_probe=np.array(self.n_probe),
+            trained_size=np.array(self.trained_size),
+            verified_recall=np.array(np.nan if self.verified_recall is None else self.verified_recall),
+            names=np.array(names, dtype=str),
+            centroids_raw=self.centroids_raw,
+            centroids_norm=self.centroids_norm,
+            lists_raw=self.lists_raw,
+            lists_norm=self.lists_norm,
+        )
+        os.replace(tmp_path, path)
 
-                # Draw a box for visualization regardless of confidence.
-                fa = obj['facial_area']
-                cv2.rectangle(frame_with_boxes, (fa['x'], fa['y']), (fa['x'] + fa['w'], fa['y'] + fa['h']), (0, 0, 255), 2)
-            # --- END OF MODIFIED LOGIC ---
-            
-            yield ('frame_update', frame_with_boxes)
+    @classmethod
+    def load(cls, path):
+        """Returns (ivf, names) or (None, None) if the file is missing or unusable."""
+        if not os.path.exists(path):
+            return None, None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if int(data['version']) != INDEX_VERSION:
+                    return None, None
+                ivf = cls(n_lists=len(data['centroids_raw']), n_probe=int(data['n_probe']))
+                ivf.centroids_raw = data['centroids_raw']
+                ivf.centroids_norm = data['centroids_norm']
+                ivf.trained_size = int(data['trained_size'])
+                # Files written before recall checks load as unverified.
+                if 'verified_recall' in data and not np.isnan(data['verified_recall']):
+                    ivf.verified_recall = float(data['verified_recall'])
+                return ivf, (data['names'].tolist(), data['lists_raw'], data['lists_norm'])
+        except Exception:
+            return None, None
 
-        except Exception as e:
-            yield ('debug', f"Frame {frame_count}: ERROR during face representation - {str(e)}")
-            yield ('frame_update', frame)
-            pass
 
-    pool.close()
-    pool.join()
-    cap.release()
+# --- Quantized Gallery File ---
 
-    yield ('debug', f"Video scan complete. Total face instances found (all confidences): {len(all_detections)}")
+GALLERY_FILE_MAGIC = b'FMGAL\x00\x00\x01'
+GALLERY_FILE_VERSION = 1
+GALLERY_FILE_ALIGN = 64
+GALLERY_VECTOR_DTYPE = 'int8'
+RERANK_FACTOR = 4
 
-    if not all_detections:
-        # This message will now only appear if DeepFace truly finds zero faces in the whole video.
-        yield ('error', "No faces were detected in any frame of the video.")
-        return
+def _align_up(offset):
+    return -(-offset // GALLERY_FILE_ALIGN) * GALLERY_FILE_ALIGN
 
-    yield ('progress', {'value': 1.0, 'text': f"Detected {len(all_detections)} face instances. Clustering..."})
-    all_embeddings = np.array([d['embedding'] for d in all_detections])
+def quantize_embeddings(embeddings, dtype=GALLERY_VECTOR_DTYPE):
+    """
+    Splits embeddings into their L2 norms and quantized unit directions.
+    int8 codes carry a per-vector scale (direction ~= codes * scale);
+    float16 codes have a scale of 1. Returns (codes, scales, norms).
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1).astype(np.float32)
+    directions = embeddings / np.maximum(norms, 1e-10)[:, None]
+    if dtype == 'float16':
+        return directions.astype(np.float16), np.ones(len(embeddings), dtype=np.float32), norms
+    if dtype != 'int8':
+        raise ValueError(f"Unsupported gallery vector dtype: {dtype}")
+    scales = (np.abs(directions).max(axis=1, initial=0) / 127).astype(np.float32)
+    codes = np.rint(directions / np.maximum(scales, 1e-12)[:, None]).clip(-127, 127).astype(np.int8)
+    return codes, scales, norms
 
-    yield ('debug', f"Clustering {len(all_embeddings)} embeddings with eps={verification_threshold}...")
-    clusters = DBSCAN(metric=distance_metric, eps=verification_threshold, min_samples=2, n_jobs=-1).fit_predict(all_embeddings)
-    unique_cluster_ids = set(clusters) - {-1}
-    yield ('debug', f"Clustering complete. Found {len(unique_cluster_ids)} unique clusters (people). Labels: {clusters}")
+def _distances_from_cosine(cosine_sim, distance_metric, query_norms, gallery_norms):
+    if distance_metric == 'cosine':
+        return 1 - cosine_sim
+    if distance_metric == 'euclidean_l2':
+        return np.sqrt(np.maximum(2 - 2 * cosine_sim, 0))
+    if distance_metric == 'euclidean':
+        q, g = query_norms[:, None], gallery_norms[None, :]
+        return np.sqrt(np.maximum(q * q + g * g - 2 * q * g * cosine_sim, 0))
+    raise ValueError(f"Unsupported distance metric: {distance_metric}")
 
-    if not unique_cluster_ids:
-        yield ('error', "Could not identify any unique individuals (clusters). All faces were considered unique. Try increasing the Verification Threshold or reducing Frame Skip.")
-        return
+def write_gallery_file(path, embeddings, names, model_name, dtype=GALLERY_VECTOR_DTYPE, chunk_rows=65536):
+    """
+    Writes a gallery as one flat binary file that GalleryFile memory-maps:
+    an 8-byte magic, a little-endian uint64 header length, a JSON header
+    (model, metrics, dtype, count, dim and section layout), then 64-byte
+    aligned sections: quantized codes, per-vector scales, L2 norms, the float32
+    vectors (for re-ranking) and the identity string table (offsets + UTF-8).
+    """
+    count = len(names)
+    dim = int(np.shape(embeddings)[1]) if count else 0
+    encoded = [name.encode('utf-8') for name in names]
+    name_offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=name_offsets[1:])
+    sections = (
+        ('codes', dtype, (count, dim)),
+        ('scales', 'float32', (count,)),
+        ('norms', 'float32', (count,)),
+        ('vectors', 'float32', (count, dim)),
+        ('name_offsets', 'int64', (count + 1,)),
+        ('name_bytes', 'uint8', (int(name_offsets[-1]),)),
+    )
+    layout, offset = {}, 0
+    for section, section_dtype, shape in sections:
+        section_dtype = np.dtype(section_dtype).newbyteorder('<')
+        layout[section] = {'offset': offset, 'dtype': section_dtype.str, 'shape': list(shape)}
+        offset = _align_up(offset + int(np.prod(shape)) * section_dtype.itemsize)
+    header = json.dumps({
+        'version': GALLERY_FILE_VERSION,
+        'model': model_name,
+        'metrics': ['cosine', 'euclidean', 'euclidean_l2'],
+        'dtype': dtype,
+        'count': count,
+        'dim': dim,
+        'sections': layout,
+    }).encode('utf-8')
+    data_start = _align_up(len(GALLERY_FILE_MAGIC) + 8 + len(header))
 
-    yield ('progress', {'value': 1.0, 'text': f"Found {len(unique_cluster_ids)} unique individual(s). Finding matches..."})
+    def write_section(f, section, array):
+        f.seek(data_start + layout[section]['offset'])
+        np.ascontiguousarray(array, dtype=layout[section]['dtype']).tofile(f)
 
-    for cluster_id in unique_cluster_ids:
-        indices = np.where(clusters == cluster_id)[0]
-        rep_detection = all_detections[indices[0]]
-        fa = rep_detection['facial_area']
-        rep_crop = rep_detection['frame'][fa['y']:fa['y'] + fa['h'], fa['x']:fa['x'] + fa['w']]
+    scales = np.empty(count, dtype=np.float32)
+    norms = np.empty(count, dtype=np.float32)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(GALLERY_FILE_MAGIC)
+        f.write(np.array(len(header), dtype='<u8').tobytes())
+        f.write(header)
+        f.seek(data_start + layout['codes']['offset'])
+        # Quantized in chunks so a large gallery never needs a second full float copy.
+        for start in range(0, count, chunk_rows):
+            end = min(count, start + chunk_rows)
+            codes, scales[start:end], norms[start:end] = quantize_embeddings(embeddings[start:end], dtype)
+            np.ascontiguousarray(codes, dtype=layout['codes']['dtype']).tofile(f)
+        write_section(f, 'scales', scales)
+        write_section(f, 'norms', norms)
+        f.seek(data_start + layout['vectors']['offset'])
+        for start in range(0, count, chunk_rows):
+            np.ascontiguousarray(embeddings[start:start + chunk_rows], dtype='<f4').tofile(f)
+        write_section(f, 'name_offsets', name_offsets)
+        f.seek(data_start + layout['name_bytes']['offset'])
+        f.write(b''.join(encoded))
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
 
-        try:
-            yield ('debug', f"Finding matches for cluster #{cluster_id + 1}...")
-            matches_df_list = DeepFace.find(
-                img_path=rep_crop,
-                db_path=db_path,
-                model_name=model_name,
-                distance_metric=distance_metric,
-                enforce_detection=True,
-                align=True,
-                silent=True
-            )
-            yield ('debug', f"Match search for cluster #{cluster_id + 1} complete.")
-            matches_df = matches_df_list[0] if matches_df_list and not matches_df_list[0].empty else pd.DataFrame()
-
-            has_strong_match = False
-            if not matches_df.empty:
-                matches_df.rename(columns={f'{model_name}_{distance_metric}': 'distance'}, inplace=True, errors='ignore')
-                matches_df['similarity'] = matches_df['distance'].apply(lambda d: convert_distance_to_similarity(d, verification_threshold))
-                if matches_df.iloc[0]['distance'] <= verification_threshold:
-                    has_strong_match = True
-
-            yield ('result', {
-                'person_index': f"{cluster_id + 1}",
-                'matches': matches_df,
-                'ref_crop': rep_crop,
-                'has_strong_match': has_strong_match
-            })
-        except Exception as e:
-            yield ('error', f"CRITICAL ERROR on find() for person #{cluster_id + 1}: {e}")
\ No newline at end of file
+
+class GalleryFile:
+    """
+    Read-only, memory-mapped gallery written by write_gallery_file.
+
+    Opening parses only the header; every section is a view into one shared
+    mapping, so the processes searching a gallery share its pages through the
+    OS page cache instead of each holding a copy. search() scores the
+    quantized codes and re-ranks the best candidates on the float32 vectors.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(GALLERY_FILE_MAGIC)) != GALLERY_FILE_MAGIC:
+                raise ValueError(f"Not a gallery file: {path}")
+            header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_len))
+        if header['version'] != GALLERY_FILE_VERSION:
+            raise ValueError(f"Unsupported gallery file version {header['version']}: {path}")
+        self.model_name = header['model']
+        self.metrics = header['metrics']
+        self.dtype = header['dtype']
+        self.count, self.dim = header['count'], header['dim']
+        data_start = _align_up(len(GALLERY_FILE_MAGIC) + 8 + header_len)
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        for section, spec in header['sections'].items():
+            section_dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+            start = data_start + spec['offset']
+            view = buffer[start:start + int(np.prod(shape)) * section_dtype.itemsize]
+            setattr(self, section, view.view(section_dtype).reshape(shape))
+
+    def __len__(self):
+        return self.count
+
+    def names(self, rows=None):
+        """Identity strings of the given rows (all rows by default)."""
+        rows = range(self.count) if rows is None else rows
+        offsets, data = self.name_offsets, self.name_bytes
+        return [bytes(data[offsets[i]:offsets[i + 1]]).decode('utf-8') for i in rows]
+
+    def subset(self, rows):
+        """In-memory gallery over some of the rows, for IVFIndex cells."""
+        sub = GalleryFile.__new__(GalleryFile)
+        sub.path, sub.model_name, sub.metrics, sub.dtype = self.path, self.model_name, self.metrics, self.dtype
+        sub.count, sub.dim = len(rows), self.dim
+        sub.codes, sub.scales, sub.norms, sub.vectors = self.codes[rows], self.scales[rows], self.norms[rows], self.vectors[rows]
+        return sub
+
+    def search(self, queries, distance_metric, top_k=DEFAULT_TOP_K, max_distance=None, rerank=True, chunk_rows=16384):
+        """
+        Same contract as SearchEngine.search, scored on the quantized codes in
+        chunks of rows. With rerank, the best RERANK_FACTOR * top_k candidates of
+        each query are rescored on the float32 vectors, so the returned
+        distances are exact and only the candidate selection is approximate.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n = self.count
+        if n == 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in range(len(queries))]
+        k = n if top_k is None else min(top_k, n)
+        pool = min(n, k * RERANK_FACTOR) if rerank else k
+        query_norms = np.linalg.norm(queries, axis=1)
+        query_dirs = queries / np.maximum(query_norms, 1e-10)[:, None]
+
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_dist = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, n, chunk_rows):
+            end = min(n, start + chunk_rows)
+            cosine_sim = (query_dirs @ self.codes[start:end].astype(np.float32).T) * self.scales[start:end]
+            dist = _distances_from_cosine(cosine_sim, distance_metric, query_norms, self.norms[start:end])
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, end), dist.shape)], axis=1)
+            dist = np.concatenate([best_dist, dist.astype(np.float32)], axis=1)
+            if dist.shape[1] > pool:
+                keep = np.argpartition(dist, pool - 1, axis=1)[:, :pool]
+                rows, dist = np.take_along_axis(rows, keep, axis=1), np.take_along_axis(dist, keep, axis=1)
+            best_rows, best_dist = rows, dist
+
+        results = []
+        for query, rows, dist in zip(queries, best_rows, best_dist):
+            if rerank:
+                rows = np.sort(rows)
+                dist = SearchEngine(self.vectors[rows]).distances(query, distance_metric)[0]
+            order = np.argsort(dist, kind='stable')[:k]
+            rows, dist = rows[order], dist[order].astype(np.float32)
+            if max_distance is not None:
+                keep = dist <= max_distance
+                rows, dist = rows[keep], dist[keep]
+            results.append((rows, dist))
+        return results
+
+
+# --- Gallery Embedding Index ---
+
+def embed_crop_file(crop_path, model_name):
+    """
+    Embeds a single cropped face image. The crops are already detected and
+    aligned, so they are embedded the same way as query faces, without a
+    second detection pass.
+    """
+    face_bgr = cv2.imread(crop_path)
+    if face_bgr is None:
+        raise ValueError(f"Cannot read cropped face {crop_path}")
+    return embed_aligned_face(face_bgr, model_name)
+
+def _try_embed_crop_file(crop_path, model_name):
+    try:
+        return embed_crop_file(crop_path, model_name)
+    except Exception:
+        return None
+
+def embed_crop_files(crop_paths, model_name):
+    """Embeds many cropped faces on the shared model pool; unreadable crops give None."""
+    tasks = [(crop_path, model_name) for crop_path in crop_paths]
+    if not tasks:
+        return []
+    if _IN_MODEL_WORKER:
+        return [_try_embed_crop_file(*task) for task in tasks]
+    return get_model_pool().map(_try_embed_crop_file, tasks, chunksize=16)
+
+
+class GallerySnapshot:
+    """
+    One consistent, read-only view of a gallery index: the row names and
+    identities, the search engine over their vectors, the gallery file and the
+    approximate index, all for the same rows. GalleryIndex publishes a new
+    snapshot with a single assignment after each change, so a search that
+    reads index.snapshot once never sees the rows of two different syncs.
+    """
+
+    def __init__(self, cropped_db_path, names, embeddings, gallery=None, ann=None):
+        self.names = tuple(names)
+        self.identities = np.array([os.path.join(cropped_db_path, name) for name in self.names], dtype=object)
+        self.embeddings = embeddings.reshape(len(self.names), -1) if len(self.names) else np.empty((0, 0), dtype=np.float32)
+        # Over the gallery file's mapped vectors and stored norms once the index is saved.
+        self.engine = SearchEngine(self.embeddings, gallery.norms if gallery is not None else None)
+        self.gallery = gallery
+        self.ann = ann
+
+    def __len__(self):
+        return len(self.names)
+
+
+class GalleryIndex:
+    """
+    Persistent embedding index for the cropped face gallery.
+
+    There is one index file per model under '_cropped_faces/_index', so the
+    embeddings of several models sit side by side and switching models is a
+    lookup. (Crops are embedded without re-detection, so the detector does not
+    enter the index; a detector change rebuilds the crops, which changes their
+    hashes.) Each row is a cropped face file with its content hash and
+    embedding, so a rebuild that rewrites identical crops reuses the stored
+    embeddings, and adding or deleting a face only adds or removes that face's row.
+
+    The '.npz' file holds the per-row sync metadata; the vectors live in a
+    memory-mapped GalleryFile next to it, searched in place in float32 (or on
+    its quantized codes with quantized=True).
+
+    Only sync() (run under the per-gallery lock by get_gallery_index) changes
+    the rows; searches read the published GallerySnapshot and never write.
+    """
+
+    def __init__(self, cropped_db_path, model_name, detector_backend=None):
+        self.cropped_db_path = cropped_db_path
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self.path = os.path.join(cropped_db_path, INDEX_DIR_NAME, f"{model_name}.npz")
+        self.names, self.hashes, self.mtimes, self.sizes = [], [], [], []
+        self.embeddings = np.empty((0, 0), dtype=np.float32)
+        self.ann_path = os.path.join(os.path.dirname(self.path), f"{model_name}.ivf.npz")
+        self.ann, self._ann_names = None, []
+        self._ann_thread = None
+        self.ann_error = None
+        self.gallery = None
+        self.snapshot = GallerySnapshot(cropped_db_path, [], self.embeddings)
+        # mtime of the crop folder when the index was last synced; see gallery_index_status.
+        self.synced_listing = None
+        self.load()
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    @property
+    def identities(self):
+        """Full paths of the cropped faces, in row order."""
+        return list(self.snapshot.identities)
+
+    def _publish(self):
+        """Swaps in a snapshot of the current rows (with the approximate index only if it covers them)."""
+        ann = self.ann if self.ann is not None and self._ann_names == list(self.names) else None
+        self.snapshot = GallerySnapshot(self.cropped_db_path, self.names, self.embeddings, self.gallery, ann)
+
+    def _legacy_path(self):
+        """An index written when files were per (model, detector) pair, if one exists."""
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(self.path), f"{glob.escape(self.model_name)}_*.npz"))):
+            if not path.endswith('.ivf.npz') and '.tmp' not in path:
+                return path
+        return None
+
+    def load(self):
+        path = self.path if os.path.exists(self.path) else self._legacy_path()
+        if path is None:
+            return
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if int(data['version']) != INDEX_VERSION:
+                    return
+                self.names = data['names'].tolist()
+                self.hashes = data['hashes'].tolist()
+                self.mtimes = data['mtimes'].tolist()
+                self.sizes = data['sizes'].tolist()
+                if 'gallery_file' in data:
+                    self.gallery = GalleryFile(os.path.join(os.path.dirname(path), str(data['gallery_file'])))
+                    if len(self.gallery) != len(self.names):
+                        raise ValueError(f"Gallery file does not match {path}")
+                    self.embeddings = self.gallery.vectors
+                else:
+                    # Written before the vectors moved to a gallery file; the next save converts it.
+                    self.embeddings = data['embeddings'].astype(np.float32)
+        except Exception:
+            # A corrupt or outdated index is simply rebuilt from the crops.
+            self.names, self.hashes, self.mtimes, self.sizes = [], [], [], []
+            self.embeddings = np.empty((0, 0), dtype=np.float32)
+            self.gallery = None
+            return
+        self.ann, ann_rows = IVFIndex.load(self.ann_path)
+        if self.ann is not None:
+            self._align_ann(*ann_rows)
+        self._publish()
+
+    def save(self):
+        """
+        Writes a new gallery file, then the metadata that points at it, so
+        readers never see the two out of step. Each save uses a fresh file name
+        because a file that is still mapped cannot be replaced on every OS.
+        """
+        index_dir = os.path.dirname(self.path)
+        os.makedirs(index_dir, exist_ok=True)
+        gallery_name = f"{self.model_name}-{time.time_ns():x}.gal"
+        vectors = self.embeddings.reshape(len(self.names), -1) if len(self.names) else np.empty((0, 0), dtype=np.float32)
+        write_gallery_file(os.path.join(index_dir, gallery_name), vectors, self.names, self.model_name)
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            version=np.array(INDEX_VERSION),
+            names=np.array(self.names, dtype=str),
+            hashes=np.array(self.hashes, dtype=str),
+            mtimes=np.array(self.mtimes, dtype=np.float64),
+            sizes=np.array(self.sizes, dtype=np.int64),
+            gallery_file=np.array(gallery_name),
+        )
+        os.replace(tmp_path, self.path)
+        self.gallery = GalleryFile(os.path.join(index_dir, gallery_name))
+        self.embeddings = self.gallery.vectors
+        self._remove_old_gallery_files(gallery_name)
+
+    def _remove_old_gallery_files(self, current_name):
+        prefix = f"{self.model_name}-"
+        for path in glob.glob(os.path.join(os.path.dirname(self.path), glob.escape(prefix) + "*.gal")):
+            name = os.path.basename(path)
+            stamp = name[len(prefix):-len(".gal")]
+            if name == current_name or '-' in stamp:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Still mapped by another process (Windows); removed on a later save.
+                pass
+
+    def add(self, name, content_hash, mtime, size, embedding):
+        """Adds or replaces the row for one cropped face."""
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        if name in self.names:
+            self.remove([name])
+        if len(self.names) == 0:
+            self.embeddings = embedding
+        else:
+            self.embeddings = np.vstack([self.embeddings, embedding])
+        self.names.append(name)
+        self.hashes.append(content_hash)
+        self.mtimes.append(mtime)
+        self.sizes.append(size)
+        self.gallery = None
+
+    def remove(self, names):
+        """Removes the rows of the given cropped face filenames."""
+        names = set(names)
+        keep = [i for i, name in enumerate(self.names) if name not in names]
+        if len(keep) == len(self.names):
+            return
+        self.names = [self.names[i] for i in keep]
+        self.hashes = [self.hashes[i] for i in keep]
+        self.mtimes = [self.mtimes[i] for i in keep]
+        self.sizes = [self.sizes[i] for i in keep]
+        self.embeddings = self.embeddings[keep] if keep else np.empty((0, 0), dtype=np.float32)
+        self.gallery = None
+
+    def sync(self):
+        """
+        Brings the index in line with the crops on disk. Only new or changed crops
+        are embedded, and rows of deleted crops are dropped.
+        Returns (added, removed) counts.
+        """
+        try:
+            listing_mtime = os.stat(self.cropped_db_path).st_mtime_ns
+        except OSError:
+            listing_mtime = None
+        on_disk = {}
+        for crop_path in list_image_files(self.cropped_db_path):
+            stat = os.stat(crop_path)
+            on_disk[os.path.basename(crop_path)] = (crop_path, stat.st_mtime, stat.st_size)
+
+        known = {name: i for i, name in enumerate(self.names)}
+        stale = [name for name in self.names if name not in on_disk]
+        embeddings_by_hash = {h: self.embeddings[i] for i, h in enumerate(self.hashes)}
+
+        new_rows, to_embed = [], []
+        for name, (crop_path, mtime, size) in on_disk.items():
+            row = known.get(name)
+            if row is not None and self.mtimes[row] == mtime and self.sizes[row] == size:
+                continue
+            content_hash = file_content_hash(crop_path)
+            if row is not None and self.hashes[row] == content_hash:
+                self.mtimes[row], self.sizes[row] = mtime, size
+                continue
+            if row is not None:
+                stale.append(name)
+            embedding = embeddings_by_hash.get(content_hash)
+            if embedding is None:
+                to_embed.append((name, content_hash, mtime, size, crop_path))
+            else:
+                new_rows.append((name, content_hash, mtime, size, embedding))
+
+        # Crops without a reusable embedding are embedded together on the model pool.
+        embeddings = embed_crop_files([item[-1] for item in to_embed], self.model_name)
+        for (name, content_hash, mtime, size, _), embedding in zip(to_embed, embeddings):
+            if embedding is None:
+                if name not in stale:
+                    stale.append(name)
+                continue
+            new_rows.append((name, content_hash, mtime, size, embedding))
+
+        self.remove(stale)
+        changed = bool(new_rows or stale)
+        if new_rows:
+            names, hashes, mtimes, sizes, embeddings = zip(*new_rows)
+            new_embeddings = np.asarray(embeddings, dtype=np.float32)
+            self.embeddings = new_embeddings if len(self.names) == 0 else np.vstack([self.embeddings, new_embeddings])
+            self.names.extend(names)
+            self.hashes.extend(hashes)
+            self.mtimes.extend(mtimes)
+            self.sizes.extend(sizes)
+            self.gallery = None
+        if changed or self.gallery is None or not os.path.exists(self.path):
+            self.save()
+            self.update_ann()
+            self._publish()
+        self.synced_listing = listing_mtime
+        return len(new_rows), len(stale)
+
+    def _align_ann(self, ann_names, lists_raw, lists_norm):
+        """Re-keys stored cell assignments to the current rows, assigning any row not seen yet."""
+        position = {name: i for i, name in enumerate(ann_names)}
+        rows = np.array([position.get(name, -1) for name in self.names], dtype=np.int64)
+        new_lists_raw = np.zeros(len(rows), dtype=np.int32)
+        new_lists_norm = np.zeros(len(rows), dtype=np.int32)
+        known = rows >= 0
+        new_lists_raw[known] = np.asarray(lists_raw)[rows[known]]
+        new_lists_norm[known] = np.asarray(lists_norm)[rows[known]]
+        if (~known).any():
+            new_lists_raw[~known], new_lists_norm[~known] = self.ann.assign(self.embeddings[~known])
+        # A new object: the published snapshot may still be searching the old one.
+        self.ann = self.ann.with_assignments(new_lists_raw, new_lists_norm)
+        self._ann_names = list(self.names)
+
+    def build_ann(self, n_lists=None, n_probe=None):
+        """
+        Trains the approximate index on the published rows, measures its recall
+        (picking n_probe with tune_ann unless one is given) and installs it.
+        Runs without the gallery lock, so searches and syncs carry on meanwhile;
+        rows synced during training are assigned to cells when it is installed.
+        """
+        snapshot = self.snapshot
+        if len(snapshot) == 0:
+            return None
+        ann = IVFIndex(n_lists, n_probe or ANN_DEFAULT_PROBES)
+        ann.train(snapshot.embeddings)
+        tune_ann(snapshot, ann, self.model_name, n_probes=(n_probe,) if n_probe else ANN_TUNING_PROBES)
+        with _gallery_lock((os.path.abspath(self.cropped_db_path), self.model_name)):
+            if len(self.names) == 0:
+                return None
+            self.ann = ann
+            self._align_ann(snapshot.names, ann.lists_raw, ann.lists_norm)
+            self.ann.save(self.ann_path, self.names)
+            self._publish()
+        return self.ann
+
+    def request_ann_training(self):
+        """Starts build_ann on a background thread unless one is already running."""
+        if self._ann_thread is not None and self._ann_thread.is_alive():
+            return
+
+        def train():
+            try:
+                self.build_ann()
+                self.ann_error = None
+            except Exception as e:
+                self.ann_error = str(e)
+
+        self._ann_thread = threading.Thread(target=train, name=f"ann-training-{self.model_name}", daemon=True)
+        self._ann_thread.start()
+
+    def update_ann(self):
+        """
+        Keeps the approximate index in step with the gallery: new rows are assigned
+        to existing cells. Training never happens here; it is requested in the
+        background once the gallery reaches ANN_MIN_GALLERY_SIZE, and again when
+        it has doubled or halved since training, in which case the old index is
+        kept but no longer counts as verified until the new one is installed.
+        """
+        if len(self.names) == 0:
+            self.ann = None
+            if os.path.exists(self.ann_path):
+                os.remove(self.ann_path)
+            return
+        if self.ann is None:
+            if len(self.names) >= ANN_MIN_GALLERY_SIZE:
+                self.request_ann_training()
+            return
+        self._align_ann(self._ann_names, self.ann.lists_raw, self.ann.lists_norm)
+        if not (self.ann.trained_size / 2 <= len(self.names) <= self.ann.trained_size * 2):
+            self.ann.verified_recall = None
+            self.request_ann_training()
+        self.ann.save(self.ann_path, self.names)
+
+    @property
+    def engine(self):
+        """Search engine over the published rows."""
+        return self.snapshot.engine
+
+    def search(self, query_embeddings, distance_metric, threshold=None, verification_threshold=None, top_k=DEFAULT_TOP_K, approximate=None, n_probe=None, quantized=False, rerank=True):
+        """
+        Searches the gallery for a batch of query embeddings in one pass.
+        Returns one DataFrame per query, sorted by distance, in the shape
+        display_results_ui expects ('identity', 'distance', 'threshold' and,
+        when a verification threshold is given, 'similarity').
+        By default the approximate index is used only when its measured recall
+        meets ANN_RECALL_TARGET (IVFIndex.enabled); approximate=True uses any
+        index there is and approximate=False always searches exactly.
+        With quantized=True the gallery file's int8 codes are scored instead
+        (re-ranked in float32 unless rerank=False); it is opt-in because
+        dequantizing each chunk is still slower than the float32 matrix
+        multiply (see the bench 'search' stage).
+        Reads one published snapshot and changes nothing, so it is safe to run
+        alongside sync() and other searches.
+        """
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        columns = ['identity', 'distance', 'threshold']
+        if verification_threshold is not None:
+            columns.append('similarity')
+        snapshot = self.snapshot
+        if len(snapshot) == 0:
+            return [pd.DataFrame(columns=columns) for _ in range(len(query_embeddings))]
+
+        identities = snapshot.identities
+        results = []
+        if approximate is None:
+            approximate = snapshot.ann is not None and snapshot.ann.enabled
+        quantized = quantized and snapshot.gallery is not None
+        engine, search_args = (snapshot.gallery, {'rerank': rerank}) if quantized else (snapshot.engine, {})
+        if approximate and snapshot.ann is not None:
+            hits = snapshot.ann.search(engine, query_embeddings, distance_metric, top_k, threshold, n_probe, **search_args)
+        else:
+            hits = engine.search(query_embeddings, distance_metric, top_k, threshold, **search_args)
+        for indices, distances in hits:
+            df = pd.DataFrame({
+                'identity': identities[indices],
+                'distance': distances.astype(np.float64),
+                'threshold': threshold,
+            })
+            if verification_threshold is not None:
+                df['similarity'] = similarity_from_distances(distances, verification_threshold)
+            results.append(df)
+        return results
+
+
+_gallery_indexes = {}
+_gallery_locks = {}
+_gallery_locks_guard = threading.Lock()
+
+def _gallery_lock(key):
+    with _gallery_locks_guard:
+        lock = _gallery_locks.get(key)
+        if lock is None:
+            lock = _gallery_locks[key] = threading.Lock()
+        return lock
+
+def get_gallery_index(cropped_db_path, model_name, detector_backend=None):
+    """
+    Returns the synced gallery index for a model, cached per process.
+    A query and a background fill of the same model share one sync.
+    """
+    key = (os.path.abspath(cropped_db_path), model_name)
+    with _gallery_lock(key):
+        index = _gallery_indexes.get(key)
+        if index is None:
+            index = GalleryIndex(cropped_db_path, model_name, detector_backend)
+            _gallery_indexes[key] = index
+        index.sync()
+    return index
+
+def gallery_index_status(cropped_db_path, model_name):
+    """
+    Cheap readiness check for a model's gallery index, without syncing it.
+    Returns {'state', 'rows'}: 'ready' when the index was synced since the crop
+    folder last changed, 'building' while a sync is running, 'stale' when an
+    index exists but needs a sync, and 'missing' when there is none yet.
+    """
+    key = (os.path.abspath(cropped_db_path), model_name)
+    index = _gallery_indexes.get(key)
+    if _gallery_lock(key).locked():
+        return {'state': 'building', 'rows': len(index) if index is not None else 0}
+    if index is not None and index.synced_listing is not None:
+        try:
+            current = os.stat(cropped_db_path).st_mtime_ns
+        except OSError:
+            current = None
+        return {'state': 'ready' if current == index.synced_listing else 'stale', 'rows': len(index)}
+    probe = GalleryIndex.__new__(GalleryIndex)
+    probe.path = os.path.join(cropped_db_path, INDEX_DIR_NAME, f"{model_name}.npz")
+    probe.model_name = model_name
+    exists = os.path.exists(probe.path) or probe._legacy_path() is not None
+    return {'state': 'stale' if exists else 'missing', 'rows': len(index) if index is not None else 0}
+
+
+class GalleryFiller:
+    """
+    Background thread that keeps the gallery index of every requested model in
+    sync, one model at a time on the shared model pool, so switching models
+    finds its embeddings already there. request() (called on every dashboard
+    rerun, and after each database build) wakes it; models whose index is
+    already 'ready' are skipped after one stat of the crop folder.
+    """
+
+    def __init__(self, cropped_db_path):
+        self.cropped_db_path = cropped_db_path
+        self.model_names = []
+        self.active = None
+        self.errors = {}
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="gallery-filler", daemon=True)
+        self._thread.start()
+
+    def request(self, model_names=None):
+        if model_names is not None:
+            self.model_names = list(model_names)
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if not os.path.isdir(self.cropped_db_path):
+                continue
+            for model_name in list(self.model_names):
+                if gallery_index_status(self.cropped_db_path, model_name)['state'] == 'ready':
+                    continue
+                self.active = model_name
+                try:
+                    get_gallery_index(self.cropped_db_path, model_name)
+                    self.errors.pop(model_name, None)
+                except Exception as e:
+                    self.errors[model_name] = str(e)
+                finally:
+                    self.active = None
+
+    def status(self):
+        """{model: {'state', 'rows'[, 'error']}} for every requested model."""
+        statuses = {}
+        for model_name in self.model_names:
+            status = gallery_index_status(self.cropped_db_path, model_name)
+            if model_name in self.errors:
+                status['error'] = self.errors[model_name]
+            statuses[model_name] = status
+        return statuses
+
+_gallery_fillers = {}
+
+def fill_gallery_indexes(cropped_db_path, model_names):
+    """Starts (once per crop folder) the GalleryFiller for these models and wakes it. Returns the filler."""
+    key = os.path.abspath(cropped_db_path)
+    filler = _gallery_fillers.get(key)
+    if filler is None:
+        filler = _gallery_fillers[key] = GalleryFiller(cropped_db_path)
+    filler.request(model_names)
+    return filler
+
+def ann_recall_report(index, distance_metric, threshold=None, n_probes=(1, 2, 4, 8, 16, 32), sample_size=500, top_k=DEFAULT_TOP_K, seed=0):
+    """
+    Compares approximate search against exact search on a sample of gallery rows
+    used as queries (each query's own row is excluded).
+    Returns a DataFrame with one row per n_probe value holding recall@top_k,
+    the share of exact verified matches (distance <= threshold) the approximate
+    search also returns, whether the best verified match is unchanged, and the
+    mean per-query latency of both searches in milliseconds.
+    """
+    snapshot = index.snapshot
+    if len(snapshot) < 2:
+        return pd.DataFrame()
+    ann = snapshot.ann
+    if ann is None:
+        # Trained for the report only; the index keeps whatever it has.
+        ann = IVFIndex()
+        ann.train(snapshot.embeddings)
+    if threshold is None:
+        threshold = get_threshold(index.model_name, distance_metric)
+    return pd.DataFrame(_ann_recall_rows(snapshot, ann, distance_metric, threshold, n_probes, sample_size, top_k, seed))
+
+def _ann_recall_rows(snapshot, ann, distance_metric, threshold, n_probes, sample_size, top_k, seed):
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(snapshot), size=min(sample_size, len(snapshot)), replace=False)
+    queries = snapshot.embeddings[rows]
+
+    def strip_self(hits):
+        cleaned = []
+        for row, (indices, distances) in zip(rows, hits):
+            keep = indices != row
+            cleaned.append((indices[keep][:top_k], distances[keep][:top_k]))
+        return cleaned
+
+    start = time.perf_counter()
+    exact = strip_self(snapshot.engine.search(queries, distance_metric, top_k + 1))
+    exact_ms = 1000 * (time.perf_counter() - start) / len(rows)
+
+    report = []
+    for n_probe in n_probes:
+        start = time.perf_counter()
+        approx = strip_self(ann.search(snapshot.engine, queries, distance_metric, top_k + 1, n_probe=n_probe))
+        approx_ms = 1000 * (time.perf_counter() - start) / len(rows)
+
+        recall_hits, verified_total, verified_hits, same_best = 0, 0, 0, 0
+        for (e_idx, e_dist), (a_idx, a_dist) in zip(exact, approx):
+            recall_hits += len(np.intersect1d(e_idx, a_idx))
+            e_verified = set(e_idx[e_dist <= threshold])
+            a_verified = set(a_idx[a_dist <= threshold])
+            verified_total += len(e_verified)
+            verified_hits += len(e_verified & a_verified)
+            e_best = e_idx[0] if len(e_idx) and e_dist[0] <= threshold else None
+            a_best = a_idx[0] if len(a_idx) and a_dist[0] <= threshold else None
+            same_best += e_best == a_best
+        report.append({
+            'n_probe': min(n_probe, ann.n_lists),
+            'n_lists': ann.n_lists,
+            'recall_at_k': recall_hits / max(1, sum(len(e_idx) for e_idx, _ in exact)),
+            'verified_recall': verified_hits / verified_total if verified_total else 1.0,
+            'same_best_verified_match': same_best / len(rows),
+            'exact_ms_per_query': exact_ms,
+            'approx_ms_per_query': approx_ms,
+        })
+    return report
+
+def tune_ann(snapshot, ann, model_name, distance_metrics=('cosine', 'euclidean'), n_probes=ANN_TUNING_PROBES, sample_size=500):
+    """
+    Sets ann.n_probe to the smallest probe count whose verified recall meets
+    ANN_RECALL_TARGET for every metric (the normalized cells serve cosine and
+    euclidean_l2, the raw cells euclidean), and ann.verified_recall to the recall
+    it reached there. When no probe count is good enough the best one is kept and
+    the index stays disabled.
+    """
+    if len(snapshot) < 2:
+        return ann
+    recall_by_probe = {}
+    for distance_metric in distance_metrics:
+        threshold = get_threshold(model_name, distance_metric)
+        for row in _ann_recall_rows(snapshot, ann, distance_metric, threshold, n_probes, sample_size, DEFAULT_TOP_K, 0):
+            n_probe = row['n_probe']
+            recall_by_probe[n_probe] = min(recall_by_probe.get(n_probe, 1.0), row['verified_recall'])
+    passing = [n_probe for n_probe in sorted(recall_by_probe) if recall_by_probe[n_probe] >= ANN_RECALL_TARGET]
+    ann.n_probe = passing[0] if passing else max(recall_by_probe, key=lambda n_probe: (recall_by_probe[n_probe], -n_probe))
+    ann.verified_recall = recall_by_probe[ann.n_probe]
+    return ann
+
+def find_in_gallery(img_path, db_path, model_name, distance_metric, detector_backend, enforce_detection=True, align=True, verification_threshold=None):
+    """
+    Drop-in replacement for DeepFace.find backed by the persistent gallery index.
+    Returns one DataFrame of matches per face detected in the query image.
+    """
+    index = get_gallery_index(db_path, model_name, detector_backend)
+    faces = run_model_task(detect_and_embed, img_path, model_name, detector_backend, enforce_detection, align)
+    if not faces:
+        return []
+    threshold = get_threshold(model_name, distance_metric)
+    return index.search([face['embedding'] for face in faces], distance_metric, threshold, verification_threshold)
+
+MANIFEST_FILENAME = "_manifest.json"
+
+def load_crop_manifest(cropped_db_path):
+    """
+    Loads the manifest mapping each source image to the crops it produced:
+    {filename: {'hash', 'mtime', 'size', 'detector', 'crops', 'failed'}}.
+    """
+    manifest_path = os.path.join(cropped_db_path, MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                return {}
+    return {}
+
+def save_crop_manifest(cropped_db_path, manifest):
+    manifest_path = os.path.join(cropped_db_path, MANIFEST_FILENAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+def crop_name_prefix(filename):
+    """
+    Prefix of the crops cut from a source image: its stem and extension, so
+    'a.jpg' and 'a.png' give 'a_jpg' and 'a_png' and never share crop names.
+    """
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}_{ext.lstrip('.')}"
+
+def crop_faces_from_image(img_path, detector_backend, cropped_db_path):
+    """
+    Detects and aligns every face in one source image, resizes each crop to a
+    width of 400px and writes it to the cropped database.
+    Crops are named "<stem>_<ext>_face_<n>.jpg" (see crop_name_prefix) and
+    each gets its gallery thumbnail written alongside. Large photos are
+    detected downscaled and cropped at full resolution (see detect_faces).
+    Returns the list of crop filenames written. Raises if no face is found.
+    """
+    faces = detect_faces(img_path, detector_backend, enforce_detection=True, align=True)
+    crop_prefix = crop_name_prefix(os.path.basename(img_path))
+    crop_names = []
+    for i, face in enumerate(faces):
+        face_crop_bgr = face['face']
+
+        # Resize while maintaining aspect ratio.
+        h, w, _ = face_crop_bgr.shape
+        target_width = 400
+        scale = target_width / w
+        target_height = int(h * scale)
+        resized_face = cv2.resize(face_crop_bgr, (target_width, target_height), interpolation=cv2.INTER_AREA)
+
+        new_filename = f"{crop_prefix}_face_{i+1}.jpg"
+        crop_path = os.path.join(cropped_db_path, new_filename)
+        cv2.imwrite(crop_path, resized_face)
+        make_thumbnail(crop_path, resized_face)
+        crop_names.append(new_filename)
+    return crop_names
+
+def plan_crop_update(source_db_path, detector_backend, manifest):
+    """
+    Compares the source images on disk with the manifest.
+    Returns (to_process, removed): the source paths that are new or changed,
+    and the filenames of sources that were deleted. Unchanged entries whose
+    mtime moved but whose content hash did not are refreshed in place.
+    Sources whose crops still use the old "<stem>_face_<n>" names, which
+    collided between e.g. a.jpg and a.png, are cropped again.
+    """
+    to_process = []
+    on_disk = set()
+    for img_path in list_image_files(source_db_path):
+        filename = os.path.basename(img_path)
+        on_disk.add(filename)
+        stat = os.stat(img_path)
+        entry = manifest.get(filename)
+        crop_prefix = crop_name_prefix(filename) + "_face_"
+        if entry is None or entry.get('detector') != detector_backend or not all(crop.startswith(crop_prefix) for crop in entry['crops']):
+            to_process.append(img_path)
+            continue
+        if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            continue
+        if entry['hash'] == file_content_hash(img_path):
+            entry['mtime'], entry['size'] = stat.st_mtime, stat.st_size
+            continue
+        to_process.append(img_path)
+    removed = [filename for filename in manifest if filename not in on_disk]
+    return to_process, removed
+
+def prepare_source_image(img_path, detector_backend, cropped_db_path):
+    """
+    Crops one source image and builds its manifest entry.
+    Returns (filename, entry, error); error is None on success.
+    """
+    filename = os.path.basename(img_path)
+    stat = os.stat(img_path)
+    entry = {
+        'hash': file_content_hash(img_path),
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'detector': detector_backend,
+        'crops': [],
+        'failed': False,
+    }
+    try:
+        entry['crops'] = crop_faces_from_image(img_path, detector_backend, cropped_db_path)
+        return filename, entry, None
+    except Exception as e:
+        entry['failed'] = True
+        return filename, entry, str(e)
+
+def crop_and_prepare_db_stream(source_db_path, detector_backend, model_name=None, workers=None, chunk_size=8):
+    """
+    Generator version of crop_and_prepare_db that reports progress as it goes.
+
+    Source images are cropped on the shared model pool (on at most `workers`
+    of its workers if given), whose workers keep the detector loaded; images are fed in
+    chunks and results stream back as they finish. Yields ('progress', {'value', 'text'}) and ('debug', str)
+    updates, one ('failure', filename) per source without a detectable face, and
+    finally ('result', (cropped_db_path, faces_created, failed_files)).
+    """
+    cropped_db_path = os.path.join(source_db_path, "_cropped_faces")
+    os.makedirs(cropped_db_path, exist_ok=True)
+
+    manifest = load_crop_manifest(cropped_db_path)
+    to_process, removed = plan_crop_update(source_db_path, detector_backend, manifest)
+
+    def drop_crops(filename):
+        for crop_name in manifest.pop(filename, {}).get('crops', []):
+            remove_image(os.path.join(cropped_db_path, crop_name))
+
+    for filename in removed:
+        drop_crops(filename)
+    # Old crops of changed sources go before any worker writes the new ones.
+    for img_path in to_process:
+        drop_crops(os.path.basename(img_path))
+
+    total = len(to_process)
+    yield ('debug', f"{total} new or changed source image(s), {len(removed)} removed.")
+
+    tasks = [(img_path, detector_backend, cropped_db_path) for img_path in to_process]
+    if _IN_MODEL_WORKER:
+        results = (prepare_source_image(*task) for task in tasks)
+    else:
+        model_pool = get_model_pool(workers)
+        model_pool.warm(model_name, detector_backend)
+        results = model_pool.imap_unordered(prepare_source_image, tasks, chunksize=max(1, chunk_size), max_in_flight=model_pool.concurrency(workers))
+
+    faces_count = 0
+    for done, (filename, entry, error) in enumerate(results, start=1):
+        manifest[filename] = entry
+        faces_count += len(entry['crops'])
+        if error is not None:
+            yield ('failure', filename)
+            yield ('debug', f"{filename}: {error}")
+        yield ('progress', {'value': done / total, 'text': f"Cropped {done}/{total} image(s)..."})
+
+    # Crops not produced by any tracked source (e.g. from an older build) are stale.
+    tracked_crops = {crop for entry in manifest.values() for crop in entry['crops']}
+    for crop_path in list_image_files(cropped_db_path):
+        if os.path.basename(crop_path) not in tracked_crops:
+            remove_image(crop_path)
+    prune_thumbnails(cropped_db_path)
+
+    # Remove representation pickles left behind by DeepFace.find.
+    for pkl_file in glob.glob(os.path.join(cropped_db_path, "*.pkl")):
+        os.remove(pkl_file)
+
+    save_crop_manifest(cropped_db_path, manifest)
+
+    if model_name:
+        yield ('progress', {'value': 1.0, 'text': f"Updating {model_name} embedding index..."})
+        get_gallery_index(cropped_db_path, model_name, detector_backend)
+    # The indexes of the other models kept in sync catch up in the background.
+    filler = _gallery_fillers.get(os.path.abspath(cropped_db_path))
+    if filler is not None:
+        filler.request()
+
+    failed_files = sorted(filename for filename, entry in manifest.items() if entry['failed'])
+    yield ('result', (cropped_db_path, faces_count, failed_files))
+
+def crop_and_prepare_db(source_db_path, detector_backend, model_name=None, workers=None):
+    """
+    Finds faces in the source images, crops them, resizes to a width of 400px
+    while maintaining aspect ratio, and saves them to '_cropped_faces'.
+
+    The rebuild is incremental: a manifest of source hash, mtime and detector
+    records which crops each source produced, so only new, changed or deleted
+    sources are touched and stale crops are removed.
+    If a model name is given, the gallery embedding index for it is updated too.
+    Returns (cropped_db_path, faces_created, failed_files).
+    """
+    result = None
+    for update_type, data in crop_and_prepare_db_stream(source_db_path, detector_backend, model_name, workers):
+        if update_type == 'result':
+            result = data
+    return result
+
+
+# --- Query Result Cache ---
+
+DEFAULT_CACHE_MAX_ENTRIES = 200
+DEFAULT_CACHE_MAX_MB = 2048
+
+class MediaCache:
+    """
+    Content-addressed on-disk cache for analyzed query media.
+
+    Entries are keyed on the file's content hash plus every setting that
+    changes detection or embedding (model, detector, sampling, ...), and hold
+    face boxes, embeddings, small crops and any cluster assignments computed
+    so far as arrays in one .npz file. Settings that only affect scoring -
+    the verification threshold and the distance metric - are deliberately
+    not part of the key, so changing them rescores the cached embeddings
+    instead of re-running the models. Least recently used entries are evicted
+    once max_entries or max_mb is exceeded.
+    """
+
+    def __init__(self, cache_dir, max_entries=DEFAULT_CACHE_MAX_ENTRIES, max_mb=DEFAULT_CACHE_MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(file_hash, **settings):
+        payload = json.dumps({'file': file_hash, **settings}, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        """Returns the cached arrays as a dict, or None. A hit marks the entry as recently used."""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+            return arrays
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, arrays):
+        path = self._path(key)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def update(self, key, arrays):
+        """Adds arrays (e.g. cluster labels) to an existing entry."""
+        existing = self.get(key)
+        if existing is not None:
+            existing.update(arrays)
+            self.put(key, existing)
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith('.npz') and '.tmp' not in entry.name:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total > self.max_bytes):
+            _, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith('.npz'):
+                os.remove(entry.path)
+
+
+def faces_to_arrays(faces):
+    """Packs detect_and_embed output into plain arrays for the cache."""
+    arrays = {
+        'embeddings': np.asarray([face['embedding'] for face in faces], dtype=np.float32),
+        'boxes': np.asarray(
+            [(face['facial_area']['x'], face['facial_area']['y'], face['facial_area']['w'], face['facial_area']['h']) for face in faces],
+            dtype=np.int32
+        ).reshape(-1, 4),
+        'confidences': np.asarray([face.get('confidence') or 0 for face in faces], dtype=np.float32),
+    }
+    for i, face in enumerate(faces):
+        arrays[f'crop_{i}'] = face['face']
+    return arrays
+
+def faces_from_arrays(arrays):
+    """Inverse of faces_to_arrays."""
+    faces = []
+    for i, (embedding, box, confidence) in enumerate(zip(arrays['embeddings'], arrays['boxes'], arrays['confidences'])):
+        faces.append({
+            'facial_area': {'x': int(box[0]), 'y': int(box[1]), 'w': int(box[2]), 'h': int(box[3])},
+            'confidence': float(confidence),
+            'face': arrays[f'crop_{i}'],
+            'embedding': embedding.tolist(),
+        })
+    return faces
+
+def image_cache_key(img_path, model_name, detector_backend, max_side=DETECTION_MAX_SIDE, roi=None):
+    return MediaCache.make_key(
+        file_content_hash(img_path), kind='image', model=model_name, detector=detector_backend,
+        max_side=max_side, roi=roi_cache_key(roi),
+    )
+
+def labels_cache_name(clustering, distance_metric, threshold):
+    """Array name under which cluster labels for a scoring setting are cached."""
+    return f"labels_{clustering}_{distance_metric}_{threshold:.6f}".replace('.', 'p')
+
+
+# --- Identity Metadata Store ---
+class MetadataStore:
+    """
+    Person metadata (name, national code) for each source image, kept in SQLite.
+
+    Rows are keyed by source filename, which every cropped face's name
+    encodes ("<stem>_<ext>_face_<n>.jpg"), so a match is resolved to its
+    person with one primary-key lookup; crops named by the older
+    "<stem>_face_<n>.jpg" scheme fall back to the stem index. Each edit is its own
+    transaction, and WAL mode lets concurrent sessions read while another
+    writes. A legacy metadata.json next to the database is imported once.
+    """
+
+    def __init__(self, db_path, legacy_json_path=None):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS identities ("
+                "filename TEXT PRIMARY KEY, stem TEXT NOT NULL, "
+                "name TEXT NOT NULL DEFAULT '', national_code TEXT NOT NULL DEFAULT '', updated REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS identities_stem ON identities (stem)")
+        if legacy_json_path and os.path.exists(legacy_json_path):
+            self._import_json(legacy_json_path)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _import_json(self, json_path):
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO identities (filename, stem, name, national_code, updated) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (filename, os.path.splitext(filename)[0], info.get('name', ''), info.get('national_code', ''), now)
+                    for filename, info in data.items() if isinstance(info, dict)
+                ]
+            )
+        os.replace(json_path, json_path + ".migrated")
+
+    @staticmethod
+    def _row_to_info(row):
+        return {'name': row['name'], 'national_code': row['national_code']} if row is not None else {}
+
+    def get(self, filename):
+        """Returns {'name', 'national_code'} for a source image, or {}."""
+        row = self._connect().execute(
+            "SELECT name, national_code FROM identities WHERE filename = ?", (filename,)
+        ).fetchone()
+        return self._row_to_info(row)
+
+    def set(self, filename, name, national_code):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO identities (filename, stem, name, national_code, updated) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(filename) DO UPDATE SET name = excluded.name, "
+                "national_code = excluded.national_code, updated = excluded.updated",
+                (filename, os.path.splitext(filename)[0], name, national_code, time.time())
+            )
+
+    def delete(self, filename):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM identities WHERE filename = ?", (filename,))
+
+    def lookup_crop(self, crop_path):
+        """Resolves a cropped face path to (source filename, info); (None, {}) if unknown."""
+        prefix = os.path.basename(crop_path).rsplit('_face_', 1)[0]
+        stem, _, ext = prefix.rpartition('_')
+        row = None
+        if stem:
+            row = self._connect().execute(
+                "SELECT filename, name, national_code FROM identities WHERE filename = ?", (f"{stem}.{ext}",)
+            ).fetchone()
+        if row is None:
+            row = self._connect().execute(
+                "SELECT filename, name, national_code FROM identities WHERE stem = ? LIMIT 1", (prefix,)
+            ).fetchone()
+        return (row['filename'] if row is not None else None), self._row_to_info(row)
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM identities").fetchone()[0]
+
+
+# --- Core Image Processing Backend ---
+
+def process_image(img_path, db_path, model_name, detector_backend, distance_metric, verification_threshold, cache=None, metrics=None, max_side=DETECTION_MAX_SIDE, roi=None):
+    """
+    Processes an image to find faces and matches. The detector sees the image
+    downscaled to max_side, restricted to `roi` if given (see detect_faces).
+    With a MediaCache, an image seen before with the same model and detector
+    reuses its cached faces and embeddings and is only re-scored.
+    Stage timings are added to `metrics` (a PipelineMetrics) when given.
+    Returns:
+        - (np.array) The image with RED bounding boxes drawn on it. Green boxes are added by the frontend.
+        - (list) A list of structured dictionaries containing results for each face.
+        - (str or None) An error message if something went wrong.
+    """
+    if metrics is None:
+        metrics = NO_METRICS
+    try:
+        with metrics.span('decode'):
+            original_img = cv2.imread(img_path)
+        if original_img is None:
+            return None, None, "Cannot read the uploaded image."
+
+        # Step 1: Detect and align every face once, and embed those aligned crops.
+        cache_key = cached = None
+        if cache is not None:
+            cache_key = image_cache_key(img_path, model_name, detector_backend, max_side, roi)
+            cached = cache.get(cache_key)
+        if cached is not None:
+            faces = faces_from_arrays(cached)
+        else:
+            faces = run_model_task(detect_and_embed, original_img, model_name, detector_backend, True, True, max_side, roi, metrics=metrics)
+            if cache is not None:
+                cache.put(cache_key, faces_to_arrays(faces))
+        if not faces:
+            return None, None, "No faces were detected in the uploaded image."
+
+        # Step 2: Search the gallery with each face's embedding; each result stays tied to its box.
+        with metrics.span('index_sync'):
+            index = get_gallery_index(db_path, model_name, detector_backend)
+        threshold = get_threshold(model_name, distance_metric)
+
+        with metrics.span('search', len(faces)):
+            matches_df_list = index.search(
+                [face['embedding'] for face in faces], distance_metric, threshold, verification_threshold
+            )
+
+        img_with_boxes = original_img.copy()
+        results_list = []
+
+        for i, (face, df) in enumerate(zip(faces, matches_df_list)):
+            facial_area = face['facial_area']
+            x, y, w, h = facial_area['x'], facial_area['y'], facial_area['w'], facial_area['h']
+            cv2.rectangle(img_with_boxes, (x, y), (x + w, y + h), (0, 0, 255), 2)
+            cv2.putText(img_with_boxes, f"#{i+1}", (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 255), 2)
+
+            ref_face_img = face['face']
+
+            has_strong_match = not df.empty and df.iloc[0]['distance'] <= verification_threshold
+
+            results_list.append({
+                'person_index': i + 1,
+                'matches': df,
+                'ref_crop': ref_face_img,
+                'facial_area': facial_area,
+                'has_strong_match': has_strong_match
+            })
+
+        return img_with_boxes, results_list, None
+
+    except Exception as e:
+        error_msg = f"An error occurred during image processing: {str(e)}"
+        if "Face could not be detected" in str(e):
+            error_msg = "No faces were detected in the uploaded image."
+        return None, None, error_msg
+
+# --- Core Video Processing Backend (as a Generator) ---
+
+# In face_match_backend.py
+
+DEFAULT_CROP_MEMORY_MB = 256
+CROP_MAX_SIDE = 224
+
+BOX_DTYPE = np.dtype([
+    ('frame', np.int32), ('x', np.int32), ('y', np.int32),
+    ('w', np.int32), ('h', np.int32), ('confidence', np.float32),
+    ('weight', np.int32),
+])
+
+class DetectionStore:
+    """
+    Compact storage for every face detected while scanning a video.
+
+    Embeddings live in one preallocated float32 array and boxes in a structured
+    array, both grown by doubling. Only small face crops are kept, not frames,
+    and their total size is capped by a memory budget: once it is exceeded,
+    every other stored crop is dropped and only every `crop_stride`-th detection
+    keeps one from then on. Memory therefore grows with the number of faces,
+    not with frames times faces.
+    """
+
+    def __init__(self, crop_memory_mb=DEFAULT_CROP_MEMORY_MB, initial_capacity=256):
+        self.count = 0
+        self.embeddings = None
+        self.boxes = np.zeros(initial_capacity, dtype=BOX_DTYPE)
+        self.crops = {}
+        self.crop_bytes = 0
+        self.crop_budget = int(crop_memory_mb * 1024 * 1024)
+        self.crop_stride = 1
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self, dim):
+        capacity = len(self.boxes)
+        if self.embeddings is None:
+            self.embeddings = np.empty((capacity, dim), dtype=np.float32)
+        if self.count < capacity:
+            return
+        self.boxes = np.resize(self.boxes, capacity * 2)
+        grown = np.empty((capacity * 2, self.embeddings.shape[1]), dtype=np.float32)
+        grown[:self.count] = self.embeddings[:self.count]
+        self.embeddings = grown
+
+    def add(self, frame_number, frame, embedding, facial_area, confidence=0.0, weight=1):
+        """Stores one detection and, budget permitting, a downscaled crop of the face."""
+        crop = None
+        if self.count % self.crop_stride == 0:
+            crop = small_face_crop(frame, facial_area)
+        return self.add_crop(frame_number, crop, embedding, facial_area, confidence, weight)
+
+    def add_crop(self, frame_number, crop, embedding, facial_area, confidence=0.0, weight=1):
+        """
+        Stores one entry with an already cut crop (or None). `weight` is the number
+        of detections the entry stands for, e.g. the length of a face track.
+        """
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._grow(len(embedding))
+        index = self.count
+        x, y, w, h = (int(facial_area[k]) for k in ('x', 'y', 'w', 'h'))
+        self.embeddings[index] = embedding
+        self.boxes[index] = (frame_number, x, y, w, h, confidence, weight)
+        self.count += 1
+
+        if crop is not None and crop.size and index % self.crop_stride == 0:
+            self.crops[index] = crop
+            self.crop_bytes += crop.nbytes
+            while self.crop_bytes > self.crop_budget and self.crop_stride < 2 ** 30:
+                self._thin_crops()
+        return index
+
+    def _thin_crops(self):
+        self.crop_stride *= 2
+        for index in [i for i in self.crops if i % self.crop_stride != 0]:
+            self.crop_bytes -= self.crops.pop(index).nbytes
+
+    def to_arrays(self):
+        """Packs the store into plain arrays for the result cache."""
+        arrays = {
+            'embeddings': self.embedding_matrix(),
+            'boxes': self.boxes[:self.count],
+            'crop_stride': np.array(self.crop_stride),
+        }
+        for index, crop in self.crops.items():
+            arrays[f'crop_{index}'] = crop
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, crop_memory_mb=DEFAULT_CROP_MEMORY_MB):
+        """Rebuilds a store packed with to_arrays."""
+        store = cls(crop_memory_mb, initial_capacity=max(1, len(arrays['boxes'])))
+        store.count = len(arrays['boxes'])
+        store.boxes[:store.count] = arrays['boxes']
+        store.embeddings = np.array(arrays['embeddings'], dtype=np.float32) if store.count else None
+        store.crop_stride = int(arrays['crop_stride'])
+        for name, crop in arrays.items():
+            if name.startswith('crop_') and name != 'crop_stride':
+                store.crops[int(name[5:])] = crop
+                store.crop_bytes += crop.nbytes
+        return store
+
+    def embedding_matrix(self):
+        """The stored embeddings as an (n, dim) view, without copying."""
+        if self.embeddings is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self.embeddings[:self.count]
+
+    def facial_area(self, index):
+        box = self.boxes[index]
+        return {'x': int(box['x']), 'y': int(box['y']), 'w': int(box['w']), 'h': int(box['h'])}
+
+    def representative(self, indices):
+        """First detection among the indices that still has a stored crop, else the first one."""
+        for index in indices:
+            if index in self.crops:
+                return int(index), self.crops[index]
+        return int(indices[0]), None
+
+# --- Streaming Identity Clustering ---
+
+class OnlineClusterer:
+    """
+    Incremental clustering that assigns each face embedding to an identity as
+    soon as it arrives, instead of running DBSCAN once the whole video is read.
+
+    An embedding joins the nearest identity when its distance is within the
+    verification threshold, otherwise it starts a new identity. In 'centroid'
+    mode the distance is to the identity's running mean; in 'prototype' mode it
+    is the minimum over up to `max_prototypes` stored members, which follows
+    identities whose appearance drifts. Identities whose centroids come within
+    the threshold are merged, and finalize() splits identities that have grown
+    too wide. As with DBSCAN(min_samples=2), identities seen fewer than
+    min_samples times are labelled -1.
+    """
+
+    def __init__(self, distance_metric, threshold, mode='centroid', min_samples=2, max_prototypes=8):
+        if mode not in ('centroid', 'prototype'):
+            raise ValueError(f"Unknown clustering mode: {mode}")
+        self.distance_metric = distance_metric
+        self.threshold = threshold
+        self.mode = mode
+        self.min_samples = min_samples
+        self.max_prototypes = max_prototypes
+        self.sums, self.counts, self.prototypes = [], [], []
+        self.parent = []
+        self.assignments, self.weights = [], []
+
+    def _prepare(self, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self.distance_metric in ('cosine', 'euclidean_l2'):
+            embedding = embedding / max(np.linalg.norm(embedding), 1e-10)
+        return embedding
+
+    def _root(self, identity):
+        while self.parent[identity] != identity:
+            self.parent[identity] = self.parent[self.parent[identity]]
+            identity = self.parent[identity]
+        return identity
+
+    def _active(self):
+        return [i for i in range(len(self.parent)) if self.parent[i] == i]
+
+    def centroid(self, identity):
+        return self.sums[identity] / self.counts[identity]
+
+    def _distances(self, embedding, identities):
+        if self.mode == 'centroid':
+            vectors = np.stack([self.centroid(i) for i in identities])
+            return SearchEngine(vectors).distances(embedding, self.distance_metric)[0]
+        return np.array([
+            SearchEngine(np.stack(self.prototypes[i])).distances(embedding, self.distance_metric)[0].min()
+            for i in identities
+        ])
+
+    def add(self, embedding, weight=1):
+        """
+        Assigns one embedding; returns (identity, is_new_identity). `weight` is the
+        number of detections it stands for, e.g. the length of a face track.
+        """
+        embedding = self._prepare(embedding)
+        self.weights.append(weight)
+        active = self._active()
+        if active:
+            distances = self._distances(embedding, active)
+            best = int(np.argmin(distances))
+            if distances[best] <= self.threshold:
+                identity = active[best]
+                self.sums[identity] += embedding * weight
+                self.counts[identity] += weight
+                if len(self.prototypes[identity]) < self.max_prototypes:
+                    self.prototypes[identity].append(embedding)
+                self.assignments.append(identity)
+                self._merge_into_neighbours(identity)
+                return self._root(identity), False
+        identity = len(self.parent)
+        self.parent.append(identity)
+        self.sums.append(embedding.astype(np.float64) * weight)
+        self.counts.append(weight)
+        self.prototypes.append([embedding])
+        self.assignments.append(identity)
+        return identity, True
+
+    def _merge(self, keep, drop):
+        self.parent[drop] = keep
+        self.sums[keep] = self.sums[keep] + self.sums[drop]
+        self.counts[keep] += self.counts[drop]
+        room = self.max_prototypes - len(self.prototypes[keep])
+        self.prototypes[keep].extend(self.prototypes[drop][:max(room, 0)])
+
+    def _merge_into_neighbours(self, identity):
+        """Merges any identity whose centroid moved within the threshold of this one."""
+        others = [i for i in self._active() if i != identity]
+        if not others:
+            return
+        vectors = np.stack([self.centroid(i) for i in others])
+        distances = SearchEngine(vectors).distances(self.centroid(identity), self.distance_metric)[0]
+        for other, distance in zip(others, distances):
+            if distance <= self.threshold:
+                self._merge(identity, other)
+
+    def finalize(self, embeddings, split_fraction=0.2):
+        """
+        Splits identities where more than split_fraction of the members lie
+        beyond the threshold from the centroid, when 2-means separates them into
+        halves whose centroids are themselves further apart than the threshold.
+        `embeddings` are the same vectors passed to add(), in order.
+        Returns the final labels.
+        """
+        labels = self.labels(drop_small=False)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        next_label = labels.max() + 1 if len(labels) else 0
+        for label in np.unique(labels):
+            members = np.where(labels == label)[0]
+            if len(members) < 2 * self.min_samples:
+                continue
+            vectors = np.stack([self._prepare(e) for e in embeddings[members]])
+            spread = SearchEngine(vectors).distances(vectors.mean(axis=0), self.distance_metric)[0]
+            if np.mean(spread > self.threshold) <= split_fraction:
+                continue
+            halves = sklearn_cluster.KMeans(n_clusters=2, n_init=3, random_state=0).fit_predict(vectors)
+            if min(np.bincount(halves, minlength=2)) < self.min_samples:
+                continue
+            centroids = np.stack([vectors[halves == h].mean(axis=0) for h in (0, 1)])
+            if SearchEngine(centroids[:1]).distances(centroids[1], self.distance_metric)[0, 0] > self.threshold:
+                labels[members[halves == 1]] = next_label
+                next_label += 1
+        return self._drop_small(labels)
+
+    def _drop_small(self, labels):
+        labels = labels.copy()
+        weights = np.asarray(self.weights)
+        for identity in np.unique(labels):
+            if weights[labels == identity].sum() < self.min_samples:
+                labels[labels == identity] = -1
+        # Renumber to 0..k-1 in order of first appearance, like DBSCAN output.
+        remap, next_id = {}, 0
+        for i, label in enumerate(labels):
+            if label == -1:
+                continue
+            if label not in remap:
+                remap[label], next_id = next_id, next_id + 1
+            labels[i] = remap[label]
+        return labels
+
+    def labels(self, drop_small=True):
+        """Current label for every embedding added so far."""
+        labels = np.array([self._root(i) for i in self.assignments], dtype=np.int64)
+        return self._drop_small(labels) if drop_small else labels
+
+    @property
+    def identity_count(self):
+        return sum(1 for i in self._active() if self.counts[i] >= self.min_samples)
+
+
+def cluster_embeddings_dbscan(embeddings, distance_metric, threshold, sample_weight=None):
+    """
+    The original end-of-video DBSCAN clustering, kept as an option and as a reference.
+    sample_weight counts how many detections each embedding stands for.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if distance_metric == 'euclidean_l2':
+        # scikit-learn has no euclidean_l2; it is euclidean distance on L2-normalized vectors.
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-10)
+        distance_metric = 'euclidean'
+    return sklearn_cluster.DBSCAN(metric=distance_metric, eps=threshold, min_samples=2, n_jobs=-1).fit_predict(embeddings, sample_weight=sample_weight)
+
+def compare_with_dbscan(embeddings, distance_metric, threshold, mode='centroid'):
+    """
+    Offline check of the online clusterer against DBSCAN on the same embeddings.
+    Returns a dict with adjusted Rand index, normalized mutual information,
+    cluster and noise counts for both methods, and their run times in seconds.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    start = time.perf_counter()
+    reference = cluster_embeddings_dbscan(embeddings, distance_metric, threshold)
+    dbscan_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    clusterer = OnlineClusterer(distance_metric, threshold, mode)
+    for embedding in embeddings:
+        clusterer.add(embedding)
+    online = clusterer.finalize(embeddings)
+    online_s = time.perf_counter() - start
+
+    return {
+        'adjusted_rand_index': sklearn_metrics.adjusted_rand_score(reference, online),
+        'normalized_mutual_info': sklearn_metrics.normalized_mutual_info_score(reference, online),
+        'dbscan_clusters': len(set(reference) - {-1}),
+        'online_clusters': len(set(online) - {-1}),
+        'dbscan_noise': int(np.sum(reference == -1)),
+        'online_noise': int(np.sum(online == -1)),
+        'dbscan_seconds': dbscan_s,
+        'online_seconds': online_s,
+    }
+
+# --- Cross-Frame Face Tracking ---
+
+def box_iou(a, b):
+    """Intersection over union of two facial_area dicts."""
+    x1, y1 = max(a['x'], b['x']), max(a['y'], b['y'])
+    x2 = min(a['x'] + a['w'], b['x'] + b['w'])
+    y2 = min(a['y'] + a['h'], b['y'] + b['h'])
+    inter = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a['w'] * a['h'] + b['w'] * b['h'] - inter
+    return inter / union if union > 0 else 0.0
+
+class FaceTrack:
+    """One face followed across frames, with the running sum of its embeddings."""
+
+    def __init__(self, track_id, frame_number, facial_area):
+        self.track_id = track_id
+        self.facial_area = facial_area
+        self.first_frame = self.last_frame = frame_number
+        self.hits = 0
+        self.embedding_sum = None
+        self.embedding_count = 0
+        self.last_embed_frame = None
+        self.best_quality = -1.0
+        self.best = None  # (frame_number, facial_area, confidence, crop)
+
+    def add_embedding(self, embedding, frame_number):
+        embedding = np.asarray(embedding, dtype=np.float64)
+        self.embedding_sum = embedding if self.embedding_sum is None else self.embedding_sum + embedding
+        self.embedding_count += 1
+        self.last_embed_frame = frame_number
+
+    def embedding(self):
+        """The aggregated (mean) embedding of the track."""
+        return (self.embedding_sum / self.embedding_count).astype(np.float32)
+
+class FaceTracker:
+    """
+    Lightweight IoU tracker that links face boxes across sampled frames, so the
+    embedding model only runs when a track is new, when a clearly better view
+    of the face appears (confidence times box area grows by quality_gain), or
+    every reembed_interval frames. Finished tracks hand one aggregated
+    embedding to the clustering step.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_gap=30, reembed_interval=150, quality_gain=1.25):
+        self.iou_threshold = iou_threshold
+        self.max_gap = max_gap
+        self.reembed_interval = reembed_interval
+        self.quality_gain = quality_gain
+        self.tracks = []
+        self.next_id = 0
+        self.embeddings_computed = 0
+        self.embeddings_skipped = 0
+
+    def update(self, frame_number, frame, faces):
+        """
+        Links this frame's faces to tracks (greedily by IoU) and returns a list of
+        (face, track, needs_embedding) in the order of `faces`.
+        """
+        pairs = sorted(
+            ((box_iou(face['facial_area'], track.facial_area), fi, ti)
+             for fi, face in enumerate(faces) for ti, track in enumerate(self.tracks)),
+            reverse=True
+        )
+        matched_faces, matched_tracks, assignment = set(), set(), {}
+        for iou, fi, ti in pairs:
+            if iou < self.iou_threshold:
+                break
+            if fi in matched_faces or ti in matched_tracks:
+                continue
+            matched_faces.add(fi)
+            matched_tracks.add(ti)
+            assignment[fi] = self.tracks[ti]
+
+        updates = []
+        for fi, face in enumerate(faces):
+            track = assignment.get(fi)
+            if track is None:
+                track = FaceTrack(self.next_id, frame_number, face['facial_area'])
+                self.next_id += 1
+                self.tracks.append(track)
+            track.facial_area = face['facial_area']
+            track.last_frame = frame_number
+            track.hits += 1
+
+            fa = face['facial_area']
+            quality = max(face.get('confidence') or 0, 1e-3) * fa['w'] * fa['h']
+            improved = quality > track.best_quality * self.quality_gain
+            if quality > track.best_quality:
+                track.best_quality = quality
+                track.best = (frame_number, fa, face.get('confidence') or 0, small_face_crop(frame, fa))
+            needs_embedding = (
+                track.last_embed_frame is None
+                or improved
+                or frame_number - track.last_embed_frame >= self.reembed_interval
+            )
+            if needs_embedding:
+                self.embeddings_computed += 1
+            else:
+                self.embeddings_skipped += 1
+            updates.append((face, track, needs_embedding))
+        return updates
+
+    def expire(self, frame_number):
+        """Removes and returns the tracks not seen for more than max_gap frames."""
+        finished = [t for t in self.tracks if frame_number - t.last_frame > self.max_gap]
+        self.tracks = [t for t in self.tracks if frame_number - t.last_frame <= self.max_gap]
+        return [t for t in finished if t.embedding_count]
+
+    def finish_all(self):
+        """Removes and returns every remaining track."""
+        finished, self.tracks = self.tracks, []
+        return [t for t in finished if t.embedding_count]
+
+def small_face_crop(frame, facial_area):
+    """Cuts a face out of a frame, downscaled so its longer side is at most CROP_MAX_SIDE."""
+    x, y, w, h = (int(facial_area[k]) for k in ('x', 'y', 'w', 'h'))
+    crop = frame[max(y, 0):y + h, max(x, 0):x + w]
+    if not crop.size:
+        return None
+    scale = CROP_MAX_SIDE / max(crop.shape[:2])
+    if scale < 1:
+        return cv2.resize(crop, (max(1, int(crop.shape[1] * scale)), max(1, int(crop.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+    return crop.copy()
+
+def cluster_detections(detections, distance_metric, threshold, clustering='online'):
+    """
+    Clusters stored detections after the fact, e.g. when they come from the
+    result cache. Online clustering replays the embeddings in their original
+    order, so it gives the same labels as clustering during the scan.
+    """
+    embeddings = detections.embedding_matrix()
+    weights = detections.boxes['weight'][:len(detections)]
+    if clustering == 'online':
+        clusterer = OnlineClusterer(distance_metric, threshold)
+        for embedding, weight in zip(embeddings, weights):
+            clusterer.add(embedding, int(weight))
+        return clusterer.finalize(embeddings)
+    return cluster_embeddings_dbscan(embeddings, distance_metric, threshold, weights)
+
+def cluster_query_embeddings(detections, labels, cluster_ids, distance_metric, match_with='centroid', best_k=5):
+    """
+    Builds one gallery query per cluster from the embeddings it already has.
+    'centroid' averages every member, weighted by how many detections each
+    stands for; 'best' averages the best_k members with the highest
+    confidence times box area. For cosine and euclidean_l2 the members are
+    L2-normalized before averaging.
+    """
+    embeddings = detections.embedding_matrix()
+    boxes = detections.boxes[:len(detections)]
+    queries = []
+    for cluster_id in cluster_ids:
+        members = np.where(labels == cluster_id)[0]
+        weights = boxes['weight'][members].astype(np.float64)
+        if match_with == 'best':
+            quality = np.maximum(boxes['confidence'][members], 1e-3) * boxes['w'][members] * boxes['h'][members]
+            keep = np.argsort(-quality, kind='stable')[:best_k]
+            members, weights = members[keep], weights[keep]
+        vectors = embeddings[members].astype(np.float64)
+        if distance_metric in ('cosine', 'euclidean_l2'):
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-10)
+        queries.append(np.average(vectors, axis=0, weights=np.maximum(weights, 1)))
+    return np.asarray(queries, dtype=np.float32)
+
+def read_face_crop(video_path, frame_number, facial_area):
+    """Re-reads one frame (1-based number) from the video and crops a face from it."""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number - 1)
+        ret, frame = cap.read()
+    finally:
+        cap.release()
+    if not ret:
+        return None
+    fa = facial_area
+    return frame[max(fa['y'], 0):fa['y'] + fa['h'], max(fa['x'], 0):fa['x'] + fa['w']].copy()
+
+class FrameSampler:
+    """
+    Decides which video frames get analyzed and moves past the others cheaply.
+
+    The base step comes from a frame count (frame_skip) or, if sample_seconds is
+    given, from the video's frame rate. Skipped frames are passed with grab(),
+    which skips the retrieve/colour-convert work, or by seeking when the gap is
+    at least seek_threshold frames. In adaptive mode, a scene cut (a large change
+    in a tiny grayscale thumbnail) or a call to boost() - e.g. when a new face
+    appears - switches to a denser step for a short window.
+    """
+
+    def __init__(self, fps, frame_skip=1, sample_seconds=None, adaptive=False,
+                 seek_threshold=90, cut_threshold=30.0, dense_factor=4, dense_window_steps=3):
+        if sample_seconds:
+            self.base_step = max(1, int(round((fps or 25) * sample_seconds)))
+        else:
+            self.base_step = max(1, int(frame_skip))
+        self.adaptive = adaptive
+        self.seek_threshold = seek_threshold
+        self.cut_threshold = cut_threshold
+        self.dense_step = max(1, self.base_step // dense_factor)
+        self.dense_window = self.base_step * dense_window_steps
+        self.dense_until = 0
+        self.scene_cuts = 0
+        self._last_thumb = None
+
+    def next_step(self, frame_number):
+        if self.adaptive and frame_number < self.dense_until:
+            return self.dense_step
+        return self.base_step
+
+    def boost(self, frame_number):
+        """Samples densely for a while after frame_number (adaptive mode only)."""
+        if self.adaptive:
+            self.dense_until = max(self.dense_until, frame_number + self.dense_window)
+
+    def observe(self, frame_number, frame):
+        """Checks a sampled frame for a scene cut; returns True if one was found."""
+        if not self.adaptive:
+            return False
+        thumb = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+        is_cut = self._last_thumb is not None and float(np.mean(np.abs(thumb - self._last_thumb))) > self.cut_threshold
+        self._last_thumb = thumb
+        if is_cut:
+            self.scene_cuts += 1
+            self.boost(frame_number)
+        return is_cut
+
+    def advance(self, cap, frames):
+        """Moves past `frames` frames without decoding them into images. Returns False at the end."""
+        if frames <= 0:
+            return True
+        if frames >= self.seek_threshold:
+            position = cap.get(cv2.CAP_PROP_POS_FRAMES)
+            return cap.set(cv2.CAP_PROP_POS_FRAMES, position + frames)
+        for _ in range(frames):
+            if not cap.grab():
+                return False
+        return True
+
+def decode_frames(cap, sampler, frame_queue, stop_event, metrics=NO_METRICS):
+    """
+    Decoder stage: reads the sampled frames and puts each (frame_number, frame)
+    on a bounded queue, then a final None - or, if decoding failed, the
+    exception, for the consumer to report. Blocks while the queue is full.
+    Frame numbers are 1-based, so with a step of N the first frame read is N.
+    """
+    frame_number, end = 0, None
+    try:
+        while not stop_event.is_set():
+            started = time.time()
+            step = sampler.next_step(frame_number)
+            if not sampler.advance(cap, step - 1):
+                break
+            ret, frame = cap.read()
+            if not ret:
+                break
+            metrics.add('decode', started, time.time() - started, step)
+            position = cap.get(cv2.CAP_PROP_POS_FRAMES)
+            frame_number = int(position) if position > 0 else frame_number + step
+            sampler.observe(frame_number, frame)
+            while not stop_event.is_set():
+                try:
+                    frame_queue.put((frame_number, frame), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+    except Exception as e:
+        end = e
+    finally:
+        # Always ends the stream, or the consumer would wait on the queue forever.
+        frame_queue.put(end)
+
+def scan_video(cap, total_frames, model_name, detector_backend, distance_metric, verification_threshold, frame_skip, workers=None, crop_memory_mb=DEFAULT_CROP_MEMORY_MB, clustering='online', tracking=True, reembed_every=10, sample_seconds=None, adaptive_sampling=False, max_side=DETECTION_MAX_SIDE, roi=None, metrics=NO_METRICS):
+    """
+    The scan stage of process_video: yields its progress/frame/debug events and
+    returns (detections, clusterer, failed_frames) - clusterer is None unless
+    clustering is 'online', and failed_frames counts frames whose analysis raised.
+    If the decoder fails, the scan stops with an ('error', ...) event and
+    returns None.
+    """
+    model_pool = warm_model_pool(model_name, detector_backend, workers)
+    max_in_flight = 2 * model_pool.concurrency(workers)
+    detections = DetectionStore(crop_memory_mb)
+    clusterer = OnlineClusterer(distance_metric, verification_threshold) if clustering == 'online' else None
+    sampler = FrameSampler(cap.get(cv2.CAP_PROP_FPS), frame_skip, sample_seconds, adaptive_sampling)
+    step = sampler.base_step
+    tracker = FaceTracker(max_gap=3 * step, reembed_interval=reembed_every * step) if tracking else None
+
+    def store_track(track):
+        frame_number, facial_area, confidence, crop = track.best
+        embedding = track.embedding()
+        detections.add_crop(frame_number, crop, embedding, facial_area, confidence, track.hits)
+        if clusterer is not None:
+            with metrics.span('cluster'):
+                identity, is_new = clusterer.add(embedding, track.hits)
+            if is_new:
+                yield ('debug', f"  - New individual candidate #{identity + 1} from track {track.track_id} (frames {track.first_frame}-{track.last_frame}).")
+
+    frame_queue = queue.Queue(maxsize=max_in_flight)
+    stop_event = threading.Event()
+    decoder = threading.Thread(target=decode_frames, args=(cap, sampler, frame_queue, stop_event, metrics), daemon=True)
+    decoder.start()
+
+    pending, decoding, frames_done, failed_frames = deque(), True, 0, 0
+    decode_error = None
+    try:
+        while True:
+            metrics.gauge('frame_queue', frame_queue.qsize())
+            metrics.gauge('in_flight', len(pending))
+            # Keep every worker busy, up to a bounded number of frames in flight.
+            while decoding and len(pending) < max_in_flight:
+                item = frame_queue.get()
+                if item is None:
+                    decoding = False
+                    break
+                if isinstance(item, Exception):
+                    decoding, decode_error = False, item
+                    break
+                frame_count, frame = item
+                yield ('debug', f"Frame {frame_count}: Submitting to processing pool...")
+                if tracker is not None:
+                    task = model_pool.submit(detect_faces_in_process, frame, detector_backend, max_side, roi)
+                else:
+                    task = model_pool.submit(represent_in_process, frame, model_name, detector_backend, max_side, roi)
+                pending.append((frame_count, frame, task))
+            if not pending or decode_error is not None:
+                break
+
+            # Results are consumed oldest first, so frames come out in order.
+            frame_count, frame, async_result = pending.popleft()
+            progress_text = f"Analyzing frame {frame_count}/{total_frames}..."
+            if clusterer is not None:
+                progress_text += f" ({clusterer.identity_count} individual(s) so far)"
+            yield ('progress', {'value': min(frame_count / total_frames, 1.0), 'text': progress_text})
+
+            frames_done += 1
+            if metrics.enabled and frames_done % 25 == 0:
+                yield ('metrics', metrics.snapshot())
+
+            try:
+                face_objs = async_result.get()
+                metrics.record_task(async_result)
+
+                if isinstance(face_objs, Exception):
+                    raise face_objs
+
+                yield ('debug', f"Frame {frame_count}: Received {len(face_objs)} result(s) from pool.")
+
+                if tracker is not None:
+                    with metrics.span('track'):
+                        expired = tracker.expire(frame_count)
+                    for track in expired:
+                        yield from store_track(track)
+
+                if not face_objs:
+                    yield ('debug', f"Frame {frame_count}: No faces found.")
+                    yield ('frame_update', frame)
+                    continue
+
+                frame_with_boxes = frame.copy()
+                if tracker is not None:
+                    with metrics.span('track', len(face_objs)):
+                        updates = tracker.update(frame_count, frame, face_objs)
+                    to_embed = [(face, track) for face, track, needs_embedding in updates if needs_embedding]
+                    if to_embed:
+                        embed_task = model_pool.submit(embed_faces_in_process, [face['face'] for face, _ in to_embed], model_name)
+                        embeddings = embed_task.get()
+                        metrics.record_task(embed_task)
+                        if isinstance(embeddings, Exception):
+                            raise embeddings
+                        for (_, track), embedding in zip(to_embed, embeddings):
+                            if track.embedding_count == 0:
+                                sampler.boost(frame_count)
+                            track.add_embedding(embedding, frame_count)
+                    yield ('debug', f"Frame {frame_count}: Embedded {len(to_embed)} of {len(updates)} tracked face(s).")
+                    for face, track, _ in updates:
+                        fa = face['facial_area']
+                        cv2.rectangle(frame_with_boxes, (fa['x'], fa['y']), (fa['x'] + fa['w'], fa['y'] + fa['h']), (0, 0, 255), 2)
+                        cv2.putText(frame_with_boxes, f"T{track.track_id}", (fa['x'], fa['y'] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+                else:
+                    for obj in face_objs:
+                        # Log the confidence of every detected face; clustering sorts out weak ones.
+                        confidence = obj.get('confidence', 0)
+                        yield ('debug', f"  - Face detected with confidence: {confidence:.4f}")
+
+                        detections.add(frame_count, frame, obj['embedding'], obj['facial_area'], confidence)
+                        if clusterer is not None:
+                            with metrics.span('cluster'):
+                                identity, is_new = clusterer.add(obj['embedding'])
+                            if is_new:
+                                sampler.boost(frame_count)
+                                yield ('debug', f"  - New individual candidate #{identity + 1} first seen in frame {frame_count}.")
+
+                        # Draw a box for visualization regardless of confidence.
+                        fa = obj['facial_area']
+                        cv2.rectangle(frame_with_boxes, (fa['x'], fa['y']), (fa['x'] + fa['w'], fa['y'] + fa['h']), (0, 0, 255), 2)
+
+                yield ('frame_update', frame_with_boxes)
+
+            except Exception as e:
+                failed_frames += 1
+                yield ('debug', f"Frame {frame_count}: ERROR during face representation - {str(e)}")
+                yield ('frame_update', frame)
+    finally:
+        stop_event.set()
+        # Drain the queue so a decoder blocked on put() can exit.
+        while decoder.is_alive():
+            try:
+                frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        decoder.join()
+        # Frames still in flight finish on the shared pool; their results are discarded.
+        cap.release()
+
+    if decode_error is not None:
+        yield ('error', f"Video decoding failed: {decode_error}")
+        return None
+    if sampler.adaptive:
+        yield ('debug', f"Adaptive sampling: {sampler.scene_cuts} scene cut(s) detected.")
+    if tracker is not None:
+        for track in tracker.finish_all():
+            yield from store_track(track)
+        yield ('debug', f"Tracking: {tracker.next_id} track(s); {tracker.embeddings_computed} face embedding(s) computed, {tracker.embeddings_skipped} skipped.")
+
+    return detections, clusterer, failed_frames
+
+def process_video(video_path, db_path, model_name, detector_backend, distance_metric, verification_threshold, frame_skip, workers=None, crop_memory_mb=DEFAULT_CROP_MEMORY_MB, clustering='online', tracking=True, reembed_every=10, sample_seconds=None, adaptive_sampling=False, match_with='centroid', max_side=DETECTION_MAX_SIDE, roi=None, cache=None, metrics=None):
+    """
+    Processes a video to find unique individuals and their matches.
+
+    The scan is pipelined: a decoder thread feeds sampled frames through a
+    bounded queue to the shared model pool (using at most `workers` of its workers if given),
+    whose workers keep the model loaded, and results are reassembled in frame
+    order before being yielded. Detections are kept in a DetectionStore whose
+    face crops stay within crop_memory_mb.
+    With tracking=True, workers only detect faces; a FaceTracker links boxes
+    across frames and a track is embedded when it is new, when its view clearly
+    improves, or every `reembed_every` sampled frames, and each finished track
+    contributes one aggregated embedding to clustering.
+    With clustering='online' (the default) faces are assigned to identities
+    as they arrive; clustering='dbscan' runs DBSCAN once the scan is complete.
+    Frames are sampled every frame_skip frames, or every sample_seconds if given,
+    by a FrameSampler that skips frames without decoding them; with
+    adaptive_sampling it samples densely around scene cuts and new faces.
+    Every cluster is matched against the gallery in one batched search, using
+    the embeddings it already has (see cluster_query_embeddings).
+    Workers detect on frames downscaled to max_side and cut faces at full
+    resolution; `roi` restricts detection to part of the frame (see detect_faces).
+    With a MediaCache, a video already scanned with the same settings skips
+    the scan and is only re-clustered and re-scored; a scan in which any frame
+    failed is not cached, so the next run scans the video again.
+    With a PipelineMetrics, per-stage timings and queue depths are collected
+    and reported as ('metrics', snapshot) events during and after the run.
+    """
+    if metrics is None:
+        metrics = NO_METRICS
+    cap = cv2.VideoCapture(video_path)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if total_frames == 0:
+        yield ('error', "Cannot read video file or video has no frames.")
+        return
+
+    cache_key = cached = None
+    if cache is not None:
+        cache_key = MediaCache.make_key(
+            file_content_hash(video_path), kind='video', model=model_name, detector=detector_backend,
+            frame_skip=frame_skip, sample_seconds=sample_seconds, tracking=tracking, reembed_every=reembed_every,
+            crop_memory_mb=crop_memory_mb, max_side=max_side, roi=roi_cache_key(roi),
+            # Without tracking, adaptive sampling is steered by new identities, which depend on scoring.
+            adaptive=adaptive_sampling and (tracking or (distance_metric, verification_threshold, clustering)),
+        )
+        cached = cache.get(cache_key)
+
+    clusters = None
+    if cached is not None:
+        cap.release()
+        detections = DetectionStore.from_arrays(cached, crop_memory_mb)
+        labels_name = labels_cache_name(clustering, distance_metric, verification_threshold)
+        if labels_name in cached:
+            clusters = cached[labels_name]
+        yield ('debug', f"Loaded {len(detections)} cached face instance(s); skipping the video scan.")
+        yield ('progress', {'value': 1.0, 'text': "Using cached analysis..."})
+        clusterer = None
+    else:
+        scan = yield from scan_video(
+            cap, total_frames, model_name, detector_backend, distance_metric, verification_threshold, frame_skip,
+            workers, crop_memory_mb, clustering, tracking, reembed_every, sample_seconds, adaptive_sampling,
+            max_side, roi, metrics
+        )
+        if scan is None:
+            # The decoder failed; scan_video has reported it, and nothing is cached.
+            return
+        detections, clusterer, failed_frames = scan
+        if failed_frames:
+            yield ('debug', f"{failed_frames} frame(s) could not be analyzed; the scan is not cached.")
+        elif cache is not None:
+            cache.put(cache_key, detections.to_arrays())
+
+    yield ('debug', f"Video scan complete. Total face instances found (all confidences): {len(detections)}")
+    yield ('debug', f"Stored {len(detections.crops)} face crop(s) using {detections.crop_bytes / 1024 / 1024:.1f} MB.")
+
+    if not len(detections):
+        # This message will now only appear if DeepFace truly finds zero faces in the whole video.
+        yield ('error', "No faces were detected in any frame of the video.")
+        return
+
+    yield ('progress', {'value': 1.0, 'text': f"Detected {len(detections)} face instances. Clustering..."})
+    all_embeddings = detections.embedding_matrix()
+
+    if clusters is not None:
+        yield ('debug', "Using cached cluster assignments.")
+    elif clusterer is not None:
+        yield ('debug', f"Finalizing online clustering of {len(all_embeddings)} embeddings (threshold={verification_threshold})...")
+        with metrics.span('cluster', len(all_embeddings)):
+            clusters = clusterer.finalize(all_embeddings)
+    else:
+        yield ('debug', f"Clustering {len(all_embeddings)} embeddings (threshold={verification_threshold})...")
+        with metrics.span('cluster', len(all_embeddings)):
+            clusters = cluster_detections(detections, distance_metric, verification_threshold, clustering)
+    if cache is not None:
+        cache.update(cache_key, {labels_cache_name(clustering, distance_metric, verification_threshold): clusters})
+    unique_cluster_ids = set(clusters) - {-1}
+    yield ('debug', f"Clustering complete. Found {len(unique_cluster_ids)} unique clusters (people). Labels: {clusters}")
+    if metrics.enabled:
+        yield ('metrics', metrics.snapshot())
+
+    if not unique_cluster_ids:
+        yield ('error', "Could not identify any unique individuals (clusters). All faces were considered unique. Try increasing the Verification Threshold or reducing Frame Skip.")
+        return
+
+    yield ('progress', {'value': 1.0, 'text': f"Found {len(unique_cluster_ids)} unique individual(s). Finding matches..."})
+
+    cluster_ids = sorted(unique_cluster_ids)
+    try:
+        yield ('debug', f"Matching {len(cluster_ids)} cluster(s) against the gallery in one batch ({match_with} embeddings)...")
+        queries = cluster_query_embeddings(detections, clusters, cluster_ids, distance_metric, match_with)
+        with metrics.span('index_sync'):
+            index = get_gallery_index(db_path, model_name, detector_backend)
+        threshold = get_threshold(model_name, distance_metric)
+        with metrics.span('search', len(cluster_ids)):
+            matches_df_list = index.search(queries, distance_metric, threshold, verification_threshold)
+        yield ('debug', "Batch match search complete.")
+        if metrics.enabled:
+            yield ('metrics', metrics.snapshot())
+    except Exception as e:
+        yield ('error', f"CRITICAL ERROR during gallery search: {e}")
+        return
+
+    for cluster_id, matches_df in zip(cluster_ids, matches_df_list):
+        indices = np.where(clusters == cluster_id)[0]
+        rep_index, rep_crop = detections.representative(indices)
+        if rep_crop is None:
+            # The crop was dropped to stay within the memory budget; read that one frame again.
+            rep_crop = read_face_crop(video_path, int(detections.boxes[rep_index]['frame']), detections.facial_area(rep_index))
+
+        has_strong_match = not matches_df.empty and matches_df.iloc[0]['distance'] <= verification_threshold
+
+        yield ('result', {
+            'person_index': f"{cluster_id + 1}",
+            'matches': matches_df,
+            'ref_crop': rep_crop,
+            'has_strong_match': has_strong_match,
+            'frame': int(detections.boxes[rep_index]['frame']),
+            'facial_area': detections.facial_area(rep_index),
+            'face_count': len(indices)
+        })
\ No newline at end of file
@@ -0,0 +1,591 @@
+# face_match_bench.py
+#
+# Reproducible benchmarks for the backend's pipeline stages.
+#
+#   python face_match_bench.py --stages search --gallery-sizes 1000,10000,100000,1000000
+#   python face_match_bench.py --models ArcFace --detectors opencv,retinaface \
+#       --output bench/current.json --baseline bench/baseline.json
+#   python face_match_bench.py --faces fixtures/faces --stages crop,image,video
+#
+# Stages:
+#   import  cold 'import face_match_backend' in fresh interpreters (python -X importtime);
+#           fails the run if it loads any of backend.HEAVY_MODULES (TensorFlow, ...).
+#   search  synthetic clustered embeddings (exact SearchEngine, the memory-mapped
+#           int8 GalleryFile, and the IVF index for galleries of 10k and more);
+#           needs no model.
+#   cluster OnlineClusterer against DBSCAN (backend.compare_with_dbscan) on
+#           synthetic face embeddings in shuffled order, in both clusterer modes:
+#           adjusted Rand index, NMI and cluster counts; needs no model.
+#   crop    crop_and_prepare_db over a gallery generated from the fixture faces:
+#           one cold build, then repeated no-op incremental rebuilds.
+#           The fixtures are the images in --faces, or, by default, drawn
+#           faces generated with OpenCV (see synthetic_face), so every stage
+#           runs without any data to hand.
+#   image   process_image on the fixture faces.
+#   video   process_video on synthetic videos of the fixture faces moving over a
+#           plain background, for each --video-seconds x --video-faces combination.
+#
+# Every result records throughput, p50/p95/p99 latency and the peak resident
+# memory of this process plus its model workers, and is written to a JSON and
+# a CSV file. With --baseline, results are compared against a stored run and
+# the exit code is 1 if any stage's throughput or p50 latency got worse than
+# --tolerance allows.
+# Everything runs on the CPU; nothing is downloaded beyond the model weights
+# DeepFace already caches.
+
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+import cv2
+import numpy as np
+import face_match_backend as backend
+
+
+MODEL_DIMENSIONS = {"ArcFace": 512, "VGG-Face": 4096, "Facenet": 128, "Facenet512": 512, "SFace": 128}
+IVF_MIN_BENCH_SIZE = 10_000
+SYNTHETIC_CHUNK_ROWS = 65_536
+
+
+# --- Measurement ---
+def process_tree_rss_mb():
+    """Resident memory of this process and its live child processes (the model workers)."""
+    total = backend.current_rss_mb()
+    for child in multiprocessing.active_children():
+        try:
+            with open(f'/proc/{child.pid}/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) / 1024
+                        break
+        except OSError:
+            pass
+    return total
+
+
+class PeakRss:
+    """Samples process_tree_rss_mb in the background while a stage runs."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0.0
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process_tree_rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = process_tree_rss_mb()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, process_tree_rss_mb())
+
+
+def summarize(stage, params, latencies, items, elapsed, peak_rss_mb, **extra):
+    """One result record; latencies are in seconds, items is the unit count behind the throughput."""
+    latencies_ms = np.asarray(latencies, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99]) if len(latencies_ms) else (None, None, None)
+    return {
+        'stage': stage,
+        **params,
+        'samples': len(latencies_ms),
+        'items': items,
+        'seconds': round(elapsed, 4),
+        'throughput_per_s': round(items / elapsed, 3) if elapsed > 0 else None,
+        'p50_ms': None if p50 is None else round(float(p50), 3),
+        'p95_ms': None if p95 is None else round(float(p95), 3),
+        'p99_ms': None if p99 is None else round(float(p99), 3),
+        'peak_rss_mb': None if peak_rss_mb is None else round(peak_rss_mb, 1),
+        **extra,
+    }
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+# --- Fixtures ---
+def synthetic_gallery(size, dim, rng, samples_per_identity=5, noise=0.35):
+    """
+    Clustered embeddings: identities with a few noisy samples each, like a real gallery.
+    Generated in float32 chunks, so a million rows never need a float64 copy.
+    """
+    n_identities = max(1, size // samples_per_identity)
+    centers = rng.standard_normal((n_identities, dim), dtype=np.float32)
+    labels = np.arange(size) % n_identities
+    gallery = np.empty((size, dim), dtype=np.float32)
+    for start in range(0, size, SYNTHETIC_CHUNK_ROWS):
+        stop = min(size, start + SYNTHETIC_CHUNK_ROWS)
+        chunk = gallery[start:stop]
+        rng.standard_normal(chunk.shape, dtype=np.float32, out=chunk)
+        chunk *= noise
+        chunk += centers[labels[start:stop]]
+    return gallery, centers, labels
+
+def synthetic_face(rng, side=224):
+    """
+    A frontal face drawn with OpenCV: skin-toned oval, hair, brows, eyes, nose
+    shading and mouth on a plain background, with proportions and colours
+    drawn from rng so each call looks like a different person.
+    """
+    img = np.full((side, side, 3), rng.integers(150, 230, size=3), dtype=np.uint8)
+    center = (side // 2, int(side * 0.54))
+    face_w, face_h = int(side * rng.uniform(0.27, 0.33)), int(side * rng.uniform(0.36, 0.41))
+    skin = tuple(int(c) for c in np.array([110, 150, 200]) * rng.uniform(0.55, 1.1) + rng.integers(-10, 11, size=3))
+    hair = tuple(int(c) for c in rng.integers(10, 90, size=3))
+    cv2.rectangle(img, (center[0] - face_w // 3, center[1] + face_h // 2), (center[0] + face_w // 3, side), skin, -1)
+    cv2.ellipse(img, (center[0], center[1] - face_h // 6), (face_w + 6, face_h), 0, 180, 360, hair, -1)
+    cv2.ellipse(img, center, (face_w, face_h), 0, 0, 360, skin, -1)
+
+    eye_y = center[1] - int(face_h * rng.uniform(0.12, 0.2))
+    eye_dx = int(face_w * rng.uniform(0.38, 0.48))
+    eye_r = max(3, int(face_w * rng.uniform(0.14, 0.17)))
+    iris = tuple(int(c) for c in rng.integers(20, 110, size=3))
+    shadow = tuple(int(c * 0.75) for c in skin)
+    for x in (center[0] - eye_dx, center[0] + eye_dx):
+        cv2.ellipse(img, (x, eye_y - int(1.8 * eye_r)), (int(eye_r * 1.7), max(3, int(eye_r * 0.6))), 0, 180, 360, hair, -1)
+        cv2.ellipse(img, (x, eye_y), (int(eye_r * 1.5), eye_r), 0, 0, 360, (235, 235, 235), -1)
+        cv2.ellipse(img, (x, eye_y), (int(eye_r * 1.5), eye_r), 0, 180, 360, shadow, 2)
+        cv2.circle(img, (x, eye_y), int(eye_r * 0.8), iris, -1)
+        cv2.circle(img, (x, eye_y), max(1, eye_r // 3), (15, 15, 15), -1)
+
+    nose_bottom = center[1] + int(face_h * rng.uniform(0.15, 0.25))
+    cv2.line(img, (center[0] + 3, eye_y + eye_r), (center[0] + 6, nose_bottom), shadow, 3)
+    cv2.ellipse(img, (center[0], nose_bottom), (max(4, face_w // 5), 4), 0, 0, 180, shadow, 2)
+    mouth_y = center[1] + int(face_h * rng.uniform(0.45, 0.55))
+    lips = (int(skin[0] * 0.6), int(skin[1] * 0.5), int(min(255, skin[2] * 0.9)))
+    cv2.ellipse(img, (center[0], mouth_y), (int(face_w * rng.uniform(0.35, 0.5)), max(4, face_h // 12)), 0, 0, 360, lips, -1)
+    return cv2.GaussianBlur(img, (5, 5), 0)
+
+def synthetic_faces(count, rng):
+    return [synthetic_face(rng) for _ in range(count)]
+
+def load_fixture_faces(faces_dir):
+    faces = []
+    for path in backend.list_image_files(faces_dir):
+        img = cv2.imread(path)
+        if img is not None:
+            faces.append(img)
+    if not faces:
+        raise SystemExit(f"No readable face images in {faces_dir}")
+    return faces
+
+def write_source_gallery(faces, target_dir, count, rng):
+    """Writes `count` source images derived from the fixtures (flips and brightness shifts, so hashes differ)."""
+    os.makedirs(target_dir, exist_ok=True)
+    for i in range(count):
+        img = faces[i % len(faces)]
+        if (i // len(faces)) % 2:
+            img = cv2.flip(img, 1)
+        img = cv2.convertScaleAbs(img, alpha=1.0, beta=float(rng.integers(-20, 21)))
+        cv2.imwrite(os.path.join(target_dir, f"person_{i:06d}.jpg"), img)
+
+def write_synthetic_video(faces, path, seconds, face_count, rng, fps=25, size=(960, 540), face_side=140):
+    """Fixture faces drifting across a plain background; returns the frame count."""
+    width, height = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+    tiles = [cv2.resize(faces[(i * 7) % len(faces)], (face_side, face_side)) for i in range(face_count)]
+    starts = rng.uniform([0, 0], [width - face_side, height - face_side], size=(face_count, 2))
+    velocities = rng.uniform(-2, 2, size=(face_count, 2))
+    frames = int(seconds * fps)
+    background = np.full((height, width, 3), 90, dtype=np.uint8)
+    for t in range(frames):
+        frame = background.copy()
+        for tile, start, velocity in zip(tiles, starts, velocities):
+            x, y = (start + velocity * t).astype(int)
+            x = int(np.clip(x, 0, width - face_side))
+            y = int(np.clip(y, 0, height - face_side))
+            frame[y:y + face_side, x:x + face_side] = tile
+        writer.write(frame)
+    writer.release()
+    return frames
+
+
+# --- Stages ---
+def bench_import(args, log):
+    """Import-time profile of the backend; TensorFlow and friends must stay deferred."""
+    probe = "import face_match_backend as b; print(','.join(b.loaded_heavy_modules()))"
+    latencies, heavy, slowest = [], set(), {}
+    for _ in range(args.repeat):
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', probe],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(backend.__file__)),
+        )
+        heavy.update(name for name in completed.stdout.strip().split(',') if name)
+        # Lines look like "import time:   self [us] | cumulative | imported package".
+        for line in completed.stderr.splitlines():
+            parts = line.split('|')
+            if not line.startswith('import time:') or len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            self_us, cumulative_us, module = int(parts[0].split(':')[1]), int(parts[1]), parts[2].strip()
+            slowest[module] = max(slowest.get(module, 0), self_us)
+            if module == 'face_match_backend':
+                latencies.append(cumulative_us / 1e6)
+    top = sorted(slowest.items(), key=lambda item: -item[1])[:5]
+    result = summarize('import_backend', {}, latencies, len(latencies), sum(latencies), None,
+                       heavy_modules=",".join(sorted(heavy)), slowest_modules=",".join(f"{name}:{us // 1000}ms" for name, us in top))
+    log(f"import face_match_backend: p50 {result['p50_ms']} ms, heavy modules: {result['heavy_modules'] or 'none'}")
+    return [result]
+
+def bench_search(args, rng, log):
+    results = []
+    for model_name in args.models:
+        dim = MODEL_DIMENSIONS.get(model_name, 512)
+        for size in args.gallery_sizes:
+            gallery, centers, labels = synthetic_gallery(size, dim, rng)
+            query_labels = rng.integers(0, len(centers), size=args.queries)
+            queries = centers[query_labels] + 0.35 * rng.standard_normal((args.queries, dim), dtype=np.float32)
+            params = {'model': model_name, 'detector': None, 'gallery_size': size, 'dim': dim, 'metric': args.metric}
+
+            with PeakRss() as rss:
+                started = time.perf_counter()
+                engine = backend.SearchEngine(gallery)
+                elapsed = time.perf_counter() - started
+            results.append(summarize('search_build', params, [elapsed], size, elapsed, rss.peak))
+
+            latencies = []
+            with PeakRss() as rss:
+                started = time.perf_counter()
+                for query in queries:
+                    t = time.perf_counter()
+                    engine.search(query, args.metric, args.top_k)
+                    latencies.append(time.perf_counter() - t)
+                elapsed = time.perf_counter() - started
+            results.append(summarize('search_exact', params, latencies, len(queries), elapsed, rss.peak))
+
+            with PeakRss() as rss:
+                started = time.perf_counter()
+                exact_batch = engine.search(queries, args.metric, args.top_k)
+                elapsed = time.perf_counter() - started
+            results.append(summarize('search_exact_batch', params, [elapsed], len(queries), elapsed, rss.peak, batch_size=len(queries)))
+            log(f"search {model_name} n={size}: exact p50 {results[-2]['p50_ms']} ms, batch {results[-1]['throughput_per_s']} queries/s")
+
+            with tempfile.TemporaryDirectory() as gallery_dir:
+                gallery_path = os.path.join(gallery_dir, "bench.gal")
+                backend.write_gallery_file(gallery_path, gallery, [f"{i}.jpg" for i in range(size)], model_name)
+                with PeakRss() as rss:
+                    started = time.perf_counter()
+                    gallery_file = backend.GalleryFile(gallery_path)
+                    elapsed = time.perf_counter() - started
+                results.append(summarize('search_gallery_open', params, [elapsed], size, elapsed, rss.peak, file_mb=round(os.path.getsize(gallery_path) / 2**20, 1)))
+
+                # The float32 engine over the mapped vectors: what GalleryIndex searches by default.
+                mapped_engine = backend.SearchEngine(gallery_file.vectors, gallery_file.norms)
+                latencies = []
+                with PeakRss() as rss:
+                    started = time.perf_counter()
+                    for query in queries:
+                        t = time.perf_counter()
+                        mapped_engine.search(query, args.metric, args.top_k)
+                        latencies.append(time.perf_counter() - t)
+                    elapsed = time.perf_counter() - started
+                results.append(summarize('search_mapped', params, latencies, len(queries), elapsed, rss.peak))
+                log(f"search {model_name} n={size}: mapped float32 p50 {results[-1]['p50_ms']} ms")
+                del mapped_engine
+
+                latencies, hits = [], 0
+                with PeakRss() as rss:
+                    started = time.perf_counter()
+                    for query, (exact_indices, _) in zip(queries, exact_batch):
+                        t = time.perf_counter()
+                        quantized_indices, _ = gallery_file.search(query, args.metric, args.top_k)[0]
+                        latencies.append(time.perf_counter() - t)
+                        hits += len(np.intersect1d(quantized_indices, exact_indices))
+                    elapsed = time.perf_counter() - started
+                recall = hits / max(1, sum(len(indices) for indices, _ in exact_batch))
+                results.append(summarize('search_quantized', params, latencies, len(queries), elapsed, rss.peak, dtype=gallery_file.dtype, recall_at_k=round(recall, 4)))
+                log(f"search {model_name} n={size}: int8 p50 {results[-1]['p50_ms']} ms, recall@{args.top_k} {recall:.3f}")
+                del gallery_file
+
+            if size >= IVF_MIN_BENCH_SIZE:
+                with PeakRss() as rss:
+                    started = time.perf_counter()
+                    ivf = backend.IVFIndex()
+                    ivf.train(gallery, seed=args.seed)
+                    train_seconds = time.perf_counter() - started
+                results.append(summarize('search_ivf_train', params, [train_seconds], size, train_seconds, rss.peak, n_lists=ivf.n_lists))
+
+                latencies, hits = [], 0
+                with PeakRss() as rss:
+                    started = time.perf_counter()
+                    for query, (exact_indices, _) in zip(queries, exact_batch):
+                        t = time.perf_counter()
+                        approx_indices, _ = ivf.search(engine, query, args.metric, args.top_k)[0]
+                        latencies.append(time.perf_counter() - t)
+                        hits += len(np.intersect1d(approx_indices, exact_indices))
+                    elapsed = time.perf_counter() - started
+                recall = hits / max(1, sum(len(indices) for indices, _ in exact_batch))
+                results.append(summarize('search_ivf', params, latencies, len(queries), elapsed, rss.peak, n_probe=ivf.n_probe, recall_at_k=round(recall, 4)))
+                log(f"search {model_name} n={size}: ivf p50 {results[-1]['p50_ms']} ms, recall@{args.top_k} {recall:.3f}")
+            del engine, gallery
+    return results
+
+def bench_cluster(args, rng, log):
+    results = []
+    # One untimed call so the first DBSCAN run does not pay for loading scikit-learn.
+    backend.compare_with_dbscan(rng.standard_normal((10, 8), dtype=np.float32), args.metric, 0.5)
+    for model_name in args.models:
+        dim = MODEL_DIMENSIONS.get(model_name, 512)
+        threshold = backend.get_threshold(model_name, args.metric)
+        for size in args.cluster_sizes:
+            # A video shows a few people many times, unlike a gallery.
+            embeddings, _, _ = synthetic_gallery(size, dim, rng, samples_per_identity=50, noise=args.cluster_noise)
+            embeddings = embeddings[rng.permutation(size)]
+            for mode in ('centroid', 'prototype'):
+                params = {'model': model_name, 'detector': None, 'gallery_size': size, 'dim': dim, 'metric': args.metric, 'mode': mode}
+                with PeakRss() as rss:
+                    report = backend.compare_with_dbscan(embeddings, args.metric, threshold, mode)
+                results.append(summarize(
+                    'cluster_online', params, [report['online_seconds']], size, report['online_seconds'], rss.peak,
+                    adjusted_rand_index=round(report['adjusted_rand_index'], 4),
+                    normalized_mutual_info=round(report['normalized_mutual_info'], 4),
+                    online_clusters=report['online_clusters'], dbscan_clusters=report['dbscan_clusters'],
+                    online_noise=report['online_noise'], dbscan_noise=report['dbscan_noise'],
+                ))
+                results.append(summarize('cluster_dbscan', params, [report['dbscan_seconds']], size, report['dbscan_seconds'], rss.peak))
+                log(f"cluster {model_name} n={size} {mode}: ARI {report['adjusted_rand_index']:.4f}, NMI {report['normalized_mutual_info']:.4f}, "
+                    f"{report['online_clusters']} online vs {report['dbscan_clusters']} DBSCAN cluster(s), "
+                    f"{report['online_seconds']:.2f}s vs {report['dbscan_seconds']:.2f}s")
+    return results
+
+def bench_crop(args, faces, work_dir, model_name, detector_backend, rng, log):
+    source_dir = os.path.join(work_dir, f"source_{model_name}_{detector_backend}")
+    shutil.rmtree(source_dir, ignore_errors=True)
+    write_source_gallery(faces, source_dir, args.crop_images, rng)
+    params = {'model': model_name, 'detector': detector_backend, 'gallery_size': args.crop_images}
+
+    with PeakRss() as rss:
+        started = time.perf_counter()
+        cropped_db_path, faces_created, failed = backend.crop_and_prepare_db(source_dir, detector_backend, model_name, args.workers)
+        elapsed = time.perf_counter() - started
+    results = [summarize('crop_cold', params, [elapsed], args.crop_images, elapsed, rss.peak, faces_created=faces_created, failed=len(failed))]
+    log(f"crop {model_name}/{detector_backend}: {args.crop_images} images in {elapsed:.1f}s ({faces_created} faces)")
+
+    latencies = []
+    with PeakRss() as rss:
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            backend.crop_and_prepare_db(source_dir, detector_backend, model_name, args.workers)
+            latencies.append(time.perf_counter() - t)
+    results.append(summarize('crop_noop_rebuild', params, latencies, len(latencies), sum(latencies), rss.peak))
+    return results, cropped_db_path
+
+def bench_image(args, faces, work_dir, cropped_db_path, model_name, detector_backend, log):
+    image_paths = []
+    for i, img in enumerate(faces):
+        path = os.path.join(work_dir, f"query_{i:04d}.jpg")
+        cv2.imwrite(path, img)
+        image_paths.append(path)
+    threshold = backend.get_threshold(model_name, args.metric)
+    params = {'model': model_name, 'detector': detector_backend, 'gallery_size': args.crop_images, 'metric': args.metric}
+
+    # One untimed call so lazy index loading is not counted as query latency.
+    backend.process_image(image_paths[0], cropped_db_path, model_name, detector_backend, args.metric, threshold)
+    latencies, face_count = [], 0
+    with PeakRss() as rss:
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            for path in image_paths:
+                t = time.perf_counter()
+                _, results, _ = backend.process_image(path, cropped_db_path, model_name, detector_backend, args.metric, threshold)
+                latencies.append(time.perf_counter() - t)
+                face_count += len(results or [])
+        elapsed = time.perf_counter() - started
+    record = summarize('image', params, latencies, len(latencies), elapsed, rss.peak, faces=face_count)
+    log(f"image {model_name}/{detector_backend}: p50 {record['p50_ms']} ms, p95 {record['p95_ms']} ms")
+    return [record]
+
+def bench_video(args, faces, work_dir, cropped_db_path, model_name, detector_backend, rng, log):
+    threshold = backend.get_threshold(model_name, args.metric)
+    results = []
+    for seconds in args.video_seconds:
+        for face_count in args.video_faces:
+            path = os.path.join(work_dir, f"video_{seconds}s_{face_count}f.avi")
+            if not os.path.exists(path):
+                write_synthetic_video(faces, path, seconds, face_count, rng)
+            cap = cv2.VideoCapture(path)
+            frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            cap.release()
+            params = {'model': model_name, 'detector': detector_backend, 'gallery_size': args.crop_images, 'metric': args.metric,
+                      'video_seconds': seconds, 'video_faces': face_count, 'frame_skip': args.frame_skip}
+
+            latencies, individuals = [], 0
+            with PeakRss() as rss:
+                for _ in range(max(1, args.video_repeat)):
+                    t = time.perf_counter()
+                    individuals = sum(
+                        1 for update_type, _ in backend.process_video(
+                            path, cropped_db_path, model_name, detector_backend, args.metric, threshold, args.frame_skip, args.workers
+                        ) if update_type == 'result'
+                    )
+                    latencies.append(time.perf_counter() - t)
+            record = summarize('video', params, latencies, frames * len(latencies), sum(latencies), rss.peak, individuals=individuals)
+            results.append(record)
+            log(f"video {model_name}/{detector_backend} {seconds}s x{face_count}: {record['throughput_per_s']} frames/s, {individuals} individual(s)")
+    return results
+
+
+# --- Output and Baseline ---
+RESULT_KEY_FIELDS = ('stage', 'model', 'detector', 'gallery_size', 'dim', 'metric', 'mode', 'video_seconds', 'video_faces', 'frame_skip')
+
+def result_key(record):
+    return tuple(record.get(field) for field in RESULT_KEY_FIELDS)
+
+def write_results(path, results, env):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'environment': env, 'results': results}, f, indent=2)
+    csv_path = os.path.splitext(path)[0] + ".csv"
+    fields = []
+    for record in results:
+        fields.extend(field for field in record if field not in fields)
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+    return csv_path
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    """Prints each shared result's change against the baseline; returns the regressions."""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {result_key(record): record for record in json.load(f)['results']}
+    regressions = []
+    for record in results:
+        old = baseline.get(result_key(record))
+        if old is None:
+            continue
+        label = " ".join(f"{field}={value}" for field, value in zip(RESULT_KEY_FIELDS, result_key(record)) if value is not None)
+        changes = []
+        for metric, higher_is_better in (('throughput_per_s', True), ('p50_ms', False), ('p95_ms', False), ('peak_rss_mb', False)):
+            if not old.get(metric) or record.get(metric) is None:
+                continue
+            ratio = record[metric] / old[metric]
+            changes.append(f"{metric} {old[metric]} -> {record[metric]} ({(ratio - 1) * 100:+.1f}%)")
+            if metric in ('throughput_per_s', 'p50_ms') and (ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance):
+                regressions.append((label, metric, old[metric], record[metric]))
+        print(f"{label}: " + "; ".join(changes))
+    return regressions
+
+
+def parse_list(cast):
+    return lambda value: [cast(item) for item in value.split(',') if item]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the face matching pipeline stages.")
+    parser.add_argument('--stages', type=parse_list(str), default=['import', 'search', 'cluster', 'crop', 'image', 'video'], help="Comma-separated: import,search,cluster,crop,image,video")
+    parser.add_argument('--faces', help="Folder of face images used as fixtures for the crop, image and video stages. Default: generated faces.")
+    parser.add_argument('--synthetic-faces', type=int, default=24, help="Faces generated when --faces is not given. Default: 24")
+    parser.add_argument('--models', type=parse_list(str), default=["ArcFace"])
+    parser.add_argument('--detectors', type=parse_list(str), default=["opencv"])
+    parser.add_argument('--metric', default="cosine", choices=('cosine', 'euclidean', 'euclidean_l2'))
+    parser.add_argument('--gallery-sizes', type=parse_list(int), default=[1000, 10000, 100000], help="Synthetic gallery sizes for the search stage (up to 1000000).")
+    parser.add_argument('--queries', type=int, default=200, help="Queries per search benchmark.")
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--cluster-sizes', type=parse_list(int), default=[1000, 5000], help="Synthetic face counts for the cluster stage.")
+    parser.add_argument('--cluster-noise', type=float, default=1.0, help="Spread of each synthetic identity's embeddings in the cluster stage. Default: 1.0")
+    parser.add_argument('--crop-images', type=int, default=200, help="Source images generated for the crop stage.")
+    parser.add_argument('--video-seconds', type=parse_list(float), default=[10, 60])
+    parser.add_argument('--video-faces', type=parse_list(int), default=[1, 4])
+    parser.add_argument('--video-repeat', type=int, default=1)
+    parser.add_argument('--frame-skip', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3, help="Repetitions for the image stage and no-op rebuilds.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help="Where fixtures are generated. Default: a temporary folder, removed afterwards.")
+    parser.add_argument('--output', default=os.path.join("bench_results", "latest.json"), help="JSON results; a CSV is written next to it.")
+    parser.add_argument('--baseline', help="Earlier results JSON to compare against.")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="Allowed slowdown against the baseline before failing. Default: 0.10")
+    parser.add_argument('-q', '--quiet', action='store_true')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    log = (lambda message: None) if args.quiet else (lambda message: print(message, file=sys.stderr, flush=True))
+    results = []
+
+    failures = []
+    if 'import' in args.stages:
+        results.extend(bench_import(args, log))
+        if results[-1]['heavy_modules']:
+            failures.append(f"import face_match_backend loaded {results[-1]['heavy_modules']}")
+
+    # Each stage gets its own generator, so fixtures do not depend on which stages run.
+    if 'search' in args.stages:
+        results.extend(bench_search(args, np.random.default_rng(args.seed), log))
+    if 'cluster' in args.stages:
+        results.extend(bench_cluster(args, np.random.default_rng(args.seed), log))
+
+    model_stages = [stage for stage in ('crop', 'image', 'video') if stage in args.stages]
+    if model_stages:
+        faces = load_fixture_faces(args.faces) if args.faces else synthetic_faces(args.synthetic_faces, np.random.default_rng(args.seed))
+        work_dir = args.work_dir or tempfile.mkdtemp(prefix="face_match_bench_")
+        try:
+            for model_name in args.models:
+                for detector_backend in args.detectors:
+                    with PeakRss() as rss:
+                        started = time.perf_counter()
+                        backend.warm_model_pool(model_name, detector_backend, args.workers)
+                        elapsed = time.perf_counter() - started
+                    results.append(summarize('model_warmup', {'model': model_name, 'detector': detector_backend}, [elapsed], 1, elapsed, rss.peak))
+
+                    # image and video match against the gallery the crop stage builds.
+                    crop_results, cropped_db_path = bench_crop(args, faces, work_dir, model_name, detector_backend, np.random.default_rng(args.seed), log)
+                    if 'crop' in model_stages:
+                        results.extend(crop_results)
+                    if 'image' in model_stages:
+                        results.extend(bench_image(args, faces, work_dir, cropped_db_path, model_name, detector_backend, log))
+                    if 'video' in model_stages:
+                        results.extend(bench_video(args, faces, work_dir, cropped_db_path, model_name, detector_backend, np.random.default_rng(args.seed), log))
+        finally:
+            if not args.work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    env = environment()
+    env['args'] = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'quiet')}
+    csv_path = write_results(args.output, results, env)
+    log(f"Wrote {args.output} and {csv_path}")
+
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.tolerance)
+        for label, metric, old, new in regressions:
+            print(f"REGRESSION {label}: {metric} {old} -> {new}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,398 @@
+# face_match_cli.py
+#
+# Headless batch matching of images and videos against the face database.
+#
+#   python face_match_cli.py photos/ clips/ --db face_database -o results.jsonl
+#   python face_match_cli.py --list files.txt -o results.parquet --resume
+#   python face_match_cli.py --db face_database --train-ann --ann-report
+#
+# Results are written as one JSON line per face ("face" records) plus one
+# "file" record per finished input. The output is flushed line by line, so an
+# interrupted run can be continued with --resume; Parquet output is converted
+# from the JSONL checkpoint once the run completes.
+
+import os
+import sys
+import json
+import time
+import argparse
+from collections import deque
+
+import cv2
+import face_match_backend as backend
+
+
+# --- Input Discovery ---
+def collect_inputs(paths, list_files=(), recursive=True):
+    """Expands files, directories and list files into (path, 'image'|'video') pairs, in order, without duplicates."""
+    candidates = list(paths)
+    for list_file in list_files:
+        with open(list_file, 'r', encoding='utf-8') as f:
+            candidates.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+
+    def media_kind(path):
+        ext = os.path.splitext(path)[1].lower()
+        if ext in backend.IMAGE_EXTENSIONS:
+            return 'image'
+        if ext in backend.VIDEO_EXTENSIONS:
+            return 'video'
+        return None
+
+    inputs, seen = [], set()
+    for candidate in candidates:
+        if os.path.isdir(candidate):
+            files = []
+            for root, dirs, names in os.walk(candidate):
+                # Skip the database's own working folders (_cropped_faces, _thumbs, ...).
+                dirs[:] = sorted(d for d in dirs if not d.startswith('_')) if recursive else []
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files = [candidate]
+        for path in files:
+            kind = media_kind(path)
+            path = os.path.abspath(path)
+            if kind is not None and path not in seen:
+                seen.add(path)
+                inputs.append((path, kind))
+    return inputs
+
+
+# --- Output and Resume ---
+class ResultWriter:
+    """Appends JSON lines to the checkpoint file, flushing after every input."""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.completed = set()
+        if resume and os.path.exists(path):
+            self.completed = self._load_completed()
+        elif os.path.exists(path):
+            os.remove(path)
+        self.f = open(path, 'a', encoding='utf-8')
+
+    def _load_completed(self):
+        """
+        Reads the sources already finished, and rewrites the checkpoint
+        without the face records of any input that was cut off mid-way.
+        """
+        records, completed, lines = [], set(), 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A line truncated by the interruption.
+                records.append(record)
+                if record.get('record') == 'file':
+                    completed.add(record['source'])
+        kept = [record for record in records if record['source'] in completed]
+        if len(kept) != lines:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for record in kept:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+        return completed
+
+    def write(self, records):
+        for record in records:
+            self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def convert_to_parquet(jsonl_path, parquet_path):
+    import pandas as pd
+    df = pd.read_json(jsonl_path, lines=True)
+    df.to_parquet(parquet_path, index=False)
+
+
+# --- Record Building ---
+def match_fields(matches_df, verification_threshold, top_k, metadata=None):
+    """Best identity, distance and candidate list for one face's match DataFrame."""
+    candidates = [
+        {'identity': row.identity, 'distance': float(row.distance)}
+        for row in matches_df.head(top_k).itertuples()
+    ]
+    best = candidates[0] if candidates else None
+    fields = {
+        'identity': best['identity'] if best else None,
+        'distance': best['distance'] if best else None,
+        'similarity': float(matches_df.iloc[0]['similarity']) if best else None,
+        'matched': bool(best and best['distance'] <= verification_threshold),
+        'candidates': candidates,
+    }
+    if metadata is not None:
+        info = metadata.lookup_crop(best['identity'])[1] if best else {}
+        fields['name'] = info.get('name')
+        fields['national_code'] = info.get('national_code')
+    return fields
+
+def face_record(source, media, face_index, facial_area, confidence, frame, match):
+    return {
+        'record': 'face',
+        'source': source,
+        'media': media,
+        'face': face_index,
+        'frame': frame,
+        'box': [facial_area['x'], facial_area['y'], facial_area['w'], facial_area['h']],
+        'confidence': confidence,
+        **match,
+    }
+
+def file_record(source, media, faces, seconds, error=None, frames=None):
+    return {
+        'record': 'file',
+        'source': source,
+        'media': media,
+        'faces': faces,
+        'frames': frames,
+        'seconds': round(seconds, 3),
+        'error': error,
+    }
+
+
+# --- Batch Processing ---
+class Throughput:
+    """Counters for the end-of-run summary."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.images = self.videos = self.faces = self.frames = self.errors = self.skipped = 0
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        files = self.images + self.videos
+        return "\n".join([
+            f"Processed {files} file(s) ({self.images} image(s), {self.videos} video(s)) in {elapsed:.1f}s; "
+            f"{self.skipped} skipped as already done, {self.errors} with errors.",
+            f"  {files / elapsed:.2f} files/s, {self.images / elapsed:.2f} images/s, "
+            f"{self.frames / elapsed:.1f} video frames/s, {self.faces / elapsed:.2f} faces/s ({self.faces} face(s)).",
+        ])
+
+def run_images(paths, index, args, writer, stats, metadata, cache, log, metrics):
+    """
+    Analyzes images on the shared model pool, keeping up to two per worker in
+    flight, and searches the gallery as each one comes back.
+    """
+    model_pool = backend.get_model_pool()
+    in_flight = deque()
+    remaining = iter(paths)
+
+    def submit_next():
+        for path in remaining:
+            cached = None
+            if cache is not None:
+                key = backend.image_cache_key(path, args.model, args.detector, args.detect_max_side, args.roi)
+                cached = cache.get(key)
+            if cached is not None:
+                in_flight.append((path, time.time(), None, backend.faces_from_arrays(cached)))
+            else:
+                task = model_pool.submit(backend.analyze_image_file_in_process, path, args.model, args.detector, args.detect_max_side, args.roi)
+                in_flight.append((path, time.time(), task, None))
+            return
+
+    for _ in range(2 * model_pool.workers):
+        submit_next()
+    while in_flight:
+        metrics.gauge('in_flight', len(in_flight))
+        path, started, task, faces = in_flight.popleft()
+        if task is not None:
+            faces = task.get()
+            metrics.record_task(task)
+            if cache is not None and isinstance(faces, list):
+                cache.put(backend.image_cache_key(path, args.model, args.detector, args.detect_max_side, args.roi), backend.faces_to_arrays(faces))
+        submit_next()
+
+        stats.images += 1
+        if isinstance(faces, Exception):
+            stats.errors += 1
+            writer.write([file_record(path, 'image', 0, time.time() - started, str(faces))])
+            log(f"[image] {path}: {faces}")
+            continue
+
+        with metrics.span('search', len(faces)):
+            matches_df_list = index.search(
+                [face['embedding'] for face in faces], args.metric, args.model_threshold, args.threshold, top_k=args.top_k
+            )
+        records = [
+            face_record(path, 'image', i + 1, face['facial_area'], face.get('confidence'), None,
+                        match_fields(df, args.threshold, args.top_k, metadata))
+            for i, (face, df) in enumerate(zip(faces, matches_df_list))
+        ]
+        records.append(file_record(path, 'image', len(faces), time.time() - started))
+        writer.write(records)
+        stats.faces += len(faces)
+        log(f"[image] {path}: {len(faces)} face(s)")
+
+def run_video(path, args, writer, stats, metadata, cache, log, metrics):
+    started = time.time()
+    cap = cv2.VideoCapture(path)
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    records, error = [], None
+    try:
+        processor = backend.process_video(
+            path, args.gallery, args.model, args.detector, args.metric, args.threshold, args.frame_skip, args.workers,
+            sample_seconds=args.sample_seconds, adaptive_sampling=args.adaptive_sampling,
+            max_side=args.detect_max_side, roi=args.roi, cache=cache,
+            metrics=metrics if metrics.enabled else None
+        )
+        for update_type, data in processor:
+            if update_type == 'result':
+                records.append(face_record(
+                    path, 'video', int(data['person_index']), data['facial_area'], None, data['frame'],
+                    match_fields(data['matches'], args.threshold, args.top_k, metadata)
+                ))
+                records[-1]['instances'] = data['face_count']
+            elif update_type == 'error':
+                error = data
+    except Exception as e:
+        # One unreadable video must not end the batch; it is recorded as done with its error.
+        records, error = [], str(e) or type(e).__name__
+
+    stats.videos += 1
+    stats.frames += frames
+    stats.faces += len(records)
+    if error is not None and not records:
+        stats.errors += 1
+    records.append(file_record(path, 'video', len(records), time.time() - started, error, frames))
+    writer.write(records)
+    log(f"[video] {path}: {len(records) - 1} individual(s)" + (f" ({error})" if error else ""))
+
+
+# --- Gallery Reports ---
+def print_ann_report(index, args):
+    """Prints the approximate-search recall report (see backend.ann_recall_report) for the chosen metric."""
+    ann = index.snapshot.ann
+    if ann is None:
+        print(f"No approximate index for {args.model}; the report trains a throwaway one (use --train-ann to keep it).")
+    else:
+        recall = 'unverified' if ann.verified_recall is None else f"{ann.verified_recall:.4f}"
+        state = 'enabled' if ann.enabled else 'disabled'
+        print(f"Approximate index for {args.model}: {ann.n_lists} cells, n_probe={ann.n_probe}, verified recall {recall} ({state}, target {backend.ANN_RECALL_TARGET}).")
+    report = backend.ann_recall_report(index, args.metric, args.threshold, top_k=args.top_k)
+    print(report.to_string(index=False) if len(report) else "The gallery has fewer than two faces.")
+
+
+def parse_box(value):
+    try:
+        x, y, w, h = (int(part) for part in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected X,Y,W,H, got {value!r}")
+    return (x, y, w, h)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Match faces in images and videos against a face database, without the dashboard.")
+    parser.add_argument('inputs', nargs='*', help="Image/video files or folders (folders are searched recursively).")
+    parser.add_argument('--list', action='append', default=[], metavar='FILE', help="Text file with one input path per line. May be repeated.")
+    parser.add_argument('--no-recursive', dest='recursive', action='store_false', help="Only look at the top level of input folders.")
+    parser.add_argument('--db', default=os.path.join(os.getcwd(), "face_database"), help="Face database folder (source images). Default: ./face_database")
+    parser.add_argument('--no-build', dest='build', action='store_false', help="Use the cropped database as is instead of updating it first.")
+    parser.add_argument('-o', '--output', default="results.jsonl", help="Output file; .jsonl or .parquet. Default: results.jsonl")
+    parser.add_argument('--format', choices=('jsonl', 'parquet'), help="Output format. Default: from the output file's extension.")
+    parser.add_argument('--resume', action='store_true', help="Skip inputs already finished in a previous run with the same output.")
+    parser.add_argument('--model', default="ArcFace")
+    parser.add_argument('--detector', default="retinaface")
+    parser.add_argument('--metric', default="cosine", choices=('cosine', 'euclidean', 'euclidean_l2'))
+    parser.add_argument('--threshold', type=float, help="Verification threshold. Default: the model's own threshold for the metric.")
+    parser.add_argument('--top-k', type=int, default=5, help="Candidates to keep per face. Default: 5")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Model worker processes. Default: CPU count")
+    parser.add_argument('--frame-skip', type=int, default=15, help="Process one of every N video frames. Default: 15")
+    parser.add_argument('--sample-seconds', type=float, help="Sample one video frame every N seconds instead of --frame-skip.")
+    parser.add_argument('--adaptive-sampling', action='store_true', help="Sample densely around scene cuts and new faces.")
+    parser.add_argument('--detect-max-side', type=int, default=backend.DETECTION_MAX_SIDE,
+                        help=f"Run the detector on media downscaled to this longer side; faces are still cut at full resolution. 0 = full resolution. Default: {backend.DETECTION_MAX_SIDE}")
+    parser.add_argument('--roi', type=parse_box, action='append', metavar='X,Y,W,H', help="Only detect faces inside this box (full-resolution pixels). May be repeated.")
+    parser.add_argument('--cache-dir', help="Reuse analysis of media seen before (see MediaCache).")
+    parser.add_argument('--metrics-file', help="Write per-stage timings in the Prometheus text format here at the end.")
+    parser.add_argument('--trace-file', help="Write a Chrome/Perfetto trace of every stage span here at the end.")
+    parser.add_argument('--train-ann', action='store_true', help="Train and tune the approximate index for the gallery now (otherwise it is trained in the background from a large gallery size on).")
+    parser.add_argument('--ann-report', action='store_true', help="Print the approximate-search recall report for the gallery.")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Only print the final summary.")
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.list and not (args.train_ann or args.ann_report):
+        parser.error("no inputs given")
+    args.format = args.format or ('parquet' if args.output.lower().endswith('.parquet') else 'jsonl')
+    args.model_threshold = backend.get_threshold(args.model, args.metric)
+    if args.threshold is None:
+        args.threshold = args.model_threshold
+    return args
+
+def prepare_gallery(args, log):
+    """Warms the model pool, brings the cropped database up to date (unless --no-build) and returns the synced gallery index."""
+    backend.warm_model_pool(args.model, args.detector, args.workers)
+    args.gallery = os.path.join(args.db, "_cropped_faces")
+    if args.build:
+        for update_type, data in backend.crop_and_prepare_db_stream(args.db, args.detector, args.model, args.workers):
+            if update_type == 'result':
+                log(f"Face database ready: {data[1]} new face crop(s), {len(data[2])} source(s) without a face.")
+    index = backend.get_gallery_index(args.gallery, args.model, args.detector)
+    if args.train_ann:
+        ann = index.build_ann()
+        if ann is not None:
+            log(f"Approximate index trained: n_probe={ann.n_probe}, verified recall {ann.verified_recall:.4f} ({'enabled' if ann.enabled else 'disabled'}).")
+    if args.ann_report:
+        print_ann_report(index, args)
+    return index
+
+def main(argv=None):
+    args = parse_args(argv)
+    log = (lambda message: None) if args.quiet else (lambda message: print(message, file=sys.stderr, flush=True))
+    if not args.inputs and not args.list:
+        prepare_gallery(args, log)
+        return 0
+
+    inputs = collect_inputs(args.inputs, args.list, args.recursive)
+    checkpoint_path = args.output if args.format == 'jsonl' else args.output + ".jsonl"
+    writer = ResultWriter(checkpoint_path, args.resume)
+    stats = Throughput()
+    pending = [(path, kind) for path, kind in inputs if path not in writer.completed]
+    stats.skipped = len(inputs) - len(pending)
+    log(f"{len(inputs)} input(s), {len(pending)} to process.")
+
+    index = prepare_gallery(args, log)
+
+    metadata_path = os.path.join(args.db, "metadata.sqlite3")
+    metadata = backend.MetadataStore(metadata_path) if os.path.exists(metadata_path) else None
+    cache = backend.MediaCache(args.cache_dir) if args.cache_dir else None
+    if args.metrics_file or args.trace_file:
+        metrics = backend.PipelineMetrics(trace=bool(args.trace_file))
+    else:
+        metrics = backend.NO_METRICS
+
+    interrupted = False
+    try:
+        run_images([path for path, kind in pending if kind == 'image'], index, args, writer, stats, metadata, cache, log, metrics)
+        for path, kind in pending:
+            if kind == 'video':
+                run_video(path, args, writer, stats, metadata, cache, log, metrics)
+    except KeyboardInterrupt:
+        interrupted = True
+        log("Interrupted; run again with --resume to continue.")
+    finally:
+        writer.close()
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file, labels={'model': args.model, 'detector': args.detector})
+        if args.trace_file:
+            metrics.write_trace(args.trace_file)
+
+    print(stats.report(), file=sys.stderr)
+    if interrupted:
+        return 130
+    if args.format == 'parquet':
+        try:
+            convert_to_parquet(checkpoint_path, args.output)
+        except ImportError as e:
+            print(f"Cannot write Parquet ({e}); the results are in {checkpoint_path}.", file=sys.stderr)
+            return 1
+        log(f"Wrote {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
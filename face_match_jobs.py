@@ -0,0 +1,415 @@
+# face_match_jobs.py
+#
+# Local job scheduler for analyses and gallery builds, shared by every
+# dashboard session of one app process.
+#
+#   scheduler = JobScheduler("face_database/_jobs", workers=2)
+#   job_id = scheduler.submit('video', params, PRIORITY_VIDEO, input_path="clip.mp4")
+#   scheduler.get(job_id)       # status, progress, queue position, timestamps
+#   scheduler.result(job_id)    # what the job's runner returned, once it is done
+#   scheduler.cancel(job_id)
+#
+# Jobs run on a bounded number of threads, highest priority first and oldest
+# first within a priority; the heavy work still happens on the backend's shared
+# model pool. Gallery builds run one at a time: while one runs, the others stay
+# in the queue and the worker threads take the next job of another kind. Job state and progress live in
+# SQLite and results in pickle files under the state folder, so a job outlives
+# the browser tab that started it, and jobs that were queued or running when
+# the process stopped are queued again when it restarts. Inputs are copied into
+# the state folder at submit time and removed once the job has finished.
+
+import os
+import json
+import time
+import uuid
+import heapq
+import pickle
+import shutil
+import sqlite3
+import threading
+from collections import deque
+
+import cv2
+import face_match_backend as backend
+
+
+PRIORITY_IMAGE = 20
+PRIORITY_BUILD = 10
+PRIORITY_VIDEO = 0
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_MAX_QUEUED = 100
+DEFAULT_RETENTION_SECONDS = 7 * 24 * 3600
+PROGRESS_INTERVAL = 0.5
+PREVIEW_INTERVAL = 1.0
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+# Kinds that never run two at a time; a waiting one stays queued rather than holding a worker thread.
+EXCLUSIVE_KINDS = ('build',)
+
+
+class JobQueueFull(Exception):
+    """Raised by submit when max_queued jobs are already waiting."""
+
+class JobCancelled(Exception):
+    """Raised inside a runner (by JobContext.check) once its job was cancelled."""
+
+
+# --- Runners ---
+# A runner takes (params, context), reports through the context and returns a
+# picklable result. Long runners call context.check() between steps.
+
+def run_image_job(params, context):
+    metrics = backend.PipelineMetrics() if params.get('stage_timings') else None
+    cache = backend.MediaCache(params['cache_dir']) if params.get('cache_dir') else None
+    context.progress(0.0, "Analyzing image...", force=True)
+    processed_img, results, error = backend.process_image(
+        params['path'], params['db_path'], params['model_name'], params['detector_backend'],
+        params['distance_metric'], params['verification_threshold'], cache=cache, metrics=metrics,
+        max_side=params.get('max_side', backend.DETECTION_MAX_SIDE)
+    )
+    return {
+        'processed_media': processed_img,
+        'results': results or [],
+        'errors': [error] if error else [],
+        'stage_timings': metrics.snapshot() if metrics is not None else None,
+    }
+
+def run_video_job(params, context):
+    metrics = backend.PipelineMetrics() if params.get('stage_timings') else None
+    cache = backend.MediaCache(params['cache_dir']) if params.get('cache_dir') else None
+    processor = backend.process_video(
+        params['path'], params['db_path'], params['model_name'], params['detector_backend'],
+        params['distance_metric'], params['verification_threshold'], params['frame_skip'], params.get('workers'),
+        sample_seconds=params.get('sample_seconds'), adaptive_sampling=params.get('adaptive_sampling', False),
+        max_side=params.get('max_side', backend.DETECTION_MAX_SIDE), cache=cache, metrics=metrics
+    )
+    results, errors, stage_timings = [], [], None
+    try:
+        for update_type, data in processor:
+            context.check()
+            if update_type == 'progress': context.progress(data['value'], data['text'])
+            elif update_type == 'frame_update': context.preview(data)
+            elif update_type == 'result': results.append(data)
+            elif update_type == 'error': errors.append(data)
+            elif update_type == 'metrics': stage_timings = data
+            elif update_type == 'debug': context.log.append(data)
+    finally:
+        # Stops the decoder thread and in-flight frames when the job is cancelled.
+        processor.close()
+    return {'results': results, 'errors': errors, 'stage_timings': stage_timings, 'log': list(context.log)}
+
+def run_build_job(params, context):
+    count, failures = 0, []
+    stream = backend.crop_and_prepare_db_stream(
+        params['source_db_path'], params['detector_backend'], params.get('model_name'), params.get('workers')
+    )
+    try:
+        for update_type, data in stream:
+            context.check()
+            if update_type == 'progress': context.progress(data['value'], data['text'])
+            elif update_type == 'failure': failures.append(data)
+            elif update_type == 'result': _, count, failures = data
+            elif update_type == 'debug': context.log.append(data)
+    finally:
+        stream.close()
+    return {'count': count, 'failures': failures, 'log': list(context.log)}
+
+RUNNERS = {'image': run_image_job, 'video': run_video_job, 'build': run_build_job}
+
+
+# --- Scheduler ---
+class JobContext:
+    """Handed to a runner: throttled progress and preview reporting, and cancellation."""
+
+    def __init__(self, scheduler, job_id):
+        self.scheduler = scheduler
+        self.job_id = job_id
+        self.log = deque(maxlen=200)
+        self._cancel = threading.Event()
+        self._last_progress = self._last_preview = 0.0
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def progress(self, value, text='', force=False):
+        now = time.time()
+        if force or value >= 1.0 or now - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = now
+            self.scheduler._update(self.job_id, progress=float(value), progress_text=text)
+
+    def preview(self, frame):
+        """Keeps the latest frame as a JPEG next to the job, for the dashboard to show."""
+        now = time.time()
+        if now - self._last_preview < PREVIEW_INTERVAL:
+            return
+        self._last_preview = now
+        path = self.scheduler.preview_path(self.job_id)
+        tmp_path = path + ".tmp.jpg"
+        if cv2.imwrite(tmp_path, frame, [cv2.IMWRITE_JPEG_QUALITY, 80]):
+            os.replace(tmp_path, path)
+
+
+class JobScheduler:
+    """
+    Priority job queue with a bounded number of worker threads and its state
+    in SQLite (see the module notes). Safe to share between sessions and threads.
+    """
+
+    def __init__(self, state_dir, workers=DEFAULT_JOB_WORKERS, max_queued=DEFAULT_MAX_QUEUED, runners=None, retention_seconds=DEFAULT_RETENTION_SECONDS):
+        self.state_dir = state_dir
+        self.workers = max(1, int(workers))
+        self.max_queued = max_queued
+        self.runners = dict(RUNNERS if runners is None else runners)
+        self.retention_seconds = retention_seconds
+        for sub_dir in ("inputs", "results", "previews"):
+            os.makedirs(os.path.join(state_dir, sub_dir), exist_ok=True)
+        self.db_path = os.path.join(state_dir, "jobs.sqlite3")
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, label TEXT NOT NULL DEFAULT '', owner TEXT, "
+                "priority INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL, params TEXT NOT NULL, "
+                "progress REAL NOT NULL DEFAULT 0, progress_text TEXT NOT NULL DEFAULT '', error TEXT, "
+                "created REAL NOT NULL, started REAL, finished REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, created)")
+
+        self._heap = []
+        self._condition = threading.Condition()
+        self._contexts = {}
+        # Exclusive kinds with a job running; guarded by _condition.
+        self._running_exclusive = set()
+        self.prune()
+        self._recover()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True) for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _recover(self):
+        """Queues again the jobs a previous process left queued or running."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, progress = 0, progress_text = '', started = NULL WHERE status = ?",
+                (QUEUED, RUNNING)
+            )
+            rows = conn.execute("SELECT id, kind, priority, created FROM jobs WHERE status = ?", (QUEUED,)).fetchall()
+        for row in rows:
+            heapq.heappush(self._heap, (-row['priority'], row['created'], row['id'], row['kind']))
+
+    # Paths
+    def input_path(self, job_id, extension=''):
+        return os.path.join(self.state_dir, "inputs", f"{job_id}{extension}")
+
+    def result_path(self, job_id):
+        return os.path.join(self.state_dir, "results", f"{job_id}.pkl")
+
+    def preview_path(self, job_id):
+        return os.path.join(self.state_dir, "previews", f"{job_id}.jpg")
+
+    # Public API
+    def submit(self, kind, params, priority=0, input_path=None, label='', owner=None):
+        """
+        Queues a job and returns its id. With input_path, the file is copied
+        into the state folder and the runner gets the copy as params['path'].
+        Raises JobQueueFull when max_queued jobs are already waiting.
+        """
+        if kind not in self.runners:
+            raise ValueError(f"Unknown job kind: {kind}")
+        if self.max_queued and self.count(QUEUED) >= self.max_queued:
+            raise JobQueueFull(f"{self.max_queued} jobs are already queued.")
+        job_id = uuid.uuid4().hex
+        params = dict(params)
+        if input_path is not None:
+            params['path'] = self.input_path(job_id, os.path.splitext(input_path)[1].lower())
+            shutil.copyfile(input_path, params['path'])
+        created = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, label, owner, priority, status, params, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, label, owner, int(priority), QUEUED, json.dumps(params), created)
+            )
+        with self._condition:
+            heapq.heappush(self._heap, (-int(priority), created, job_id, kind))
+            self._condition.notify()
+        return job_id
+
+    def get(self, job_id):
+        """The job as a dict (params decoded, plus queue_position while queued), or None."""
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['queue_position'] = None
+        if job['status'] == QUEUED:
+            job['queue_position'] = 1 + self._connect().execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND (priority > ? OR (priority = ? AND created < ?))",
+                (QUEUED, job['priority'], job['priority'], job['created'])
+            ).fetchone()[0]
+        job['cancel_requested'] = job_id in self._contexts and self._contexts[job_id].cancelled
+        return job
+
+    def list_jobs(self, kind=None, statuses=None, owner=None, limit=20):
+        """Most recent jobs first, optionally filtered; params are left out."""
+        query, args = "SELECT id, kind, label, owner, priority, status, progress, progress_text, error, created, started, finished FROM jobs", []
+        conditions = []
+        if kind is not None:
+            conditions.append("kind = ?")
+            args.append(kind)
+        if statuses:
+            conditions.append(f"status IN ({', '.join('?' * len(statuses))})")
+            args.extend(statuses)
+        if owner is not None:
+            conditions.append("owner = ?")
+            args.append(owner)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created DESC LIMIT ?"
+        args.append(limit)
+        return [dict(row) for row in self._connect().execute(query, args).fetchall()]
+
+    def count(self, status):
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def result(self, job_id):
+        """What the job's runner returned, or None until the job is done."""
+        try:
+            with open(self.result_path(job_id), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued job at once, or asks a running one to stop at its next
+        check. Returns False if the job is unknown or already finished.
+        """
+        with self._connect() as conn:
+            cancelled = conn.execute(
+                "UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                (CANCELLED, time.time(), job_id, QUEUED)
+            ).rowcount
+        if cancelled:
+            self._remove_input(job_id)
+            return True
+        context = self._contexts.get(job_id)
+        if context is None:
+            return False
+        context._cancel.set()
+        return True
+
+    def prune(self):
+        """Deletes finished jobs older than retention_seconds, with their files."""
+        cutoff = time.time() - self.retention_seconds
+        with self._connect() as conn:
+            old = [row['id'] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?, ?) AND finished < ?", (DONE, FAILED, CANCELLED, cutoff)
+            ).fetchall()]
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in old])
+        for job_id in old:
+            self._remove_input(job_id)
+            for path in (self.result_path(job_id), self.preview_path(job_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+        return len(old)
+
+    # Workers
+    def _update(self, job_id, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def _remove_input(self, job_id):
+        for name in os.listdir(os.path.join(self.state_dir, "inputs")):
+            if name.startswith(job_id):
+                try:
+                    os.remove(os.path.join(self.state_dir, "inputs", name))
+                except OSError:
+                    pass
+
+    def _next_job(self):
+        """
+        Pops the first queued job that may start now, skipping those of an
+        exclusive kind that is already running (they keep their place).
+        Returns (job_id, kind), or None. Called with _condition held.
+        """
+        skipped, found = [], None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if entry[3] in self._running_exclusive:
+                skipped.append(entry)
+                continue
+            found = entry[2], entry[3]
+            break
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return found
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next_job()
+                job_id, kind = job
+                if kind in EXCLUSIVE_KINDS:
+                    self._running_exclusive.add(kind)
+            try:
+                self._run(job_id)
+            finally:
+                if kind in EXCLUSIVE_KINDS:
+                    with self._condition:
+                        self._running_exclusive.discard(kind)
+                        # A job of this kind may be waiting while other threads sleep.
+                        self._condition.notify_all()
+
+    def _run(self, job_id):
+        context = JobContext(self, job_id)
+        self._contexts[job_id] = context
+        try:
+            with self._connect() as conn:
+                claimed = conn.execute(
+                    "UPDATE jobs SET status = ?, started = ? WHERE id = ? AND status = ?",
+                    (RUNNING, time.time(), job_id, QUEUED)
+                ).rowcount
+            if not claimed:
+                # Cancelled while it was waiting.
+                return
+            job = self.get(job_id)
+            runner = self.runners[job['kind']]
+            try:
+                context.check()
+                result = runner(job['params'], context)
+                context.check()
+                tmp_path = self.result_path(job_id) + ".tmp"
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, self.result_path(job_id))
+                self._update(job_id, status=DONE, progress=1.0, finished=time.time())
+            except JobCancelled:
+                self._update(job_id, status=CANCELLED, finished=time.time())
+            except Exception as e:
+                self._update(job_id, status=FAILED, error=f"{type(e).__name__}: {e}", finished=time.time())
+        finally:
+            self._contexts.pop(job_id, None)
+            self._remove_input(job_id)
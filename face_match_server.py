@@ -0,0 +1,562 @@
+# face_match_server.py
+#
+# Local HTTP service over face_match_backend, plus a small load generator.
+#
+#   python face_match_server.py serve --db face_database --port 8765
+#   python face_match_server.py loadgen --image face.jpg --concurrency 32 --requests 500
+#
+# Endpoints (images are sent as the raw request body):
+#   POST /detect              faces and boxes
+#   POST /embed               faces with embeddings (?aligned=1: the body is one aligned face crop)
+#   POST /match               faces with their gallery matches (?top_k=5&threshold=0.68)
+#   POST /video-jobs          queue a video for process_video; returns a job id
+#   GET  /video-jobs/<id>     job status, progress and results (kept for an hour after it finishes)
+#   GET  /health              queue depths and batching statistics
+#   GET  /metrics             per-stage timings and queue depths, Prometheus text format
+#
+# Concurrent requests are grouped per stage by a MicroBatcher, so one worker
+# task detects faces for several images, one forward pass embeds the faces of
+# several requests, and one gallery search serves them all. Each stage has a
+# bounded queue; a full queue answers 503 with Retry-After, and a request whose
+# deadline (X-Deadline-Ms header or deadline_ms parameter) passes answers 504.
+
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import argparse
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import face_match_backend as backend
+
+
+DEFAULT_MAX_BATCH_SIZE = 16
+DEFAULT_MAX_WAIT_MS = 10
+DEFAULT_MAX_QUEUE = 256
+DEFAULT_DEADLINE_MS = 30000
+DEFAULT_MAX_VIDEO_JOBS = 8
+GALLERY_REFRESH_SECONDS = 30
+# Finished video jobs are kept this long, and at most this many of them, for clients to collect.
+FINISHED_JOB_TTL_SECONDS = 3600
+MAX_FINISHED_JOBS = 100
+
+
+class QueueFull(Exception):
+    pass
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# --- Micro-batching ---
+class BatchItem:
+    """One queued request; the waiting handler thread blocks in result()."""
+
+    def __init__(self, payload, deadline):
+        self.payload = payload
+        self.deadline = deadline
+        self._done = threading.Event()
+        self._result = self._error = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._done.set()
+
+    def result(self):
+        if not self._done.wait(max(0.0, self.deadline - time.time())):
+            raise DeadlineExceeded()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class MicroBatcher:
+    """
+    Groups concurrently submitted items into batches for process_batch(payloads),
+    which returns one result (or exception) per payload.
+
+    A batch is dispatched once it holds max_batch_size items or its first item
+    has waited max_wait_ms. `concurrency` dispatcher threads let several batches
+    run at once (one per model worker). Items whose deadline has passed are
+    dropped before they reach the model, and submit() raises QueueFull once
+    max_queue items are waiting.
+    """
+
+    def __init__(self, name, process_batch, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS, max_queue=DEFAULT_MAX_QUEUE, concurrency=1):
+        self.name = name
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batches = self.items = self.expired = self.rejected = 0
+        self._lock = threading.Lock()
+        for i in range(max(1, concurrency)):
+            threading.Thread(target=self._run, name=f"{name}-batcher-{i}", daemon=True).start()
+
+    def submit(self, payload, deadline):
+        item = BatchItem(payload, deadline)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFull(self.name)
+        return item
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        flush_at = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = flush_at - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            now = time.time()
+            live = []
+            for item in batch:
+                if item.deadline <= now:
+                    item.set_error(DeadlineExceeded())
+                else:
+                    live.append(item)
+            with self._lock:
+                self.expired += len(batch) - len(live)
+            if not live:
+                continue
+            try:
+                results = self.process_batch([item.payload for item in live])
+            except Exception as e:
+                results = [e] * len(live)
+            for item, result in zip(live, results):
+                if isinstance(result, Exception):
+                    item.set_error(result)
+                else:
+                    item.set_result(result)
+            with self._lock:
+                self.batches += 1
+                self.items += len(live)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self.queue.qsize(),
+                'max_queue': self.queue.maxsize,
+                'batches': self.batches,
+                'items': self.items,
+                'mean_batch_size': round(self.items / self.batches, 2) if self.batches else 0,
+                'expired': self.expired,
+                'rejected': self.rejected,
+            }
+
+
+# --- Service ---
+class MatchService:
+    """The detect -> embed -> match stages, each behind its own MicroBatcher."""
+
+    def __init__(self, db_path, model_name, detector_backend, distance_metric, workers, max_batch_size, max_wait_ms, max_queue, max_video_jobs, cache_dir=None, detect_max_side=backend.DETECTION_MAX_SIDE):
+        self.db_path = db_path
+        self.gallery_path = os.path.join(db_path, "_cropped_faces")
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self.distance_metric = distance_metric
+        self.workers = workers
+        self.detect_max_side = detect_max_side
+        self.model_threshold = backend.get_threshold(model_name, distance_metric)
+        self.model_pool = backend.warm_model_pool(model_name, detector_backend, workers)
+        self.cache = backend.MediaCache(cache_dir) if cache_dir else None
+        self.metrics = backend.PipelineMetrics()
+
+        self._index, self._index_loaded = None, 0.0
+        self._index_lock = threading.Lock()
+        metadata_path = os.path.join(db_path, "metadata.sqlite3")
+        self.metadata = backend.MetadataStore(metadata_path) if os.path.exists(metadata_path) else None
+
+        concurrency = self.model_pool.concurrency(workers)
+        self.detector = MicroBatcher('detect', self._detect_batch, max_batch_size, max_wait_ms, max_queue, concurrency)
+        self.embedder = MicroBatcher('embed', self._embed_batch, 4 * max_batch_size, max_wait_ms, max_queue, concurrency)
+        self.matcher = MicroBatcher('match', self._match_batch, 4 * max_batch_size, max_wait_ms, max_queue, 1)
+
+        self.jobs = {}
+        self._jobs_lock = threading.Lock()
+        self.job_queue = queue.Queue(maxsize=max_video_jobs)
+        threading.Thread(target=self._run_video_jobs, name="video-jobs", daemon=True).start()
+
+    # Batch functions: one pool task / forward pass / search per batch.
+    def _run_task(self, fn, *args):
+        task = self.model_pool.submit(fn, *args)
+        result = task.get()
+        self.metrics.record_task(task)
+        return result
+
+    def _detect_batch(self, frames):
+        self.metrics.gauge('detect', self.detector.queue.qsize())
+        return self._run_task(backend.detect_faces_batch_in_process, frames, self.detector_backend, self.detect_max_side)
+
+    def _embed_batch(self, crop_lists):
+        all_crops = [crop for crops in crop_lists for crop in crops]
+        if not all_crops:
+            return [[] for _ in crop_lists]
+        self.metrics.gauge('embed', self.embedder.queue.qsize())
+        embeddings = self._run_task(backend.embed_faces_in_process, all_crops, self.model_name)
+        if isinstance(embeddings, Exception):
+            return [embeddings] * len(crop_lists)
+        results, start = [], 0
+        for crops in crop_lists:
+            results.append(embeddings[start:start + len(crops)])
+            start += len(crops)
+        return results
+
+    def _match_batch(self, queries):
+        index = self.gallery_index()
+        all_embeddings = [embedding for embeddings, _, _ in queries for embedding in embeddings]
+        if not all_embeddings:
+            return [[] for _ in queries]
+        max_top_k = max(top_k for _, top_k, _ in queries)
+        self.metrics.gauge('match', self.matcher.queue.qsize())
+        with self.metrics.span('search', len(all_embeddings)):
+            matches_df_list = index.search(all_embeddings, self.distance_metric, self.model_threshold, top_k=max_top_k)
+        results, start = [], 0
+        for embeddings, top_k, threshold in queries:
+            results.append([self._match_fields(df.head(top_k), threshold) for df in matches_df_list[start:start + len(embeddings)]])
+            start += len(embeddings)
+        return results
+
+    def gallery_index(self):
+        with self._index_lock:
+            if self._index is None or time.time() - self._index_loaded > GALLERY_REFRESH_SECONDS:
+                self._index = backend.get_gallery_index(self.gallery_path, self.model_name, self.detector_backend)
+                self._index_loaded = time.time()
+            return self._index
+
+    def _match_fields(self, df, threshold):
+        candidates = []
+        for row in df.itertuples():
+            candidate = {
+                'identity': os.path.basename(row.identity),
+                'distance': float(row.distance),
+                'similarity': float(backend.similarity_from_distances([row.distance], threshold)[0]),
+            }
+            if self.metadata is not None:
+                candidate.update(self.metadata.lookup_crop(row.identity)[1])
+            candidates.append(candidate)
+        return {
+            'matched': bool(candidates and candidates[0]['distance'] <= threshold),
+            'matches': candidates,
+        }
+
+    # Request pipeline.
+    def detect(self, img, deadline):
+        faces = self.detector.submit(img, deadline).result()
+        return [{
+            'box': [face['facial_area']['x'], face['facial_area']['y'], face['facial_area']['w'], face['facial_area']['h']],
+            'confidence': float(face.get('confidence') or 0),
+            'face': face['face'],
+        } for face in faces]
+
+    def embed(self, img, deadline, aligned=False):
+        if aligned:
+            embeddings = self.embedder.submit([img], deadline).result()
+            return [{'embedding': np.asarray(embeddings[0], dtype=float).tolist()}]
+        faces = self.detect(img, deadline)
+        embeddings = self.embedder.submit([face['face'] for face in faces], deadline).result()
+        for face, embedding in zip(faces, embeddings):
+            face['embedding'] = np.asarray(embedding, dtype=float).tolist()
+        return faces
+
+    def match(self, img, deadline, top_k, threshold):
+        faces = self.embed(img, deadline)
+        results = self.matcher.submit(([face['embedding'] for face in faces], top_k, threshold), deadline).result()
+        for face, result in zip(faces, results):
+            face.update(result)
+            del face['embedding']
+        return faces
+
+    # Video jobs run one at a time on the same model pool.
+    def submit_video(self, video_bytes, suffix, params):
+        job_id = uuid.uuid4().hex
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
+        tmp.write(video_bytes)
+        tmp.close()
+        job = {'id': job_id, 'status': 'queued', 'progress': 0.0, 'text': '', 'results': [], 'error': None, 'path': tmp.name, 'params': params, 'finished': None}
+        self._prune_jobs()
+        with self._jobs_lock:
+            self.jobs[job_id] = job
+        try:
+            self.job_queue.put_nowait(job)
+        except queue.Full:
+            with self._jobs_lock:
+                del self.jobs[job_id]
+            os.remove(tmp.name)
+            raise QueueFull('video-jobs')
+        return job_id
+
+    def _prune_jobs(self):
+        """Drops finished jobs past FINISHED_JOB_TTL_SECONDS, and the oldest beyond MAX_FINISHED_JOBS."""
+        with self._jobs_lock:
+            finished = sorted((job for job in self.jobs.values() if job['finished'] is not None), key=lambda job: job['finished'])
+            expired = time.time() - FINISHED_JOB_TTL_SECONDS
+            for i, job in enumerate(finished):
+                if job['finished'] < expired or i < len(finished) - MAX_FINISHED_JOBS:
+                    del self.jobs[job['id']]
+
+    def _run_video_jobs(self):
+        while True:
+            job = self.job_queue.get()
+            job['status'] = 'running'
+            params = job['params']
+            try:
+                processor = backend.process_video(
+                    job['path'], self.gallery_path, self.model_name, self.detector_backend, self.distance_metric,
+                    params['threshold'], params['frame_skip'], self.workers,
+                    sample_seconds=params['sample_seconds'], max_side=self.detect_max_side, cache=self.cache
+                )
+                for update_type, data in processor:
+                    if update_type == 'progress':
+                        job['progress'], job['text'] = data['value'], data['text']
+                    elif update_type == 'result':
+                        job['results'].append({
+                            'person': data['person_index'],
+                            'frame': data['frame'],
+                            'box': [data['facial_area'][k] for k in ('x', 'y', 'w', 'h')],
+                            'instances': data['face_count'],
+                            **self._match_fields(data['matches'].head(params['top_k']), params['threshold']),
+                        })
+                    elif update_type == 'error':
+                        job['error'] = data
+                job['status'] = 'done'
+            except Exception as e:
+                job['status'], job['error'] = 'failed', str(e)
+            finally:
+                os.remove(job['path'])
+                job['finished'] = time.time()
+                self._prune_jobs()
+
+    def job_status(self, job_id):
+        with self._jobs_lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return {k: v for k, v in job.items() if k not in ('path', 'params', 'finished')}
+
+    def health(self):
+        return {
+            'model': self.model_name,
+            'detector': self.detector_backend,
+            'workers': self.model_pool.workers,
+            'stages': {batcher.name: batcher.stats() for batcher in (self.detector, self.embedder, self.matcher)},
+            'video_jobs_queued': self.job_queue.qsize(),
+        }
+
+
+# --- HTTP ---
+class MatchServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class MatchRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    service = None  # Set by serve().
+    default_deadline_ms = DEFAULT_DEADLINE_MS
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            return self._send_json(200, self.service.health())
+        if url.path == '/metrics':
+            body = self.service.metrics.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if url.path.startswith('/video-jobs/'):
+            job = self.service.job_status(url.path.rsplit('/', 1)[1])
+            if job is None:
+                return self._send_json(404, {'error': "Unknown job."})
+            return self._send_json(200, job)
+        self._send_json(404, {'error': "Not found."})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body = self._read_body()
+
+        try:
+            deadline_ms = float(self.headers.get('X-Deadline-Ms') or params.get('deadline_ms') or self.default_deadline_ms)
+            threshold = float(params.get('threshold', self.service.model_threshold))
+            top_k = int(params.get('top_k', 5))
+            frame_skip = int(params.get('frame_skip', 15))
+            sample_seconds = float(params['sample_seconds']) if 'sample_seconds' in params else None
+        except ValueError as e:
+            return self._send_json(400, {'error': f"Invalid parameter: {e}"})
+        deadline = time.time() + deadline_ms / 1000.0
+
+        try:
+            if url.path == '/video-jobs':
+                job_id = self.service.submit_video(body, params.get('suffix', '.mp4'), {
+                    'threshold': threshold,
+                    'top_k': top_k,
+                    'frame_skip': frame_skip,
+                    'sample_seconds': sample_seconds,
+                })
+                return self._send_json(202, {'job': job_id})
+            if url.path not in ('/detect', '/embed', '/match'):
+                return self._send_json(404, {'error': "Not found."})
+
+            img = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                return self._send_json(400, {'error': "The request body is not a readable image."})
+            if url.path == '/detect':
+                faces = self.service.detect(img, deadline)
+            elif url.path == '/embed':
+                faces = self.service.embed(img, deadline, aligned=params.get('aligned') in ('1', 'true'))
+            else:
+                faces = self.service.match(img, deadline, top_k, threshold)
+            for face in faces:
+                face.pop('face', None)
+            self._send_json(200, {'faces': faces})
+        except QueueFull as e:
+            self._send_json(503, {'error': f"The {e} queue is full; retry later."}, {'Retry-After': '1'})
+        except DeadlineExceeded:
+            self._send_json(504, {'error': "Deadline exceeded."})
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+
+
+def serve(args):
+    service = MatchService(
+        args.db, args.model, args.detector, args.metric, args.workers,
+        args.max_batch_size, args.max_wait_ms, args.max_queue, args.max_video_jobs, args.cache_dir, args.detect_max_side
+    )
+    service.gallery_index()
+    MatchRequestHandler.service = service
+    MatchRequestHandler.default_deadline_ms = args.deadline_ms
+    server = MatchServer((args.host, args.port), MatchRequestHandler)
+    print(f"Serving {args.model}/{args.detector} on http://{args.host}:{args.port} with {service.model_pool.workers} worker(s).", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# --- Load Generator ---
+def loadgen(args):
+    """Posts an image from `concurrency` threads and reports latency percentiles and status codes."""
+    import http.client
+
+    with open(args.image, 'rb') as f:
+        body = f.read()
+    url = urlparse(args.url)
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+
+    def client():
+        conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        for _ in iter(lambda: next(counter, None), None):
+            started = time.time()
+            try:
+                conn.request('POST', f"/{args.endpoint}", body=body, headers={'X-Deadline-Ms': str(args.deadline_ms)})
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+                status = 'connection error'
+            with lock:
+                latencies.append(time.time() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+        conn.close()
+
+    started = time.time()
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    print(f"{len(latencies)} request(s) in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} req/s) with concurrency {args.concurrency}")
+    print(f"latency ms: p50={p50:.1f} p95={p95:.1f} p99={p99:.1f}")
+    print(f"status: {statuses}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Face matching HTTP service.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help="Run the HTTP service.")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--db', default=os.path.join(os.getcwd(), "face_database"), help="Face database folder. Default: ./face_database")
+    serve_parser.add_argument('--model', default="ArcFace")
+    serve_parser.add_argument('--detector', default="retinaface")
+    serve_parser.add_argument('--metric', default="cosine", choices=('cosine', 'euclidean', 'euclidean_l2'))
+    serve_parser.add_argument('--workers', type=int, default=backend.DEFAULT_POOL_WORKERS, help="Model worker processes.")
+    serve_parser.add_argument('--max-batch-size', type=int, default=DEFAULT_MAX_BATCH_SIZE, help="Images per detection batch; embedding and match batches hold 4x as many faces.")
+    serve_parser.add_argument('--max-wait-ms', type=float, default=DEFAULT_MAX_WAIT_MS, help="How long a batch waits to fill up.")
+    serve_parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE, help="Queued requests per stage before answering 503.")
+    serve_parser.add_argument('--deadline-ms', type=float, default=DEFAULT_DEADLINE_MS, help="Default per-request deadline.")
+    serve_parser.add_argument('--max-video-jobs', type=int, default=DEFAULT_MAX_VIDEO_JOBS, help="Queued video jobs before answering 503.")
+    serve_parser.add_argument('--cache-dir', help="MediaCache folder for video jobs.")
+    serve_parser.add_argument('--detect-max-side', type=int, default=backend.DETECTION_MAX_SIDE, help="Longer side the detector sees; 0 = full resolution.")
+
+    load_parser = commands.add_parser('loadgen', help="Send concurrent requests to a running service.")
+    load_parser.add_argument('--url', default='http://127.0.0.1:8765')
+    load_parser.add_argument('--endpoint', default='match', choices=('detect', 'embed', 'match'))
+    load_parser.add_argument('--image', required=True)
+    load_parser.add_argument('--concurrency', type=int, default=16)
+    load_parser.add_argument('--requests', type=int, default=200)
+    load_parser.add_argument('--deadline-ms', type=float, default=DEFAULT_DEADLINE_MS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'serve':
+        serve(args)
+    else:
+        loadgen(args)
+
+
+if __name__ == '__main__':
+    main()